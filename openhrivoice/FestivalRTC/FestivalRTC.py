@@ -25,6 +25,11 @@ import codecs
 import locale
 import wave
 import optparse
+import threading
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 import OpenRTM_aist
 import RTC
 from openhrivoice.__init__ import __version__
@@ -39,6 +44,137 @@ except:
 
 __doc__ = _('English speech synthesis component.')
 
+#
+#  quote string for Scheme
+#
+def schemestr(s):
+    return '"' + s.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+#
+#  Long-lived Festival interpreter (festival --pipe)
+#
+class FestivalProcess:
+    """ Utility class to run Scheme commands on a persistent Festival process.
+    Completion of the commands is detected by a marker written to stderr."""
+    #
+    # Constructor
+    def __init__(self, cmdline):
+        self._cmdline = cmdline
+        self._count = 0
+        self._proc = None
+        self._lines = None
+        self._busy = False
+        self._seq = None
+        self.start()
+
+    #
+    #  start process and stderr reader thread
+    def start(self):
+        self._proc = subprocess.Popen(self._cmdline, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+        self._lines = queue.Queue()
+        th = threading.Thread(target=self.readerr, args=(self._proc.stderr, self._lines))
+        th.daemon = True
+        th.start()
+
+    #
+    #  forward stderr lines (None at EOF)
+    def readerr(self, fp, lines):
+        for l in iter(fp.readline, b''):
+            lines.put(l.decode('utf-8', 'replace').rstrip())
+        lines.put(None)
+
+    #
+    #  kill process
+    def stop(self):
+        if self._proc is not None:
+            try:
+                self._proc.kill()
+                self._proc.wait()
+            except OSError:
+                pass
+            self._proc = None
+
+    #
+    #  restart process (after crash or timeout)
+    def restart(self):
+        self.stop()
+        self.start()
+
+    #
+    #  run commands of the request seq and wait for completion
+    #  (restart on crash or timeout)
+    def run(self, commands, timeout, seq=None):
+        self._count += 1
+        self._seq = seq
+        marker = 'openhri_done_%d' % (self._count,)
+        commands += '(format stderr "%s\\n")\n' % (marker,)
+        deadline = time.time() + timeout
+        self._busy = True
+        try:
+            self._proc.stdin.write(commands.encode('utf-8'))
+            self._proc.stdin.flush()
+            while True:
+                l = self._lines.get(timeout=max(deadline - time.time(), 0.001))
+                if l is None:
+                    raise RuntimeError('festival process terminated')
+                if l == marker:
+                    return
+                if l:
+                    print(l)
+        except queue.Empty:
+            self.restart()
+            raise RuntimeError('festival process timed out')
+        except:
+            self.restart()
+            raise
+        finally:
+            self._busy = False
+
+    #
+    #  kill process while running commands (restarted by run())
+    def kill(self):
+        if self._busy and self._proc is not None:
+            try:
+                self._proc.kill()
+            except OSError:
+                pass
+
+#
+#  Pool of Festival processes
+#
+class FestivalPool:
+    """ Utility class to distribute commands to idle Festival processes."""
+    #
+    # Constructor
+    def __init__(self, cmdline, size, timeout):
+        self._timeout = timeout
+        self._procs = [FestivalProcess(cmdline) for i in range(size)]
+        self._idle = queue.Queue()
+        for p in self._procs:
+            self._idle.put(p)
+
+    #
+    #  run commands of the request seq on an idle process
+    def run(self, commands, seq=None):
+        p = self._idle.get()
+        try:
+            p.run(commands, self._timeout, seq)
+        finally:
+            self._idle.put(p)
+
+    #
+    #  kill busy processes running requests for which killable(seq) is true (barge-in)
+    def kill(self, killable):
+        for p in self._procs:
+            if killable(p._seq):
+                p.kill()
+
+    #
+    #  terminate all processes
+    def terminate(self):
+        for p in self._procs:
+            p.stop()
+
 #
 #  Festival Wrapper class
 #
@@ -57,34 +193,59 @@ class FestivalWrap(VoiceSynthBase):
 
         self._cmdline =[self._config._festival_bin, '--pipe']
         self._cmdline.extend(self._config._festival_opt)
+        self._pool = None
+        self._poolparams = None
         self._copyrights = []
         self._copyrights.append(utils.read_file_contents('festival_copyright.txt'))
         self._copyrights.append(utils.read_file_contents('diphone_copyright.txt'))
 
+    #
+    #  set size of the process pool (0: run festival -b for each utterance)
+    def set_pool(self, size, timeout):
+        if self._poolparams == (size, timeout):
+            return
+        self.terminate()
+        if size > 0:
+            self._pool = FestivalPool(self._cmdline, size, timeout)
+        self._poolparams = (size, timeout)
+
     #
     #  Syntheseizer 
     def synthreal(self, data, samplerate, character):
-        textfile = self.gettempname()
         durfile = self.gettempname().replace("\\", "\\\\")
         wavfile = self.gettempname().replace("\\", "\\\\")
-        # text file which specifies synthesized string
-        fp = codecs.open(textfile, 'w', 'utf-8')
-        fp.write('(set! u (Utterance Text "' + data + '"))')
-        fp.write('(utt.synth u)')
-        fp.write('(utt.save.segs u "' + durfile + '")')
-        fp.write('(utt.save.wave u "' + wavfile + '")')
-        fp.close()
-
-        # run Festival
-        cmdarg =[self._config._festival_bin,] + self._config._festival_opt + ['-b', textfile]
-        p = subprocess.Popen(cmdarg)
-        p.wait()
-        #p = subprocess.Popen(self._cmdline, stdout=subprocess.PIPE, stdin=subprocess.PIPE)
-        #p.stdin.write('(set! u (Utterance Text "' + data + '"))')
-        #p.stdin.write('(utt.synth u)')
-        #p.stdin.write('(utt.save.segs u "' + durfile + '")')
-        #p.stdin.write('(utt.save.wave u "' + wavfile + '")')
-        #p.communicate()
+        commands = '(set! u (Utterance Text ' + schemestr(data) + '))\n'
+        commands += '(utt.synth u)\n'
+        commands += '(utt.save.segs u "' + durfile + '")\n'
+        commands += '(utt.save.wave u "' + wavfile + '")\n'
+
+        pool = self._pool
+        if pool is not None:
+            # run on a persistent Festival process
+            try:
+                pool.run(commands, self.procseq())
+            except:
+                os.remove(durfile)
+                os.remove(wavfile)
+                raise
+        else:
+            # text file which specifies synthesized string
+            textfile = self.gettempname()
+            fp = codecs.open(textfile, 'w', 'utf-8')
+            fp.write(commands)
+            fp.close()
+
+            # run Festival
+            cmdarg =[self._config._festival_bin,] + self._config._festival_opt + ['-b', textfile]
+            try:
+                self.runproc(cmdarg)
+            except:
+                for fn in (durfile, wavfile):
+                    if os.path.exists(fn):
+                        os.remove(fn)
+                raise
+            finally:
+                os.remove(textfile)
 
         # read data
         df = open(durfile, 'r')
@@ -93,6 +254,22 @@ class FestivalWrap(VoiceSynthBase):
         os.remove(durfile)
         return (durationdata, wavfile)
 
+    #
+    #  kill running Festival processes of the requests from fromseq
+    def killprocs(self, fromseq=0):
+        VoiceSynthBase.killprocs(self, fromseq)
+        pool = self._pool
+        if pool is not None:
+            pool.kill(lambda seq: self.killable(seq, fromseq))
+
+    #
+    #  terminate process pool
+    def terminate(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+        self._poolparams = None
+
 
 #
 #  RT-Component
@@ -119,6 +296,57 @@ FestivalRTC_spec = ["implementation_id", "FestivalRTC",
                     "conf.__widget__.character", "radio",
                     "conf.__constraints__.character", "(male)",
                     "conf.__description__.character", _("Character of the voice (fixed to male).").encode('UTF-8'),
+                    "conf.default.cache_dir", "",
+                    "conf.__widget__.cache_dir", "text",
+                    "conf.__description__.cache_dir", _("Directory of the persistent synthesis cache (default: ~/.openhri/synthcache).").encode('UTF-8'),
+                    "conf.default.cache_bytes", "67108864",
+                    "conf.__widget__.cache_bytes", "text",
+                    "conf.__type__.cache_bytes", "int",
+                    "conf.__description__.cache_bytes", _("Size limit of the persistent synthesis cache in bytes (0: disable cache).").encode('UTF-8'),
+                    "conf.default.streaming", "NO",
+                    "conf.__widget__.streaming", "radio",
+                    "conf.__constraints__.streaming", "(YES, NO)",
+                    "conf.__description__.streaming", _("Synthesize long text sentence by sentence and start output after the first one (YES/NO).").encode('UTF-8'),
+                    "conf.default.resample_quality", "medium",
+                    "conf.__widget__.resample_quality", "radio",
+                    "conf.__constraints__.resample_quality", "(fast, medium, high)",
+                    "conf.__description__.resample_quality", _("Quality of the sampling rate conversion (fast, medium, high).").encode('UTF-8'),
+                    "conf.default.synth_workers", "2",
+                    "conf.__widget__.synth_workers", "spin",
+                    "conf.__type__.synth_workers", "int",
+                    "conf.__constraints__.synth_workers", "0<=x<=16",
+                    "conf.__description__.synth_workers", _("Number of synthesis worker threads (0: synthesize in the data listener).").encode('UTF-8'),
+                    "conf.default.queue_size", "8",
+                    "conf.__widget__.queue_size", "spin",
+                    "conf.__type__.queue_size", "int",
+                    "conf.__constraints__.queue_size", "0<=x<=1000",
+                    "conf.__description__.queue_size", _("Maximum number of waiting texts to be synthesized, each counted as one request in streaming mode too (0: unlimited).").encode('UTF-8'),
+                    "conf.default.queue_policy", "block",
+                    "conf.__widget__.queue_policy", "radio",
+                    "conf.__constraints__.queue_policy", "(block, drop_oldest, drop_newest)",
+                    "conf.__description__.queue_policy", _("Behavior when the request queue is full.").encode('UTF-8'),
+                    "conf.default.warmup_file", "",
+                    "conf.__widget__.warmup_file", "text",
+                    "conf.__description__.warmup_file", _("Phrase file pre-synthesized into the cache on activation (one phrase per line, optionally followed by character and rate separated by tabs).").encode('UTF-8'),
+                    "conf.default.frame_ms", "20",
+                    "conf.__widget__.frame_ms", "spin",
+                    "conf.__type__.frame_ms", "int",
+                    "conf.__constraints__.frame_ms", "5<=x<=1000",
+                    "conf.__description__.frame_ms", _("Duration of an output audio frame in milliseconds.").encode('UTF-8'),
+                    "conf.default.lead_ms", "100",
+                    "conf.__widget__.lead_ms", "spin",
+                    "conf.__type__.lead_ms", "int",
+                    "conf.__constraints__.lead_ms", "0<=x<=5000",
+                    "conf.__description__.lead_ms", _("Audio sent ahead of its playback time in milliseconds.").encode('UTF-8'),
+                    "conf.default.pool_size", "2",
+                    "conf.__widget__.pool_size", "spin",
+                    "conf.__type__.pool_size", "int",
+                    "conf.__constraints__.pool_size", "0<=x<=16",
+                    "conf.__description__.pool_size", _("Number of persistent Festival processes (0: start festival for each utterance).").encode('UTF-8'),
+                    "conf.default.watchdog_timeout", "30.0",
+                    "conf.__widget__.watchdog_timeout", "text",
+                    "conf.__type__.watchdog_timeout", "float",
+                    "conf.__description__.watchdog_timeout", _("Time limit of a synthesis in seconds (a hung Festival process is restarted).").encode('UTF-8'),
                     ""]
 
 #
@@ -134,6 +362,10 @@ class FestivalRTC(VoiceSynthComponentBase):
     #  OnInitialize
     def onInitialize(self):
         VoiceSynthComponentBase.onInitialize(self)
+        self._pool_size = [2,]
+        self.bindParameter("pool_size", self._pool_size, "2")
+        self._watchdog_timeout = [30.0,]
+        self.bindParameter("watchdog_timeout", self._watchdog_timeout, "30.0")
         try:
             self._wrap = FestivalWrap(self._properties)
         except:
@@ -147,6 +379,13 @@ class FestivalRTC(VoiceSynthComponentBase):
             self._logger.RTC_INFO('')
         return RTC.RTC_OK
 
+    #
+    #  OnActivate
+    def onActivated(self, ec_id):
+        self._wrap.set_pool(int(self._pool_size[0]), float(self._watchdog_timeout[0]))
+        VoiceSynthComponentBase.onActivated(self, ec_id)
+        return RTC.RTC_OK
+
 #
 #   RTC Manager
 #
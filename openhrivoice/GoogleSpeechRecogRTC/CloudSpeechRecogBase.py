@@ -16,9 +16,253 @@ http://www.opensource.org/licenses/eclipse-1.0.txt
 import sys, os, socket, subprocess, signal, threading, platform
 import time, struct, traceback, getopt, wave, tempfile
 import optparse
+import collections
+import math
+try:
+    import httpclient
+except ImportError:
+    from openhrivoice import httpclient
 
-from pydub import AudioSegment
-from pydub.silence import *
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    import audioop
+except ImportError:
+    audioop = None
+
+#
+#  Streaming voice activity detection by frame energy
+#
+class EnergyVAD:
+    """ Utility class to detect speech segments frame by frame.
+    A frame is speech if its RMS level is above threshold (dBFS).
+    Speech ends after hangover (ms) of silent frames, and preroll (bytes)
+    of audio before the speech onset is included in the segment."""
+    #
+    #  Constructor
+    #
+    def __init__(self, frame_rate=16000, sample_width=2, channels=1, frame_ms=20, threshold=-20, hangover=200, preroll=8000):
+        self._sample_width = sample_width
+        self._channels = channels
+        self._framebytes = int(frame_rate * frame_ms / 1000) * sample_width * channels
+        maxval = float(1 << (8 * sample_width - 1))
+        self._power = (maxval * math.pow(10.0, threshold / 20.0)) ** 2
+        self._hangover = max(1, int(math.ceil(float(hangover) / frame_ms)))
+        self._prebuf = collections.deque(maxlen=max(1, preroll // self._framebytes))
+        self._pending = bytearray()
+        self._silent = 0
+        self.active = False
+
+    #
+    #  mean power of each frame
+    #
+    def powers(self, data, nframes):
+        if numpy is not None and self._sample_width == 2:
+            x = numpy.frombuffer(data, dtype='<i2', count=nframes * self._framebytes // 2).astype(numpy.float32)
+            return (x.reshape(nframes, -1) ** 2).mean(axis=1)
+        fb = self._framebytes
+        return [float(audioop.rms(bytes(data[i * fb:(i + 1) * fb]), self._sample_width)) ** 2 for i in range(nframes)]
+
+    #
+    #  process new audio data: returns list of (event, frame)
+    #  event: "start" (frame is pre-roll + first speech frame), "speech" or "end"
+    #
+    def process(self, data):
+        self._pending.extend(data)
+        nframes = len(self._pending) // self._framebytes
+        if nframes == 0:
+            return []
+        buf = bytes(self._pending[:nframes * self._framebytes])
+        del self._pending[:nframes * self._framebytes]
+        events = []
+        fb = self._framebytes
+        for (i, power) in enumerate(self.powers(buf, nframes)):
+            frame = buf[i * fb:(i + 1) * fb]
+            if self.active:
+                if power > self._power:
+                    self._silent = 0
+                    events.append(("speech", frame))
+                else:
+                    self._silent += 1
+                    if self._silent >= self._hangover:
+                        self.active = False
+                        self._prebuf.clear()
+                        events.append(("end", frame))
+                    else:
+                        events.append(("speech", frame))
+            elif power > self._power:
+                self.active = True
+                self._silent = 0
+                events.append(("start", b''.join(self._prebuf) + frame))
+                self._prebuf.clear()
+            else:
+                self._prebuf.append(frame)
+        return events
+
+#
+#  Growable audio store
+#
+class AudioBuffer:
+    """ Utility class to accumulate audio data in a preallocated bytearray.
+    The stored data is handed off without copy by view()."""
+    #
+    #  Constructor
+    #
+    def __init__(self, capacity=32000):
+        self._buf = bytearray(capacity)
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    #
+    #  append data (capacity is doubled when full)
+    #
+    def extend(self, data):
+        n = len(data)
+        if self._len + n > len(self._buf):
+            self._buf.extend(bytearray(max(len(self._buf), self._len + n - len(self._buf))))
+        self._buf[self._len:self._len + n] = data
+        self._len += n
+
+    #
+    #  memoryview of stored data
+    #
+    def view(self):
+        return memoryview(self._buf)[:self._len]
+
+#
+#  State of an audio stream
+#
+class StreamState:
+    """ Utility class to hold the voice activity detector and the segment
+    being accumulated for one audio stream."""
+    def __init__(self, stream_id, vad):
+        self.id = stream_id
+        self.vad = vad
+        self.audio = AudioBuffer()
+        self.capture_time = 0.0
+        self.truncated = False
+        self.upload = None
+
+#
+#  FLAC encoder (flac command)
+#
+class FlacEncoder:
+    """ Utility class to encode PCM data to FLAC while it arrives.
+    The data is piped to the flac command and its output is collected
+    by a reader thread."""
+    def __init__(self, rate=16000, channels=1, flac_bin='flac'):
+        self.content_type = 'audio/x-flac; rate=%d' % rate
+        cmdarg = [flac_bin, '--silent', '--force-raw-format', '--endian=little', '--sign=signed',
+                  '--bps=16', '--channels=%d' % channels, '--sample-rate=%d' % rate, '-o', '-', '-']
+        self._devnull = open(os.devnull, 'w')
+        self._proc = subprocess.Popen(cmdarg, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=self._devnull)
+        self._out = []
+        self._reader = threading.Thread(target=self.read)
+        self._reader.daemon = True
+        self._reader.start()
+
+    def read(self):
+        while True:
+            data = self._proc.stdout.read(4096)
+            if not data:
+                break
+            self._out.append(data)
+
+    def write(self, data):
+        self._proc.stdin.write(data)
+
+    #
+    #  end of input
+    #
+    def close(self):
+        if not self._proc.stdin.closed:
+            self._proc.stdin.close()
+
+    #
+    #  encoded data (None on failure)
+    #
+    def finish(self):
+        self.close()
+        self._reader.join()
+        self._devnull.close()
+        if self._proc.wait() != 0:
+            return None
+        return b''.join(self._out)
+
+    def cancel(self):
+        try:
+            self._proc.kill()
+        except OSError:
+            pass
+        self.finish()
+
+#
+#  IMA ADPCM encoder (audioop)
+#
+class AdpcmEncoder:
+    """ Utility class to encode PCM data to IMA ADPCM (4bit) while it arrives."""
+    def __init__(self, sample_width=2):
+        self.content_type = 'audio/x-adpcm'
+        self._sample_width = sample_width
+        self._state = None
+        self._out = bytearray()
+
+    def write(self, data):
+        (adpcm, self._state) = audioop.lin2adpcm(data, self._sample_width, self._state)
+        self._out.extend(adpcm)
+
+    def close(self):
+        pass
+
+    def finish(self):
+        return bytes(self._out)
+
+    def cancel(self):
+        pass
+
+#
+#  Segment encoded while it is accumulated
+#
+class EncodedSegment:
+    """ Utility class to feed a segment to an encoder frame by frame.
+    finish() requests recognition of the encoded data, or of the raw data
+    if the encoder has failed."""
+    def __init__(self, recog, encoder, audio):
+        self._recog = recog
+        self._encoder = encoder
+        self._audio = audio
+        self._size = 0
+        self._failed = False
+
+    def write(self, data):
+        if self._failed:
+            return
+        try:
+            self._encoder.write(data)
+            self._size += len(data)
+        except (IOError, OSError):
+            self._failed = True
+
+    def close(self):
+        self._encoder.close()
+
+    def cancel(self):
+        self._encoder.cancel()
+
+    def finish(self):
+        start = time.time()
+        data = None
+        if not self._failed:
+            data = self._encoder.finish()
+        if not data:
+            print ('CloudSpeech: encoding failed, sending raw data')
+            return self._recog.request_speech_recog(self._audio.view())
+        self._recog.count_encoded(self._size, len(data), time.time() - start)
+        return self._recog.request_speech_recog(data, self._encoder.content_type)
 
 #
 #  
@@ -32,9 +276,34 @@ class CloudSpeechRecogBase(threading.Thread):
         self._platform = platform.system()
         self._callbacks = []
 
-        self._buffer = []
-        self._audio = []
-        self.audio_segments = []
+        self._inputs = {}
+        self.audio_segments = collections.deque()
+        self._max_backlog = 8
+        self._backlog_policy = "drop_oldest"
+        self._dropped = 0
+        self._processed = 0
+        self._max_depth = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._concurrency = 1
+        self._timeout = 0
+        self._deadline = 0
+        self._seq = 0
+        self._nextseq = 0
+        self._results = {}
+        self._timeouts = 0
+        self._errors = 0
+        self._stale = 0
+        self._deliverlock = threading.Lock()
+        self._max_utterance = 0
+        self._utterance_policy = "split"
+        self._streaming = False
+        self._encoding = "pcm"
+        self._flac_bin = "flac"
+        self._encoded = 0
+        self._raw_bytes = 0
+        self._encoded_bytes = 0
+        self._encode_time = 0.0
 
         self._sample_width=2
         self._frame_rate=16000
@@ -43,6 +312,7 @@ class CloudSpeechRecogBase(threading.Thread):
         self._min_silence=200
         self._silence_thr=-10
         self._min_buflen=8000
+        self._frame_ms=20
 
         self._lang=language
         self._apikey = ''
@@ -51,41 +321,152 @@ class CloudSpeechRecogBase(threading.Thread):
 
         self._running = True
         self._lock = threading.RLock()
-        self._prebuf=[]
+        self._cond = threading.Condition(self._lock)
 
     #
     #   Write to audio data
+    #   (speech segments are detected frame by frame as data arrives;
+    #    each stream_id has its own detector and segment)
     #
-    def write(self, data):
+    def write(self, data, stream_id=None):
         try:
-            self._buffer.extend(data)
-            if len(self._buffer) > self._min_buflen:
-                audio=AudioSegment(self._buffer, sample_width=self._sample_width, channels=self._channels, frame_rate=self._frame_rate)
-                chunks=detect_nonsilent(audio, min_silence_len=self._min_silence, silence_thresh=self._silence_thr)
-
-                if chunks :
-                    if not self._audio :
-                        self._audio.extend(self._prebuf)
-                    self._audio.extend(self._buffer)
-                else:
-                    self._prebuf = self._buffer
-                    if self._audio :
-                        self._audio.extend(self._buffer)
-                        self._lock.acquire()
-                        self.audio_segments.append(self._audio)
-                        self._lock.release()
-
-                        if self._logger :
-                            self.save_to_wav(self.get_logfile_name(), self._audio)
-
-                        self._audio=[]
-                self._buffer = []
+            st = self.getinput(stream_id)
+            for (event, frame) in st.vad.process(data):
+                if st.truncated:
+                    # skip the rest of a truncated utterance
+                    if event == "end":
+                        st.truncated = False
+                    continue
+                if len(st.audio) == 0:
+                    # capture time of the first sample in the segment
+                    st.capture_time = time.time() - float(len(frame)) / (self._frame_rate * self._sample_width * self._channels)
+                    if self._streaming or self._encoding != "pcm":
+                        st.upload = self.open_stream(st.audio)
+                st.audio.extend(frame)
+                if st.upload is not None:
+                    st.upload.write(frame)
+                if event == "end":
+                    self.push_segment(st)
+                elif self._max_utterance > 0 and len(st.audio) >= self._max_utterance:
+                    self.push_segment(st)
+                    if self._utterance_policy == "truncate":
+                        st.truncated = True
 
         except:
             print (traceback.format_exc())
 
         return 0
 
+    #
+    #  state of an audio stream (created at the first data)
+    #
+    def getinput(self, stream_id):
+        with self._lock:
+            if stream_id not in self._inputs:
+                self._inputs[stream_id] = StreamState(stream_id, self.create_vad())
+            return self._inputs[stream_id]
+
+    #
+    #  ids of the audio streams
+    #
+    def getinputs(self):
+        with self._lock:
+            return list(self._inputs.keys())
+
+    #
+    #  hand off accumulated audio of a stream as a segment (memoryview)
+    #  (in streaming mode, the upload stream of the segment is closed)
+    #
+    def push_segment(self, st):
+        audio = st.audio.view()
+        st.audio = AudioBuffer()
+        stream = st.upload
+        st.upload = None
+        if stream is not None:
+            stream.close()
+        with self._cond:
+            while self._max_backlog > 0 and len(self.audio_segments) >= self._max_backlog and self._running:
+                if self._backlog_policy == "drop_newest":
+                    self._dropped += 1
+                    if stream is not None:
+                        stream.cancel()
+                    return
+                elif self._backlog_policy == "drop_oldest":
+                    item = self.audio_segments.popleft()
+                    self._results[item[0]] = (None, 0, item[5])
+                    if item[4] is not None:
+                        item[4].cancel()
+                    self._dropped += 1
+                else:
+                    self._cond.wait()
+            self.audio_segments.append((self._seq, time.time(), st.capture_time, audio, stream, st.id))
+            self._seq += 1
+            self._max_depth = max(self._max_depth, len(self.audio_segments))
+            self._cond.notify_all()
+
+        if self._logger :
+            self.save_to_wav(self.get_logfile_name(), audio)
+
+    #
+    #  create voice activity detector
+    #  (min_silence: hangover in ms, min_buflen: pre-roll in bytes)
+    #
+    def create_vad(self):
+        return EnergyVAD(self._frame_rate, self._sample_width, self._channels, self._frame_ms,
+                         self._silence_thr, self._min_silence, self._min_buflen)
+
+    #
+    #  Enable streaming mode
+    #  (audio is uploaded by open_stream() while the user is speaking)
+    #
+    def set_streaming(self, flag):
+        self._streaming = flag
+
+    #
+    #  Open upload stream at the start of speech
+    #  (audio is the AudioBuffer of the segment; returns an object with
+    #   write(data), close(), cancel() and finish() which returns the result,
+    #   or None to request the raw data)
+    #  The base class encodes the segment if an encoding is set.
+    #
+    def open_stream(self, audio):
+        encoder = self.create_encoder()
+        if encoder is None:
+            return None
+        return EncodedSegment(self, encoder, audio)
+
+    #
+    #  Set encoding of uploaded audio ("pcm", "flac" or "adpcm")
+    #
+    def set_encoding(self, encoding):
+        self._encoding = encoding
+
+    #
+    #  encoder for a new segment (None: raw PCM)
+    #
+    def create_encoder(self):
+        try:
+            if self._encoding == "flac":
+                return FlacEncoder(self._frame_rate, self._channels, self._flac_bin)
+            if self._encoding == "adpcm" and audioop is not None:
+                return AdpcmEncoder(self._sample_width)
+        except OSError:
+            pass
+        if self._encoding != "pcm":
+            print ('CloudSpeech: %s encoder is not available' % self._encoding)
+        return None
+
+    #
+    #  count an encoded segment
+    #
+    def count_encoded(self, raw, encoded, elapsed):
+        print ('CloudSpeech: encoded %d -> %d bytes (ratio %.2f) in %.1fms' % (raw, encoded, float(raw) / encoded, elapsed * 1000))
+        with self._cond:
+            self._encoded += 1
+            self._raw_bytes += raw
+            self._encoded_bytes += encoded
+            self._encode_time += elapsed
+
     #
     #  Set Lang
     #  (ja-JP, en-US, en-GB, en-AU, de-DE, ....)
@@ -96,13 +477,73 @@ class CloudSpeechRecogBase(threading.Thread):
     #
     #
     #
-    def set_voice_detect_param(self, mval, thr, buflen):
+    def set_voice_detect_param(self, mval, thr, buflen, frame_ms=20):
         self._min_silence = mval
         self._silence_thr=thr
         self._min_buflen=buflen
+        self._frame_ms=frame_ms
+        with self._lock:
+            inputs = list(self._inputs.values())
+            self._inputs = {}
+        for st in inputs:
+            if st.upload is not None:
+                st.upload.cancel()
 
     #
-    #  Set callback function
+    #  Set maximum utterance length in ms (0: unlimited)
+    #  (policy: "split" continues in a new segment, "truncate" drops the rest)
+    #
+    def set_max_utterance(self, msec, policy="split"):
+        frames = int(self._frame_rate * msec / 1000)
+        self._max_utterance = frames * self._sample_width * self._channels
+        self._utterance_policy = policy
+
+    #
+    #  Set size of the segment backlog (0: unlimited) and the policy when it is full
+    #  (block, drop_oldest or drop_newest)
+    #
+    def set_backlog(self, size, policy="drop_oldest"):
+        with self._cond:
+            self._max_backlog = size
+            self._backlog_policy = policy
+            self._cond.notify_all()
+
+    #
+    #  Set number of concurrent requests, timeout of a request (sec, 0: no limit)
+    #  and deadline after capture to drop stale results (sec, 0: no limit)
+    #
+    def set_request_param(self, concurrency, timeout=0, deadline=0):
+        self._concurrency = max(1, concurrency)
+        self._timeout = timeout
+        self._deadline = deadline
+
+    #
+    #  Metrics of the segment queue
+    #  (streams, depth, max_depth, dropped, processed, wait_avg and wait_max in seconds,
+    #   timeouts, errors: failed requests, stale)
+    #  and of the encoding (encoded, encode_ratio, encode_time: average seconds
+    #  spent at the end of speech)
+    #
+    def getstats(self):
+        with self._cond:
+            wait_avg = 0.0
+            if self._processed > 0:
+                wait_avg = self._wait_total / self._processed
+            encode_ratio = 0.0
+            encode_time = 0.0
+            if self._encoded > 0:
+                encode_ratio = float(self._raw_bytes) / self._encoded_bytes
+                encode_time = self._encode_time / self._encoded
+            return {'streams': len(self._inputs),
+                    'depth': len(self.audio_segments), 'max_depth': self._max_depth,
+                    'dropped': self._dropped, 'processed': self._processed,
+                    'wait_avg': wait_avg, 'wait_max': self._wait_max,
+                    'timeouts': self._timeouts, 'errors': self._errors, 'stale': self._stale,
+                    'encoded': self._encoded, 'encode_ratio': encode_ratio, 'encode_time': encode_time}
+
+    #
+    #  Set callback function: func(result, capture_time, stream_id)
+    #  (called in the order of utterances)
     #
     def setcallback(self, func):
         self._callbacks.append(func)
@@ -123,42 +564,290 @@ class CloudSpeechRecogBase(threading.Thread):
         wave_data.setframerate(self._frame_rate)
         
         wave_data.setnframes(int(len(data) / (self._sample_width * self._channels)))
-        wave_data.writeframesraw(bytearray(data))
+        wave_data.writeframesraw(data)
         wave_data.close()
 
     #
     #  Request Google Voice Recognition
+    #  (content_type is given for encoded data)
     #
-    def request_speech_recog(self, data):
+    def request_speech_recog(self, data, content_type=None):
         return 0
 
+    #
+    #  Hypotheses in a result: [(text, score), ...] (None if recognition failed)
+    #
+    def hypotheses(self, res):
+        return None
+
     #
     #  Terminate (Call on Finished)
     #
     def terminate(self):
         print ('CloudSpeech: terminate')
-        self._running = False
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
         return 0
 
     #
-    #  Run
+    #  Run (start workers for concurrent requests)
     #
     def run(self):
-        while self._running:
-            audio =[]
-            self._lock.acquire()
-            if len(self.audio_segments) :
-                audio = self.audio_segments.pop(0)
-            self._lock.release()
-
-            if audio :
-                res = self.request_speech_recog(audio)
-                if res :
-                    for c in self._callbacks:
-                        c(res)
-                else:
-                    #print ("----")
-                    pass
+        workers = []
+        for i in range(self._concurrency - 1):
+            th = threading.Thread(target=self.work)
+            th.daemon = True
+            th.start()
+            workers.append(th)
+        self.work()
+        for th in workers:
+            th.join()
 
         print ('CloudSpeech: exit from event loop')
 
+    #
+    #  Worker (wait for segments)
+    #
+    def work(self):
+        while True:
+            with self._cond:
+                while self._running and not self.audio_segments:
+                    self._cond.wait()
+                if not self._running:
+                    break
+                (seq, tm, capture, audio, stream, stream_id) = self.audio_segments.popleft()
+                wait = time.time() - tm
+                self._processed += 1
+                self._wait_total += wait
+                self._wait_max = max(self._wait_max, wait)
+                self._cond.notify_all()
+
+            #
+            # the seq is always delivered, so that the later results are not
+            # held back by a failed request
+            res = None
+            try:
+                if self.is_stale(capture):
+                    self._stale += 1
+                    if stream is not None:
+                        stream.cancel()
+                elif stream is not None:
+                    res = self.request_with_timeout(stream.finish, stream.cancel)
+                else:
+                    res = self.request_with_timeout(lambda: self.request_speech_recog(audio))
+            except:
+                self._errors += 1
+                print ("[error] CloudSpeech: request failed")
+                print (traceback.format_exc())
+            finally:
+                self.deliver(seq, res, capture, stream_id)
+
+    #
+    #  older than deadline or not
+    #
+    def is_stale(self, capture):
+        return self._deadline > 0 and time.time() - capture > self._deadline
+
+    #
+    #  request with timeout (the request is abandoned on timeout)
+    #
+    def request_with_timeout(self, func, cancel=None):
+        if self._timeout <= 0:
+            return func()
+        result = []
+        def request():
+            try:
+                result.append(func())
+            except:
+                print (traceback.format_exc())
+        th = threading.Thread(target=request)
+        th.daemon = True
+        th.start()
+        th.join(self._timeout)
+        if th.is_alive():
+            self._timeouts += 1
+            if cancel is not None:
+                cancel()
+            print ('CloudSpeech: request timed out')
+            return None
+        if result:
+            return result[0]
+        return None
+
+    #
+    #  deliver results to callbacks in the order of segments
+    #
+    def deliver(self, seq, res, capture, stream_id=None):
+        with self._deliverlock:
+            ready = []
+            with self._cond:
+                self._results[seq] = (res, capture, stream_id)
+                while self._nextseq in self._results:
+                    ready.append(self._results.pop(self._nextseq))
+                    self._nextseq += 1
+            for (res, capture, stream_id) in ready:
+                if not res:
+                    continue
+                if self.is_stale(capture):
+                    self._stale += 1
+                    continue
+                for c in self._callbacks:
+                    c(res, capture, stream_id)
+
+
+#
+#  Hedged requests to several backends
+#
+class HedgedSpeechRecog(CloudSpeechRecogBase):
+    """ Recognizer which sends each segment to the primary backend and, if
+    no answer arrives within the hedge delay, also to the next one.
+    The first good result wins and the requests of the other backends are
+    cancelled: their HTTP requests (httpclient) in flight are aborted and
+    later ones fail at once.
+    backends is a list of (name, backend); a backend has
+    request_speech_recog(data) and hypotheses(result).
+    The hedge delay is the p95 latency of the primary backend if delay is 0."""
+    #
+    #  Constructor
+    #
+    def __init__(self, backends, delay=0, language='ja-JP'):
+        CloudSpeechRecogBase.__init__(self, language)
+        self._backends = backends
+        self._delay = delay
+        self._default_delay = 1.0
+        self._latencies = [collections.deque(maxlen=200) for b in backends]
+        self._backend_stats = [{'requests': 0, 'hedged': 0, 'wins': 0, 'failures': 0, 'cancelled': 0} for b in backends]
+
+    #
+    #  encoded or streaming uploads are not hedged
+    #
+    def open_stream(self, audio):
+        return None
+
+    #
+    #  hedge delay in seconds
+    #
+    def hedge_delay(self):
+        if self._delay > 0:
+            return self._delay
+        with self._cond:
+            lat = sorted(self._latencies[0])
+        if len(lat) < 10:
+            return self._default_delay
+        return lat[int(len(lat) * 0.95)]
+
+    #
+    #  request to a backend (the result is good if it has hypotheses)
+    #
+    def request_backend(self, i, data, cond, results, token):
+        start = time.time()
+        res = None
+        good = False
+        httpclient.setcancel(token)
+        try:
+            res = self._backends[i][1].request_speech_recog(data)
+            good = bool(self._backends[i][1].hypotheses(res))
+        except:
+            if not token.cancelled:
+                print (traceback.format_exc())
+        finally:
+            httpclient.setcancel(None)
+        with self._cond:
+            if token.cancelled:
+                self._backend_stats[i]['cancelled'] += 1
+            elif good:
+                self._latencies[i].append(time.time() - start)
+            else:
+                self._backend_stats[i]['failures'] += 1
+        with cond:
+            results.append((i, res, good))
+            cond.notify()
+
+    #
+    #  Request to the backends in turn (returns (index of backend, result))
+    #
+    def request_speech_recog(self, data, content_type=None):
+        cond = threading.Condition()
+        results = []
+        tokens = []
+        delay = self.hedge_delay()
+        launched = 0
+        deadline = 0
+        with cond:
+            while True:
+                for r in results:
+                    if r[2]:
+                        with self._cond:
+                            self._backend_stats[r[0]]['wins'] += 1
+                        # cancel the losers
+                        for (i, token) in enumerate(tokens):
+                            if i not in [x[0] for x in results]:
+                                token.cancel()
+                        return (r[0], r[1])
+                now = time.time()
+                failed = (len(results) == launched)
+                if launched < len(self._backends) and (failed or now >= deadline):
+                    # start the next backend (hedge, or failover if all have failed)
+                    with self._cond:
+                        self._backend_stats[launched]['requests'] += 1
+                        if launched > 0 and not failed:
+                            self._backend_stats[launched]['hedged'] += 1
+                    tokens.append(httpclient.CancelToken())
+                    th = threading.Thread(target=self.request_backend, args=(launched, data, cond, results, tokens[-1]))
+                    th.daemon = True
+                    th.start()
+                    launched += 1
+                    deadline = now + delay
+                elif failed:
+                    break
+                elif launched < len(self._backends):
+                    cond.wait(deadline - now)
+                else:
+                    cond.wait()
+        if results:
+            return (results[0][0], results[0][1])
+        return None
+
+    def hypotheses(self, res):
+        if not res:
+            return None
+        return self._backends[res[0]][1].hypotheses(res[1])
+
+    #
+    #  Metrics of the backends: {name: {requests, hedged, wins, failures, cancelled, latency_avg, latency_p95}}
+    #
+    def getbackendstats(self):
+        stats = {}
+        with self._cond:
+            for (i, (name, backend)) in enumerate(self._backends):
+                s = dict(self._backend_stats[i])
+                lat = sorted(self._latencies[i])
+                s['latency_avg'] = 0.0
+                s['latency_p95'] = 0.0
+                if lat:
+                    s['latency_avg'] = sum(lat) / len(lat)
+                    s['latency_p95'] = lat[int(len(lat) * 0.95)]
+                stats[name] = s
+        return stats
+
+    #
+    #  one line summary of the backends
+    #
+    def summary(self):
+        lines = []
+        stats = self.getbackendstats()
+        for (name, backend) in self._backends:
+            s = stats[name]
+            lines.append('%s: requests %d (hedged %d), wins %d, failures %d, cancelled %d, latency %.3fs (p95 %.3fs)' %
+                         (name, s['requests'], s['hedged'], s['wins'], s['failures'], s['cancelled'], s['latency_avg'], s['latency_p95']))
+        return '; '.join(lines)
+
+    #
+    #  Terminate (and the backends)
+    #
+    def terminate(self):
+        for (name, backend) in self._backends:
+            if isinstance(backend, CloudSpeechRecogBase):
+                backend.terminate()
+        return CloudSpeechRecogBase.terminate(self)
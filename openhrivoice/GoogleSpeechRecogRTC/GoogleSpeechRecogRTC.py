@@ -18,11 +18,7 @@ import time, struct, traceback, getopt, wave, tempfile
 import optparse
 
 import json
-import urllib
-import urllib.request, urllib.error
-
-from pydub import AudioSegment
-from pydub.silence import *
+import httpclient
 
 from xml.dom.minidom import Document
 
@@ -31,7 +27,8 @@ import RTC
 from __init__ import __version__
 import utils
 
-from CloudSpeechRecogBase import CloudSpeechRecogBase
+from CloudSpeechRecogBase import CloudSpeechRecogBase, HedgedSpeechRecog
+from julius_cli import JuliusCli
 
 __doc__ = 'Google Speech Recognition component.'
 
@@ -62,6 +59,11 @@ class GoogleSpeechRecogWrap(CloudSpeechRecogBase):
             if prop.getProperty("google.speech.save_wav") == 'YES':
                 self._logger = True
 
+        self._http = httpclient.fromproperties(prop)
+
+        if prop.getProperty("google.speech.flac") :
+            self._flac_bin=prop.getProperty("google.speech.flac")
+
 
     #
     #  Set ApiKey
@@ -72,17 +74,17 @@ class GoogleSpeechRecogWrap(CloudSpeechRecogBase):
 
     #
     #  Request Google Voice Recognition
+    #  (content_type is given for encoded data)
     #
-    def request_speech_recog(self, data):
+    def request_speech_recog(self, data, content_type=None):
         query_string = {'output': 'json', 'lang': self._lang, 'key': self._apikey}
-        url = '{0}?{1}'.format(self._endpoint, urllib.urlencode(query_string)) 
+        url = '{0}?{1}'.format(self._endpoint, httpclient.urlencode(query_string)) 
 
-        headers = {'Content-Type': 'audio/l16; rate=16000'}
-        voice_data = str(bytearray(data))
+        headers = {'Content-Type': content_type or 'audio/l16; rate=16000'}
+        voice_data = data
 
         try:
-            request = urllib.request.Request(url, data=voice_data, headers=headers)
-            result = urllib.urlopen(request)
+            result = self._http.request('POST', url, voice_data, headers)
             response = result.read()
             return response.decode('utf-8').split()
         except:
@@ -90,6 +92,16 @@ class GoogleSpeechRecogWrap(CloudSpeechRecogBase):
             print (traceback.format_exc())
             return ["Error"]
 
+    #
+    #  Hypotheses in a result: [(text, score), ...] (None if recognition failed)
+    #  (the first line of the result is an empty result)
+    #
+    def hypotheses(self, res):
+        if len(res) <= 1:
+            return None
+        result = json.loads(''.join(res[1:]))
+        return [(r['transcript'], r.get('confidence', 0.0)) for r in result['result'][0]['alternative']]
+
 
 #
 #  GoogleSpeechRecogRTC 
@@ -121,6 +133,53 @@ GoogleSpeechRecogRTC_spec = ["implementation_id", "GoogleSpeechRecogRTC",
 		  "conf.__widget__.silence_thr", "text",
                   "conf.__type__.silence_thr", "int",
 
+		  "conf.default.vad_frame", "20",
+		  "conf.__widget__.vad_frame", "text",
+                  "conf.__type__.vad_frame", "int",
+
+		  "conf.default.max_utterance", "0",
+		  "conf.__widget__.max_utterance", "text",
+		  "conf.__type__.max_utterance", "int",
+
+		  "conf.default.utterance_policy", "split",
+		  "conf.__widget__.utterance_policy", "radio",
+		  "conf.__constraints__.utterance_policy", "(split, truncate)",
+		  "conf.__type__.utterance_policy", "string",
+
+		  "conf.default.max_backlog", "8",
+		  "conf.__widget__.max_backlog", "text",
+		  "conf.__type__.max_backlog", "int",
+
+		  "conf.default.backlog_policy", "drop_oldest",
+		  "conf.__widget__.backlog_policy", "radio",
+		  "conf.__constraints__.backlog_policy", "(block, drop_oldest, drop_newest)",
+		  "conf.__type__.backlog_policy", "string",
+
+		  "conf.default.concurrency", "2",
+		  "conf.__widget__.concurrency", "text",
+		  "conf.__type__.concurrency", "int",
+
+		  "conf.default.request_timeout", "30",
+		  "conf.__widget__.request_timeout", "text",
+		  "conf.__type__.request_timeout", "float",
+
+		  "conf.default.result_deadline", "0",
+		  "conf.__widget__.result_deadline", "text",
+		  "conf.__type__.result_deadline", "float",
+
+		  "conf.default.encoding", "pcm",
+		  "conf.__widget__.encoding", "radio",
+		  "conf.__constraints__.encoding", "(pcm, flac)",
+		  "conf.__type__.encoding", "string",
+
+		  "conf.default.hedge_server", "",
+		  "conf.__widget__.hedge_server", "text",
+		  "conf.__type__.hedge_server", "string",
+
+		  "conf.default.hedge_delay", "0",
+		  "conf.__widget__.hedge_delay", "text",
+		  "conf.__type__.hedge_delay", "float",
+
                   ""]
 #
 #  DataListener class
@@ -151,11 +210,23 @@ class GoogleSpeechRecogRTC(OpenRTM_aist.DataFlowComponentBase):
     def __init__(self, manager):
         OpenRTM_aist.DataFlowComponentBase.__init__(self, manager)
         self._recog = None
+        self._backend = None
         self._copyrights=[]
         self._lang = [ "ja-JP" ]
         self._min_silence = [ 200 ]
         self._silence_thr = [ -20 ]
         self._min_buflen =  [ 8000 ]
+        self._vad_frame = [ 20 ]
+        self._max_utterance = [ 0 ]
+        self._utterance_policy = [ "split" ]
+        self._max_backlog = [ 8 ]
+        self._backlog_policy = [ "drop_oldest" ]
+        self._concurrency = [ 2 ]
+        self._request_timeout = [ 30.0 ]
+        self._result_deadline = [ 0.0 ]
+        self._encoding = [ "pcm" ]
+        self._hedge_server = [ "" ]
+        self._hedge_delay = [ 0.0 ]
 
 
     #
@@ -172,14 +243,33 @@ class GoogleSpeechRecogRTC(OpenRTM_aist.DataFlowComponentBase):
         self.bindParameter("min_silence", self._min_silence, "200")
         self.bindParameter("silence_thr", self._silence_thr, "-20")
         self.bindParameter("min_buflen", self._min_buflen, "8000")
+        self.bindParameter("vad_frame", self._vad_frame, "20")
+        self.bindParameter("max_utterance", self._max_utterance, "0")
+        self.bindParameter("utterance_policy", self._utterance_policy, "split")
+        self.bindParameter("max_backlog", self._max_backlog, "8")
+        self.bindParameter("backlog_policy", self._backlog_policy, "drop_oldest")
+        self.bindParameter("concurrency", self._concurrency, "2")
+        self.bindParameter("request_timeout", self._request_timeout, "30")
+        self.bindParameter("result_deadline", self._result_deadline, "0")
+        self.bindParameter("encoding", self._encoding, "pcm")
+        self.bindParameter("hedge_server", self._hedge_server, "")
+        self.bindParameter("hedge_delay", self._hedge_delay, "0")
         #
-        # create inport for audio stream
-        self._indata = RTC.TimedOctetSeq(RTC.Time(0,0), None)
-        self._inport = OpenRTM_aist.InPort("data", self._indata)
-        self._inport.appendProperty('description', 'Audio data (in packets) to be recognized.')
-        self._inport.addConnectorDataListener(OpenRTM_aist.ConnectorDataListenerType.ON_BUFFER_WRITE,
-                                              DataListener("data", self, RTC.TimedOctetSeq))
-        self.registerInPort(self._inport._name, self._inport)
+        # create inports for audio streams
+        # (google.speech.streams: comma separated stream ids, one inport is created for
+        #  each id and the results are tagged with it; "data" by default)
+        self._streams = []
+        if self._properties.getProperty("google.speech.streams") :
+            self._streams = [s.strip() for s in self._properties.getProperty("google.speech.streams").split(',') if s.strip()]
+        self._inports = {}
+        for name in (self._streams or ["data"]):
+            indata = RTC.TimedOctetSeq(RTC.Time(0,0), None)
+            inport = OpenRTM_aist.InPort(name, indata)
+            inport.appendProperty('description', 'Audio data (in packets) to be recognized.')
+            inport.addConnectorDataListener(OpenRTM_aist.ConnectorDataListenerType.ON_BUFFER_WRITE,
+                                            DataListener(name, self, RTC.TimedOctetSeq))
+            self.registerInPort(inport._name, inport)
+            self._inports[name] = (inport, indata)
 
         #
         # create outport for result
@@ -210,14 +300,25 @@ class GoogleSpeechRecogRTC(OpenRTM_aist.DataFlowComponentBase):
     #  OnActivate
     #
     def onActivated(self, ec_id):
-        self._recog = GoogleSpeechRecogWrap(self, self._lang[0])
+        self._backend = GoogleSpeechRecogWrap(self, self._lang[0])
+        if self._hedge_server[0]:
+            # local Julius server as the secondary backend
+            (host, port) = self._hedge_server[0].split(':')
+            julius = JuliusCli(host, int(port), self._backend._http)
+            self._recog = HedgedSpeechRecog([("google", self._backend), ("julius", julius)], float(self._hedge_delay[0]), self._lang[0])
+        else:
+            self._recog = self._backend
         self._recog.setcallback(self.onResult)
 
         OpenRTM_aist.DataFlowComponentBase.onActivated(self, ec_id)
         #self._recog.set_lang(self._lang[0])
-        self._recog.set_voice_detect_param(int(self._min_silence[0]),  int(self._silence_thr[0]), int(self._min_buflen[0]))
+        self._recog.set_voice_detect_param(int(self._min_silence[0]),  int(self._silence_thr[0]), int(self._min_buflen[0]), int(self._vad_frame[0]))
+        self._recog.set_max_utterance(int(self._max_utterance[0]), self._utterance_policy[0])
+        self._recog.set_backlog(int(self._max_backlog[0]), self._backlog_policy[0])
+        self._recog.set_request_param(int(self._concurrency[0]), float(self._request_timeout[0]), float(self._result_deadline[0]))
+        self._recog.set_encoding(self._encoding[0])
 
-        if self._recog._apikey:
+        if self._backend._apikey:
             self._recog.start()
             return RTC.RTC_OK
         else:
@@ -226,9 +327,9 @@ class GoogleSpeechRecogRTC(OpenRTM_aist.DataFlowComponentBase):
     #
     #  OnDeactivate
     #
-    def onDeactivate(self, ec_id):
+    def onDeactivated(self, ec_id):
         self._recog.terminate()
-        OpenRTM_aist.DataFlowComponentBase.onDeactivate(self, ec_id)
+        OpenRTM_aist.DataFlowComponentBase.onDeactivated(self, ec_id)
         return RTC.RTC_OK
 
     #
@@ -236,8 +337,8 @@ class GoogleSpeechRecogRTC(OpenRTM_aist.DataFlowComponentBase):
     #
     def onData(self, name, data):
         if self._recog:
-            if name == "data":
-                self._recog.write(data.data)
+            if name in self._inports:
+                self._recog.write(data.data, name)
 
 
     #
@@ -250,28 +351,27 @@ class GoogleSpeechRecogRTC(OpenRTM_aist.DataFlowComponentBase):
     #
     #  OnResult
     #
-    def onResult(self, data):
+    def onResult(self, data, capture_time=None, stream_id=None):
         doc = Document()
         listentext = doc.createElement("listenText")
         doc.appendChild(listentext)
+        if self._streams:
+            listentext.setAttribute("stream", stream_id)
 
-        if len(data) <= 1:
-            listentext.setAttribute("state","RecognitionFailed")
+        try:
+            hypos = self._recog.hypotheses(data)
+        except:
+            print (traceback.format_exc())
+            listentext.setAttribute("state","ParseError")
         else:
-            try:
-                data.pop(0)
-                res = ''.join(data)
-                #print res;
-                result=json.loads(res)
+            if not hypos:
+                listentext.setAttribute("state","RecognitionFailed")
+            else:
                 i=0
-                for r in result['result'][0]['alternative']:
+                for (text, score) in hypos:
                     i += 1
                     rank = str(i)
-                    if 'confidence' in r :
-                        score=str(r['confidence'])
-                    else:
-                        score=0.0
-                    text=r['transcript']
+                    score = str(score)
                     hypo = doc.createElement("data")
                     hypo.setAttribute("rank", rank)
                     hypo.setAttribute("score", score)
@@ -282,12 +382,19 @@ class GoogleSpeechRecogRTC(OpenRTM_aist.DataFlowComponentBase):
 
                 listentext.setAttribute("state","Success")
 
-            except:
-                print (traceback.format_exc())
-                listentext.setAttribute("state","ParseError")
+        self._logger.RTC_INFO("queue: streams %(streams)d, depth %(depth)d (max %(max_depth)d), dropped %(dropped)d, wait %(wait_avg).3fs (max %(wait_max).3fs), timeouts %(timeouts)d, stale %(stale)d" % self._recog.getstats())
+        self._logger.RTC_INFO("http: " + self._backend._http.summary())
+        if self._recog is not self._backend:
+            self._logger.RTC_INFO("hedge: " + self._recog.summary())
+        stats = self._recog.getstats()
+        if stats['encoded'] > 0:
+            self._logger.RTC_INFO("encoding: %(encoded)d segments, ratio %(encode_ratio).2f, %(encode_time).4fs at end of speech" % stats)
 
         res_data = doc.toxml(encoding="utf-8")
         self._outdata.data = res_data
+        if capture_time:
+            # time stamp of the recognized speech
+            self._outdata.tm = RTC.Time(int(capture_time), int((capture_time - int(capture_time)) * 1000000000))
         self._outport.write()
 
 #
@@ -19,15 +19,13 @@ import optparse
 
 import json
 
-from pydub import AudioSegment
-from pydub.silence import *
-
 from xml.dom.minidom import Document
 
 import OpenRTM_aist
 import RTC
 from __init__ import __version__
 import utils
+import httpclient
 
 from CloudSpeechRecogBase import CloudSpeechRecogBase
 from julius_cli import JuliusCli
@@ -58,17 +56,19 @@ class JuliusCliWrap(CloudSpeechRecogBase):
         #if prop.getProperty("julius.port") :
         #    self._julius_port=prop.getProperty("julius.port")
 
-        self._julius = JuliusCli(self._julius_host, self._julius_port)
+        self._http = httpclient.fromproperties(rtc._properties)
+        self._julius = JuliusCli(self._julius_host, self._julius_port, self._http)
     #
     #  Request Recaius Voice Recognition
     #
-    def request_speech_recog(self, data):
-       result = self._julius.request_asr(str(bytearray(data)))
-       if result :
-         res = json.loads(''.join(result))
-       else:
-         res = []
-       return res
+    def request_speech_recog(self, data, content_type=None):
+       return self._julius.request_speech_recog(data)
+
+    #
+    #  Hypotheses in a result
+    #
+    def hypotheses(self, res):
+       return self._julius.hypotheses(res)
        
 
 #
@@ -109,6 +109,40 @@ JuliusCliRTC_spec = ["implementation_id", "JuliusCliRTC",
                   "conf.__widget__.silence_thr", "text",
                   "conf.__type__.silence_thr", "int",
 
+                  "conf.default.vad_frame", "20",
+                  "conf.__widget__.vad_frame", "text",
+                  "conf.__type__.vad_frame", "int",
+
+                  "conf.default.max_utterance", "0",
+                  "conf.__widget__.max_utterance", "text",
+                  "conf.__type__.max_utterance", "int",
+
+                  "conf.default.utterance_policy", "split",
+                  "conf.__widget__.utterance_policy", "radio",
+                  "conf.__constraints__.utterance_policy", "(split, truncate)",
+                  "conf.__type__.utterance_policy", "string",
+
+                  "conf.default.max_backlog", "8",
+                  "conf.__widget__.max_backlog", "text",
+                  "conf.__type__.max_backlog", "int",
+
+                  "conf.default.backlog_policy", "drop_oldest",
+                  "conf.__widget__.backlog_policy", "radio",
+                  "conf.__constraints__.backlog_policy", "(block, drop_oldest, drop_newest)",
+                  "conf.__type__.backlog_policy", "string",
+
+                  "conf.default.concurrency", "2",
+                  "conf.__widget__.concurrency", "text",
+                  "conf.__type__.concurrency", "int",
+
+                  "conf.default.request_timeout", "30",
+                  "conf.__widget__.request_timeout", "text",
+                  "conf.__type__.request_timeout", "float",
+
+                  "conf.default.result_deadline", "0",
+                  "conf.__widget__.result_deadline", "text",
+                  "conf.__type__.result_deadline", "float",
+
                   ""]
 #
 #  DataListener class
@@ -146,6 +180,14 @@ class JuliusCliRTC(OpenRTM_aist.DataFlowComponentBase):
         self._min_silence = [ 200 ]
         self._silence_thr = [ -20 ]
         self._min_buflen =  [ 8000 ]
+        self._vad_frame = [ 20 ]
+        self._max_utterance = [ 0 ]
+        self._utterance_policy = [ "split" ]
+        self._max_backlog = [ 8 ]
+        self._backlog_policy = [ "drop_oldest" ]
+        self._concurrency = [ 2 ]
+        self._request_timeout = [ 30.0 ]
+        self._result_deadline = [ 0.0 ]
 
 
     #
@@ -164,14 +206,30 @@ class JuliusCliRTC(OpenRTM_aist.DataFlowComponentBase):
 	self.bindParameter("min_silence", self._min_silence, "200")
 	self.bindParameter("silence_thr", self._silence_thr, "-20")
 	self.bindParameter("min_buflen", self._min_buflen, "8000")
+	self.bindParameter("vad_frame", self._vad_frame, "20")
+	self.bindParameter("max_utterance", self._max_utterance, "0")
+	self.bindParameter("utterance_policy", self._utterance_policy, "split")
+	self.bindParameter("max_backlog", self._max_backlog, "8")
+	self.bindParameter("backlog_policy", self._backlog_policy, "drop_oldest")
+	self.bindParameter("concurrency", self._concurrency, "2")
+	self.bindParameter("request_timeout", self._request_timeout, "30")
+	self.bindParameter("result_deadline", self._result_deadline, "0")
         #
-        # create inport for audio stream
-        self._indata = RTC.TimedOctetSeq(RTC.Time(0,0), None)
-        self._inport = OpenRTM_aist.InPort("data", self._indata)
-        self._inport.appendProperty('description', _('Audio data (in packets) to be recognized.').encode('UTF-8'))
-        self._inport.addConnectorDataListener(OpenRTM_aist.ConnectorDataListenerType.ON_BUFFER_WRITE,
-                                              DataListener("data", self, RTC.TimedOctetSeq))
-        self.registerInPort(self._inport._name, self._inport)
+        # create inports for audio streams
+        # (julius.cli.streams: comma separated stream ids, one inport is created for
+        #  each id and the results are tagged with it; "data" by default)
+        self._streams = []
+        if self._properties.getProperty("julius.cli.streams") :
+            self._streams = [s.strip() for s in self._properties.getProperty("julius.cli.streams").split(',') if s.strip()]
+        self._inports = {}
+        for name in (self._streams or ["data"]):
+            indata = RTC.TimedOctetSeq(RTC.Time(0,0), None)
+            inport = OpenRTM_aist.InPort(name, indata)
+            inport.appendProperty('description', _('Audio data (in packets) to be recognized.').encode('UTF-8'))
+            inport.addConnectorDataListener(OpenRTM_aist.ConnectorDataListenerType.ON_BUFFER_WRITE,
+                                            DataListener(name, self, RTC.TimedOctetSeq))
+            self.registerInPort(inport._name, inport)
+            self._inports[name] = (inport, indata)
 
         #
         # create outport for result
@@ -206,7 +264,10 @@ class JuliusCliRTC(OpenRTM_aist.DataFlowComponentBase):
         self._recog.setcallback(self.onResult)
 
         OpenRTM_aist.DataFlowComponentBase.onActivated(self, ec_id)
-        self._recog.set_voice_detect_param(int(self._min_silence[0]),  int(self._silence_thr[0]), int(self._min_buflen[0]))
+        self._recog.set_voice_detect_param(int(self._min_silence[0]),  int(self._silence_thr[0]), int(self._min_buflen[0]), int(self._vad_frame[0]))
+        self._recog.set_max_utterance(int(self._max_utterance[0]), self._utterance_policy[0])
+        self._recog.set_backlog(int(self._max_backlog[0]), self._backlog_policy[0])
+        self._recog.set_request_param(int(self._concurrency[0]), float(self._request_timeout[0]), float(self._result_deadline[0]))
 
         #if self._recog._token:
         #    self._recog.start()
@@ -220,10 +281,10 @@ class JuliusCliRTC(OpenRTM_aist.DataFlowComponentBase):
     #
     #  OnDeactivate
     #
-    def onDeactivate(self, ec_id):
+    def onDeactivated(self, ec_id):
         self._recog.terminate()
         #self._recog._recaius.endVoiceRecogSession()
-        OpenRTM_aist.DataFlowComponentBase.onDeactivate(self, ec_id)
+        OpenRTM_aist.DataFlowComponentBase.onDeactivated(self, ec_id)
         return RTC.RTC_OK
 
     #
@@ -231,8 +292,8 @@ class JuliusCliRTC(OpenRTM_aist.DataFlowComponentBase):
     #
     def onData(self, name, data):
         if self._recog:
-            if name == "data":
-                self._recog.write(data.data)
+            if name in self._inports:
+                self._recog.write(data.data, name)
 
 
     #
@@ -245,24 +306,27 @@ class JuliusCliRTC(OpenRTM_aist.DataFlowComponentBase):
     #
     #  OnResult
     #
-    def onResult(self, data):
+    def onResult(self, data, capture_time=None, stream_id=None):
         doc = Document()
         listentext = doc.createElement("listenText")
         doc.appendChild(listentext)
+        if self._streams:
+            listentext.setAttribute("stream", stream_id)
 
-        if len(data) <= 1:
-            listentext.setAttribute("state","RecognitionFailed")
+        try:
+            hypos = self._recog.hypotheses(data)
+        except:
+            print (traceback.format_exc())
+            listentext.setAttribute("state","ParseError")
         else:
-            try:
+            if not hypos:
+                listentext.setAttribute("state","RecognitionFailed")
+            else:
                 i=0
-                for r in data['result']:
+                for (text, score) in hypos:
                     i += 1
                     rank = str(i)
-                    if 'confidence' in r :
-                        score=str(r['confidence'])
-                    else:
-                        score=0.0
-                    text=r['str']
+                    score = str(score)
                     hypo = doc.createElement("data")
                     hypo.setAttribute("rank", rank)
                     hypo.setAttribute("score", score)
@@ -273,12 +337,14 @@ class JuliusCliRTC(OpenRTM_aist.DataFlowComponentBase):
 
                 listentext.setAttribute("state","Success")
 
-            except:
-                print (traceback.format_exc())
-                listentext.setAttribute("state","ParseError")
+        self._logger.RTC_INFO("queue: streams %(streams)d, depth %(depth)d (max %(max_depth)d), dropped %(dropped)d, wait %(wait_avg).3fs (max %(wait_max).3fs), timeouts %(timeouts)d, stale %(stale)d" % self._recog.getstats())
+        self._logger.RTC_INFO("http: " + self._recog._http.summary())
 
         res_data = doc.toxml(encoding="utf-8")
         self._outdata.data = res_data
+        if capture_time:
+            # time stamp of the recognized speech
+            self._outdata.tm = RTC.Time(int(capture_time), int((capture_time - int(capture_time)) * 1000000000))
         self._outport.write()
 
 #
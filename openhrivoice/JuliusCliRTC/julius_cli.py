@@ -6,8 +6,7 @@ import time, struct, traceback, locale, codecs, getopt, wave, tempfile
 import optparse
 
 import json
-import urllib
-import urllib.request, urllib.error
+import httpclient
 
 import glob
 
@@ -18,7 +17,8 @@ class JuliusCli():
     #
     #  Constructor
     #
-    def __init__(self, host="localhost", port=10000):
+    def __init__(self, host="localhost", port=10000, http=None):
+        self._http = http or httpclient.HTTPClient()
         self.setServer(host, port)
         self._lang = "jaJP"
         self._apikey=""
@@ -38,14 +38,13 @@ class JuliusCli():
     #
     def request_asr(self, data):
         query_string = {'output': 'json', 'lang': self._lang, 'key': self._apikey}
-        url = '{0}?{1}'.format(self._endpoint, urllib.urlencode(query_string)) 
+        url = '{0}?{1}'.format(self._endpoint, httpclient.urlencode(query_string)) 
 
         headers = {'Content-Type': 'audio/l16; rate=16000'}
-        voice_data = str(bytearray(data))
+        voice_data = data
 
         try:
-            request = urllib.request.Request(url, data=voice_data, headers=headers)
-            result = urllib.urlopen(request)
+            result = self._http.request('POST', url, voice_data, headers)
             response = result.read()
             return response.decode('utf-8').split()
         except:
@@ -53,6 +52,23 @@ class JuliusCli():
             print (traceback.format_exc())
             return ["Error"]
 
+    #
+    #  Request Voice Recognition (returns decoded JSON)
+    #
+    def request_speech_recog(self, data, content_type=None):
+        result = self.request_asr(data)
+        if result :
+            return json.loads(''.join(result))
+        return []
+
+    #
+    #  Hypotheses in a result: [(text, score), ...] (None if recognition failed)
+    #
+    def hypotheses(self, res):
+        if len(res) <= 1:
+            return None
+        return [(r['str'], r.get('confidence', 0.0)) for r in res['result']]
+
 def getWavData(fname):
     try:
         f = wave.open(fname)
@@ -60,7 +76,7 @@ def getWavData(fname):
         f.close()
         return data
     except:
-        return ""
+        return b""
 
 
 def show_result(result):
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Ahead-of-time compiler of W3C-SRGS grammars for JuliusRTC
+
+Copyright (C) 2017
+    Isao Hara
+    National Institute of Advanced Industrial Science and Technology (AIST),
+    Japan
+    All rights reserved.
+
+Licensed under the Eclipse Public License -v 1.0 (EPL)
+http://www.opensource.org/licenses/eclipse-1.0.txt
+
+Every rule of the given grammar files is compiled into the grammar cache
+(~/.openhri/grammar), which JuliusRTC reads at activation. The rules are
+compiled in parallel processes. With -r and no grammar files, only the
+lexicon database (~/.openhri/lexcon.db) is rebuilt, e.g. to be shipped as
+the prebuilt lexicon (julius.prebuilt_lexicon).
+
+The properties julius.grammar_cache, julius.3rdparty_dir and
+julius.prebuilt_lexicon are read as JuliusRTC reads them from the file
+given by --config: the configuration file of JuliusRTC, or rtc.conf
+(communication.JuliusRTC.<name> and its config_file). --cache-dir,
+--3rdparty-dir and --prebuilt-lexicon override them. Without them, the
+compiler fills the default cache, which JuliusRTC does not read if the
+properties are set.
+
+With --benchmark, the automata of synthetic grammars of growing size are
+built and minimized, and the time is reported.
+
+With --check, the word sequences accepted by the automaton of every rule of
+the given grammar files and of random nested grammars are compared before
+and after the minimization.
+'''
+
+from __future__ import print_function
+import sys, os, time, random, optparse, traceback
+import multiprocessing
+from io import StringIO
+from openhrivoice.__init__ import __version__
+from openhrivoice import utils
+from openhrivoice.config import config
+from openhrivoice.JuliusRTC.parsesrgs import *
+
+__doc__ = "Compile W3C-SRGS grammars of JuliusRTC into the grammar cache."
+
+#
+#  properties of JuliusRTC used by SRGS and LexiconDB
+#
+PROPERTIES = ('julius.grammar_cache', 'julius.3rdparty_dir', 'julius.prebuilt_lexicon')
+
+class Properties:
+    """ Utility class to give the properties (a dict, which can be passed to
+    the worker processes) to SRGS and LexiconDB."""
+    def __init__(self, values):
+        self._values = values
+
+    def getProperty(self, key):
+        return self._values.get(key, '')
+
+#
+#  read the properties from the configuration file of JuliusRTC or from rtc.conf
+#
+def loadproperties(fname):
+    import OpenRTM_aist
+    prop = OpenRTM_aist.Properties()
+    f = open(fname)
+    try:
+        prop.load(f)
+    finally:
+        f.close()
+    values = {}
+    conffile = prop.getProperty('communication.JuliusRTC.config_file')
+    if conffile:
+        # rtc.conf: the configuration file of the component
+        if not os.path.isabs(conffile) and not os.path.exists(conffile):
+            conffile = os.path.join(os.path.dirname(fname), conffile)
+        values = loadproperties(conffile)
+    for key in PROPERTIES:
+        value = prop.getProperty('communication.JuliusRTC.' + key) or prop.getProperty(key)
+        if value:
+            values[key] = value
+    return values
+
+#
+#  compile a rule: (file, rule, properties) -> (file, rule, cached, elapsed, error)
+#
+def compile_rule(args):
+    (fname, rule, values) = args
+    start = time.time()
+    try:
+        srgs = SRGS(fname, Properties(values))
+        cached = srgs._cache is not None and srgs._cache.get(srgs.cachekey(rule)) is not None
+        srgs.toJulius(rule)
+        return (fname, rule, cached, time.time() - start, None)
+    except:
+        return (fname, rule, False, time.time() - start, traceback.format_exc())
+
+#
+#  synthetic grammar: items in sequence, each repeats a choice of words
+#
+def synthetic_grammar(items, words, repeat):
+    choice = u'<item repeat="%s"><one-of>%s</one-of></item>' % (repeat, u''.join([u'<item>w%d</item>' % i for i in range(words)]))
+    return StringIO(u'<grammar xmlns="http://www.w3.org/2001/06/grammar" xml:lang="en" version="1.0" root="main">'
+                    u'<rule id="main"><item>start</item>%s<item>end</item></rule></grammar>' % (choice * items,))
+
+#
+#  time to build and minimize automata of synthetic grammars
+#
+def benchmark():
+    for (items, words, repeat) in ((10, 50, '1-5'), (20, 50, '1-5'), (40, 50, '1-5'), (80, 50, '1-5'),
+                                   (2, 20, '0-3'), (4, 20, '0-3'), (6, 20, '0-3')):
+        srgs = SRGS(synthetic_grammar(items, words, repeat))
+        start = time.time()
+        dfa = srgs.toDFA('main')
+        built = time.time()
+        (before, after) = dfa.minimize()
+        print ("%2d items x %d words (repeat %s): build %.3fs, minimize %.3fs, %d states, %d edges -> %d states, %d edges" %
+               ((items, words, repeat, built - start, time.time() - built) + before + after))
+
+#
+#  random nested grammar (words, sequences, one-of and repeats)
+#
+def random_expansion(rnd, depth):
+    kind = rnd.choice(('word', 'word', 'sequence', 'one-of', 'repeat') if depth > 0 else ('word',))
+    if kind == 'word':
+        return u'<item>w%d</item>' % rnd.randint(0, 4)
+    if kind == 'sequence':
+        return u'<item>%s</item>' % u''.join([random_expansion(rnd, depth - 1) for i in range(rnd.randint(1, 3))])
+    if kind == 'one-of':
+        return u'<one-of>%s</one-of>' % u''.join([u'<item>%s</item>' % random_expansion(rnd, depth - 1) for i in range(rnd.randint(2, 3))])
+    return u'<item repeat="%s">%s</item>' % (rnd.choice(('0-1', '1-2', '0-2', '1-3')), random_expansion(rnd, depth - 1))
+
+def random_grammar(seed):
+    rnd = random.Random(seed)
+    items = u''.join([random_expansion(rnd, 3) for i in range(rnd.randint(1, 3))])
+    return StringIO(u'<grammar xmlns="http://www.w3.org/2001/06/grammar" xml:lang="en" version="1.0" root="main">'
+                    u'<rule id="main">%s</rule></grammar>' % (items,))
+
+#
+#  compare accepted word sequences before and after the minimization
+#  (returns False if they differ)
+#
+def check_rule(srgs, rule, name, maxlen):
+    dfa = srgs.toDFA(rule)
+    before = dfa.sentences(maxlen)
+    (size, minsize) = dfa.minimize()
+    after = dfa.sentences(maxlen)
+    if before != after:
+        print ("[error] %s: %s: %d sentences -> %d sentences" % (name, rule, len(before), len(after)))
+        return False
+    print ("%s: %s: %d sentences, %d states, %d edges -> %d states, %d edges" % ((name, rule, len(before)) + size + minsize))
+    return True
+
+def check(files, grammars=300, maxlen=8):
+    failed = 0
+    total = 0
+    for fname in files:
+        srgs = SRGS(fname)
+        for rule in sorted(srgs._rules.keys()):
+            total += 1
+            if not check_rule(srgs, rule, fname, maxlen):
+                failed += 1
+    for seed in range(grammars):
+        total += 1
+        if not check_rule(SRGS(random_grammar(seed)), 'main', 'random%d' % (seed,), maxlen):
+            failed += 1
+    print ("%d rules, %d failed" % (total, failed))
+    return failed == 0
+
+#
+#  Main
+#
+def main():
+    parser = utils.MyParser(version=__version__, usage="%prog [srgsfile...]",
+                            description=__doc__)
+    parser.add_option('-j', '--jobs', dest='jobs', type='int',
+                      default=multiprocessing.cpu_count(),
+                      help='number of parallel processes')
+    parser.add_option('-r', '--rebuild-lexicon', dest='rebuild_lexicon', action="store_true",
+                      default=False,
+                      help='rebuild lexicon')
+    parser.add_option('-b', '--benchmark', dest='benchmark', action="store_true",
+                      default=False,
+                      help='measure the time to build automata of synthetic grammars')
+    parser.add_option('-c', '--check', dest='check', action="store_true",
+                      default=False,
+                      help='check that the minimization keeps the accepted word sequences')
+    parser.add_option('-f', '--config', dest='config', type='string',
+                      default=None,
+                      help='read the properties from the configuration file of JuliusRTC or rtc.conf')
+    parser.add_option('--cache-dir', dest='cache_dir', type='string',
+                      default=None,
+                      help='grammar cache directory (julius.grammar_cache)')
+    parser.add_option('--3rdparty-dir', dest='thirdparty_dir', type='string',
+                      default=None,
+                      help='directory of the Julius dictionaries (julius.3rdparty_dir)')
+    parser.add_option('--prebuilt-lexicon', dest='prebuilt_lexicon', type='string',
+                      default=None,
+                      help='prebuilt lexicon database (julius.prebuilt_lexicon)')
+    try:
+        opts, args = parser.parse_args()
+    except optparse.OptionError as e:
+        print('OptionError:', e, file=sys.stderr)
+        sys.exit(1)
+
+    if opts.benchmark:
+        benchmark()
+        return
+
+    if opts.check:
+        if not check(args):
+            sys.exit(1)
+        return
+
+    if len(args) == 0 and not opts.rebuild_lexicon:
+        parser.error("wrong number of arguments")
+        sys.exit(1)
+
+    values = {}
+    if opts.config:
+        values = loadproperties(opts.config)
+    for (key, value) in (('julius.grammar_cache', opts.cache_dir),
+                         ('julius.3rdparty_dir', opts.thirdparty_dir),
+                         ('julius.prebuilt_lexicon', opts.prebuilt_lexicon)):
+        if value:
+            values[key] = value
+    for key in PROPERTIES:
+        if key in values:
+            print ("%s: %s" % (key, values[key]))
+    prop = Properties(values)
+
+    start = time.time()
+    #
+    # build the lexicon database before the workers share it
+    conf = config()
+    LexiconDB(conf._lexicondb, __version__, prop, opts.rebuild_lexicon)
+
+    tasks = []
+    for a in args:
+        tasks.extend([(a, r, values) for r in sorted(SRGS(a, prop)._rules.keys())])
+
+    pool = multiprocessing.Pool(max(1, opts.jobs))
+    failed = 0
+    try:
+        for (fname, rule, cached, elapsed, error) in pool.imap_unordered(compile_rule, tasks):
+            if error:
+                failed += 1
+                print ("[error] %s: %s" % (fname, rule))
+                print (error)
+            else:
+                print ("%s: %s (%s, %.2fs)" % (fname, rule, "cached" if cached else "compiled", elapsed))
+    finally:
+        pool.close()
+        pool.join()
+
+    print ("%d rules, %d failed in %.2fs" % (len(tasks), failed, time.time() - start))
+    if failed > 0:
+        sys.exit(1)
+
+#
+#  Main
+#
+if __name__=='__main__':
+    main()
@@ -13,65 +13,155 @@ Licensed under the Eclipse Public License -v 1.0 (EPL)
 http://www.opensource.org/licenses/eclipse-1.0.txt
 '''
 
+import sys, os, time
 import sqlite3
+import multiprocessing
 from openhrivoice.__init__ import __version__
 from openhrivoice.config import config
 from openhrivoice.JuliusRTC.parsejuliusdict import *
 from openhrivoice.JuliusRTC.parsevoxforgedict import *
 
+#
+#  rows of the lexicon of English phrases
+#  (called in a worker process)
+#
+def parsevoxforge(fname):
+    dic = VoxforgeDict(fname)
+    return [(t.lower(), v, 'ARPAbet') for (t, vs) in dic._dict.items() for v in vs]
+
+#
+#  rows of the lexicon of Japanese phrases
+#  (called in a worker process)
+#
+def parsejulius(fname):
+    dic = JuliusDict(fname)
+    return [(t, v, 'KANA') for (t, vs) in dic._dict.items() for v in vs]
+
 #
 #  Lexicon Database class
 #
 class LexiconDB:
-    ''' Utility class to store pronunciation dictionary to database'''
+    ''' Utility class to store pronunciation dictionary to database
+    Words are segmented on an in-memory index of the registered texts.'''
+
+    # maximum number of pronunciations of a segmented word
+    MAXVARIANTS = 256
+
     #
     #  Constructor
     #
     def __init__(self, fname, version, prop=None, rebuid=False):
         self._config = config()
+        prebuilt = None
         if prop :
             if prop.getProperty("julius.3rdparty_dir") :
                 self._config.julius(prop.getProperty("julius.3rdparty_dir"))
+            if prop.getProperty("julius.prebuilt_lexicon") :
+                prebuilt = prop.getProperty("julius.prebuilt_lexicon")
         #
         self._db = sqlite3.connect(fname)
+        self._texts = None
+        self._maxlen = 0
+        self._lookupcache = {}
         createtable = rebuid
 
         #
         #  check version
         if not self.tableexist('version'):
             # create version table if not
-            self.createversiontable(version)
+            self.createversiontable()
             createtable = True
-        elif len(self._db.execute(u"select text from version where text = '%s';" % (version,)).fetchall()) == 0:
+        elif len(self._db.execute(u"select text from version where text = ?;", (version,)).fetchall()) == 0:
             # check version
             self._db.execute(u'drop table version;')
-            self.createversiontable(version)
+            self.createversiontable()
             createtable = True
 
         #
-        # 
+        #  (the version is written after the data, so that an interrupted
+        #   build is done again)
         if createtable == True:
+            self._db.execute(u'delete from version;')
+            self._db.commit()
             if self.tableexist('data'):
                 self._db.execute(u'drop table data;')
-            self.createdatatable()
+            if not (prebuilt and not rebuid and self.loadprebuilt(prebuilt, version)):
+                self.build()
+            self._db.execute(u'insert into version values (?);', (version,))
+            self._db.commit()
 
-            #
-            #  lexicon of English phrases
-            dic = VoxforgeDict(self._config._julius_dict_en)
-            for t, vs in dic._dict.iteritems():
-                for v in vs:
-                    self.register(t.lower(), v, 'ARPAbet')
-            del dic
-
-            #
-            # lexicon of Japanese phrases
-            dic = JuliusDict(self._config._julius_dict_ja)
-            for t, vs in dic._dict.iteritems():
-                for v in vs:
-                    self.register(t, v, 'KANA')
-            del dic
+    #
+    #  build lexicon table from the dictionaries
+    #  (the dictionaries are parsed in parallel processes and loaded in
+    #   bulk, the indexes are created after the load)
+    def build(self):
+        start = time.time()
+        self.createdatatable()
+        pragmas = {}
+        for (name, value) in (('journal_mode', 'OFF'), ('synchronous', 'OFF'),
+                              ('cache_size', '-65536'), ('locking_mode', 'EXCLUSIVE')):
+            pragmas[name] = self._db.execute(u'pragma %s;' % (name,)).fetchone()[0]
+            self._db.execute(u'pragma %s = %s;' % (name, value))
+
+        jobs = ((parsevoxforge, self._config._julius_dict_en), (parsejulius, self._config._julius_dict_ja))
+        pool = None
+        if not hasattr(sys, "frozen") and multiprocessing.cpu_count() > 1:
+            try:
+                pool = multiprocessing.Pool(len(jobs))
+            except (OSError, ImportError, NotImplementedError) as e:
+                print ("[warning] dictionaries are parsed in this process: %s" % (e,))
+        try:
+            if pool is not None:
+                results = [pool.apply_async(func, (fname,)) for (func, fname) in jobs]
+                rows = (r.get() for r in results)
+            else:
+                rows = (func(fname) for (func, fname) in jobs)
+            count = 0
+            for r in rows:
+                self._db.executemany(u'insert into data values (?,?,?);', r)
+                count += len(r)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        self.createindexes()
+        self._db.commit()
+        for (name, value) in pragmas.items():
+            self._db.execute(u'pragma %s = %s;' % (name, value))
+        # the exclusive lock is released at the next access
+        self._db.execute(u'select count(*) from version;').fetchall()
+        print ("[info] lexicon database built in %.1fs (%d entries)" % (time.time() - start, count))
 
+    #
+    #  copy lexicon table from a prebuilt database of the same version
+    #  (returns False if the prebuilt database can not be used)
+    def loadprebuilt(self, fname, version):
+        start = time.time()
+        if not os.path.isfile(fname):
+            print ("[warning] prebuilt lexicon is not found: %s" % (fname,))
+            return False
+        try:
+            self._db.execute(u'attach database ? as prebuilt;', (fname,))
+        except sqlite3.Error as e:
+            print ("[warning] prebuilt lexicon is not available: %s" % (e,))
+            return False
+        try:
+            try:
+                if len(self._db.execute(u"select text from prebuilt.version where text = ?;", (version,)).fetchall()) == 0:
+                    print ("[warning] prebuilt lexicon is not version %s" % (version,))
+                    return False
+            except sqlite3.Error as e:
+                print ("[warning] prebuilt lexicon is not available: %s" % (e,))
+                return False
+            self.createdatatable()
+            self._db.execute(u'insert into data select text, pronounce, alphabet from prebuilt.data;')
+            self.createindexes()
             self._db.commit()
+        finally:
+            self._db.execute(u'detach database prebuilt;')
+        print ("[info] lexicon database copied from %s in %.1fs" % (fname, time.time() - start))
+        return True
 
     #
     # check table exists or not
@@ -81,14 +171,13 @@ class LexiconDB:
 
     #
     #  create 'version' table
-    def createversiontable(self, version):
+    def createversiontable(self):
         sql = u"""
 create table version (
   text varchar(10)
 );
 """
         self._db.execute(sql)
-        self._db.execute(u'insert into version values (?);', (version,))
 
     #
     #  create lexicon table
@@ -101,6 +190,10 @@ create table data (
 );
 """
         self._db.execute(sql)
+
+    #
+    #  create indexes of lexicon table
+    def createindexes(self):
         self._db.execute('create index text_index on data(text);')
         self._db.execute('create index alphabet_index on data(alphabet);')
 
@@ -113,26 +206,61 @@ create table data (
     #
     #  
     def lookup(self, text):
-        return list(set([p[0] for p in self._db.execute(u"select pronounce from data where text = '%s';" % (text.lower(),)).fetchall()]))
+        text = text.lower()
+        try:
+            return list(self._lookupcache[text])
+        except KeyError:
+            pass
+        p = list(set([p[0] for p in self._db.execute(u"select pronounce from data where text = ?;", (text,)).fetchall()]))
+        self._lookupcache[text] = p
+        return list(p)
+
+    #
+    #  set of registered texts (loaded at the first segmentation)
+    def textindex(self):
+        if self._texts is None:
+            self._texts = set()
+            for (t,) in self._db.execute(u"select distinct text from data;"):
+                self._texts.add(t)
+                self._maxlen = max(self._maxlen, len(t))
+        return self._texts
 
     #
-    # 
+    #  pronunciations of a word, or of the segments of the word if it is not
+    #  registered (the longest registered prefix is taken first, shorter ones
+    #  if the rest can not be segmented)
     def substringlookup(self, text):
         p = self.lookup(text)
-        if len(p) == 0:
-            for i in range(1, len(text)):
-                substr = text[:-i]
-                reststr = text[len(text)-i:]
-                #print substr + "|" + reststr
-                pp1 = self.lookup(substr)
-                if len(pp1) > 0:
-                    #print substr + ':' + ','.join(pp1)
-                    pp2 = self.substringlookup(reststr)
-                    for p1 in pp1:
-                        for p2 in pp2:
-                            p.append(p1 + p2)
+        if len(p) > 0 or len(text) == 0:
+            return p
+        texts = self.textindex()
+        n = len(text)
+        # seg[i]: pronunciations of text[i:]
+        seg = [None] * n
+        for i in range(n - 1, -1, -1):
+            if i > 0 and text[i:].lower() in texts:
+                seg[i] = self.lookup(text[i:])
+                continue
+            seg[i] = []
+            for j in range(min(n - 1, i + self._maxlen), i, -1):
+                if seg[j] and text[i:j].lower() in texts:
+                    seg[i] = self.combine(self.lookup(text[i:j]), seg[j])
                     break
-        return list(set(p))
+        return seg[0]
+
+    #
+    #  concatenated pronunciations (up to MAXVARIANTS)
+    def combine(self, pp1, pp2):
+        p = []
+        seen = set()
+        for p1 in pp1:
+            for p2 in pp2:
+                if p1 + p2 not in seen:
+                    seen.add(p1 + p2)
+                    p.append(p1 + p2)
+                    if len(p) >= self.MAXVARIANTS:
+                        return p
+        return p
         
 if __name__ == '__main__':
     import sys
@@ -41,10 +41,10 @@ class JuliusDict:
         for l in f:
             matchObj = re.search(r'\[.+\]', l)
             if matchObj :
-                t = conv_encoding(matchObj.group())
-                t = t[1:-1]
+                l = conv_encoding(l)
+                t = l[l.index('[') + 1:l.rindex(']')]
                 #print (t)
-                ph = conv_encoding(l).rsplit(']')
+                ph = l.rsplit(']')
                 if len(ph) > 1:
                     st = [ ' '+ph[1].strip() ]
                     try:
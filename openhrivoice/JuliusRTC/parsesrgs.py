@@ -13,7 +13,7 @@ Licensed under the Eclipse Public License -v 1.0 (EPL)
 http://www.opensource.org/licenses/eclipse-1.0.txt
 '''
 
-import sys, os, re, codecs, types
+import sys, os, re, time, codecs, types, hashlib, tempfile
 from lxml import etree
 
 from io import StringIO
@@ -22,6 +22,9 @@ from openhrivoice.__init__ import __version__
 from openhrivoice.config import config
 from openhrivoice.JuliusRTC.lexicondb import *
 
+# version of the compiled grammar format (change when the output of toJulius changes)
+GRAMMAR_FORMAT = 3
+
 #
 #
 #
@@ -93,6 +96,77 @@ class PLS:
             print (e)
         return self
 
+#
+#
+#
+class GrammarCache:
+    """ Utility class to store compiled grammars (DFA and dictionary) in files.
+    A file is written to a temporary name and renamed, so that the cache
+    can be shared by several processes. The modification time of a file is
+    updated when it is read, and the least recently used files over
+    maxentries are removed when a grammar is stored (the entries of edited
+    grammars are never read again)."""
+    #
+    #
+    def __init__(self, dirname, maxentries=1000):
+        self._dir = dirname
+        self._maxentries = maxentries
+        if not os.path.exists(self._dir):
+            os.makedirs(self._dir)
+
+    #
+    #
+    def filename(self, key):
+        return os.path.join(self._dir, key + '.jgram')
+
+    #
+    #  compiled grammar of the key (None if not cached)
+    def get(self, key):
+        try:
+            with codecs.open(self.filename(key), 'r', 'utf-8') as f:
+                gram = f.read()
+            os.utime(self.filename(key), None)
+            return gram
+        except (IOError, OSError):
+            return None
+
+    #
+    #
+    def put(self, key, gram):
+        (fd, tmpname) = tempfile.mkstemp(suffix='.tmp', dir=self._dir)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(gram.encode('utf-8'))
+        try:
+            os.rename(tmpname, self.filename(key))
+        except OSError:
+            # the target exists (on Windows)
+            os.remove(tmpname)
+        self.evict()
+
+    #
+    #  remove least recently used entries over maxentries
+    #  (and temporary files left by interrupted writes)
+    def evict(self):
+        entries = []
+        now = time.time()
+        for f in os.listdir(self._dir):
+            fname = os.path.join(self._dir, f)
+            try:
+                mtime = os.path.getmtime(fname)
+                if f.endswith('.jgram'):
+                    entries.append((mtime, fname))
+                elif f.endswith('.tmp') and now - mtime > 3600:
+                    os.remove(fname)
+            except OSError:
+                # removed by another process
+                pass
+        entries.sort()
+        for (mtime, fname) in entries[:max(0, len(entries) - self._maxentries)]:
+            try:
+                os.remove(fname)
+            except OSError:
+                pass
+
 #
 #
 #
@@ -171,17 +245,33 @@ class SRGS:
         self._rootrule = None
         self._lex = None
         self._node = None
+        self._hash = None
         self._rebuild_lexicon=rebuild_lexicon
+        self._pls = None
+        self._lexdb = None
+        self._cache = None
+        cachedir = self._config._grammarcache
 
         self._prop = prop
         if prop :
             if prop.getProperty("julius.3rdparty_dir") :
                 self._config.julius(prop.getProperty("julius.3rdparty_dir"))
+            if prop.getProperty("julius.grammar_cache") :
+                cachedir = prop.getProperty("julius.grammar_cache")
+
+        if cachedir != 'NO':
+            try:
+                self._cache = GrammarCache(cachedir)
+            except OSError as e:
+                print ("[warning] grammar cache is not available")
+                print (e)
 
         try:
             doc = etree.parse(file)
             doc.xinclude()
             self._node = doc.getroot()
+            # the included files are hashed as a part of the document
+            self._hash = hashlib.sha1(etree.tostring(doc)).hexdigest()
 
         except etree.XMLSyntaxError as e:
             print ("[error] invalid xml syntax")
@@ -264,9 +354,8 @@ class SRGS:
                             self.toJulius_recur(i, dfa, currentstate2, newstate2)
                             currentstate2 = newstate2
                         self.toJulius_recur(item._items[-1], dfa, currentstate, newstate)
-                        for v in dfa._dfa:
-                            if v[2] == currentstate:
-                                dfa.append((v[0], v[1], endstate))
+                        for v in list(dfa.incoming(currentstate)):
+                            dfa.append((v[0], v[1], endstate))
                         currentstate = newstate
                     currentstate2 = currentstate
                     for i in item._items[:-1]:
@@ -274,9 +363,8 @@ class SRGS:
                         self.toJulius_recur(i, dfa, currentstate2, newstate2)
                         currentstate2 = newstate2
                     self.toJulius_recur(item._items[-1], dfa, currentstate, endstate)
-                    for v in dfa._dfa:
-                        if v[2] == currentstate:
-                            dfa.append((v[0], v[1], endstate))
+                    for v in list(dfa.incoming(currentstate)):
+                        dfa.append((v[0], v[1], endstate))
             else:
                 currentstate = startstate
                 for i in item._items[:-1]:
@@ -285,9 +373,8 @@ class SRGS:
                     currentstate = newstate
                 self.toJulius_recur(item._items[-1], dfa, currentstate, endstate)
             if item._repeatmin == 0: # add skip transition
-                for v in dfa._dfa:
-                    if v[2] == startstate:
-                        dfa.append((v[0], v[1], endstate))
+                for v in list(dfa.incoming(startstate)):
+                    dfa.append((v[0], v[1], endstate))
 
         elif item._type == "one-of":
             for i in item._items:
@@ -311,18 +398,59 @@ class SRGS:
             pass
 
     #
+    #  key of a compiled rule: hash of the grammar (with XIncludes), the PLS
+    #  files, the lexicon database (version and file), the language and the rule
     #
+    def cachekey(self, rule):
+        h = hashlib.sha1()
+        h.update(('%d\n%s\n%s\n%s\n' % (GRAMMAR_FORMAT, __version__, self._lang, rule)).encode('utf-8'))
+        h.update(self._hash.encode('ascii'))
+        for l in (self._lex or []):
+            try:
+                with open(l, 'rb') as f:
+                    h.update(hashlib.sha1(f.read()).hexdigest().encode('ascii'))
+            except IOError:
+                h.update(('missing:' + l).encode('utf-8'))
+        try:
+            st = os.stat(self._config._lexicondb)
+            h.update(('%d:%d' % (st.st_mtime, st.st_size)).encode('ascii'))
+        except OSError:
+            pass
+        return h.hexdigest()
+
+    #
+    #  PLS lexicons and the lexicon database (opened once for all rules)
+    #
+    def lexicons(self):
+        if self._pls is None and self._lex is not None:
+            self._pls = PLS().parse(self._lex)
+        if self._lexdb is None:
+            self._lexdb = LexiconDB(self._config._lexicondb, __version__, self._prop, self._rebuild_lexicon)
+            self._rebuild_lexicon = False
+        return (self._pls, self._lexdb)
+
+    #
+    #  compiled grammar of a rule (from the cache if it is compiled already)
     #
     def toJulius(self, rootrule = None):
         if rootrule is None:
-            root = self._rules[self._rootrule]
-        else:
-            root = self._rules[rootrule]
+            rootrule = self._rootrule
+        if self._cache is None or self._hash is None:
+            return self.toJulius_compile(rootrule)
+        if not self._rebuild_lexicon:
+            gram = self._cache.get(self.cachekey(rootrule))
+            if gram is not None:
+                return gram
+        gram = self.toJulius_compile(rootrule)
+        # the key is taken after the compile, since the lexicon may be built by it
+        self._cache.put(self.cachekey(rootrule), gram)
+        return gram
 
-        lex = None
-        if self._lex is not None:
-            lex = PLS().parse(self._lex)
-        lexdb = LexiconDB(self._config._lexicondb, __version__, self._prop, self._rebuild_lexicon)
+    #
+    #
+    #
+    def toDFA(self, rootrule):
+        root = self._rules[rootrule]
 
         dfa = DFA()
         startstate = dfa.newstate()
@@ -334,6 +462,17 @@ class SRGS:
             self.toJulius_recur(i, dfa, currentstate, newstate)
             currentstate = newstate
         self.toJulius_recur(root._items[-1], dfa, currentstate, dfa.ENDSTATE)
+        return dfa
+
+    #
+    #
+    #
+    def toJulius_compile(self, rootrule):
+        (lex, lexdb) = self.lexicons()
+
+        dfa = self.toDFA(rootrule)
+        (before, after) = dfa.minimize()
+        print ("[info] %s: %d states, %d edges -> %d states, %d edges" % ((rootrule,) + before + after))
         revdfa = dfa.reverse()
 
         dict = {}
@@ -410,7 +549,8 @@ class SRGS:
 #
 #
 class DFA:
-    """ Utility class to manage DFA """
+    """ Utility class to manage DFA
+    The edges into and out of each state are indexed in the order of append()."""
 
     STARTSTATE = 0
     ENDSTATE = 1
@@ -420,6 +560,8 @@ class DFA:
     #
     def __init__(self):
         self._dfa = list()
+        self._incoming = {}
+        self._outgoing = {}
         self._totalstate = 2
 
     #
@@ -432,11 +574,178 @@ class DFA:
     #
     def append(self, value):
         self._dfa.append(value)
+        self._incoming.setdefault(value[2], []).append(value)
+        self._outgoing.setdefault(value[0], []).append(value)
+
+    #
+    #  edges into a state
+    def incoming(self, state):
+        return self._incoming.get(state, [])
+
+    #
+    #  edges from a state
+    def outgoing(self, state):
+        return self._outgoing.get(state, [])
+
+    #
+    #  remove all edges
+    def clear(self):
+        self._dfa = list()
+        self._incoming = {}
+        self._outgoing = {}
     
+    #
+    #  number of states and edges
+    def size(self):
+        states = set()
+        for v in self._dfa:
+            states.add(v[0])
+            states.add(v[2])
+        states.discard(self.EOA)
+        return (len(states), len(self._dfa))
+
+    #
+    #  word sequences accepted by the automaton (up to maxlen words)
+    def sentences(self, maxlen=10):
+        result = set()
+        stack = [(self.STARTSTATE, ())]
+        while stack:
+            (state, words) = stack.pop()
+            for (fromstate, word, tostate) in self.outgoing(state):
+                if tostate == self.EOA:
+                    result.add(' '.join(words[1:]))
+                elif len(words) <= maxlen:
+                    stack.append((tostate, words + (word,)))
+        return sorted(result)
+
+    #
+    #  determinize and minimize the automaton
+    #  (subset construction and Hopcroft's algorithm on the reversed edges,
+    #   so that the automaton given to Julius by reverse() is deterministic
+    #   and minimal; returns (states, edges) before and after)
+    def minimize(self):
+        """
+        >>> dfa = DFA()
+        >>> for v in [(0, '<s>', 2), (1, '</s>', -1), (2, 'a', 3), (3, 'b', 4),
+        ...           (2, 'a', 5), (5, 'c', 4), (4, 'd', 6), (3, 'b', 1), (5, 'c', 1),
+        ...           (6, 'd', 1), (4, 'd', 1), (3, 'b', 1), (5, 'c', 1)]:
+        ...     dfa.append(v)
+        >>> before = dfa.sentences()
+        >>> before
+        ['a b', 'a b d', 'a b d d', 'a c', 'a c d', 'a c d d']
+        >>> dfa.minimize()
+        ((7, 13), (6, 11))
+        >>> dfa.sentences() == before
+        True
+        >>> sorted(dfa.reverse())
+        [(0, '</s>', 1), (1, 'b', 2), (1, 'c', 2), (1, 'd', 3), (2, 'a', 4), (3, 'b', 2), (3, 'c', 2), (3, 'd', 5), (4, '<s>', 6), (5, 'b', 2), (5, 'c', 2), (6, -1, -1)]
+        """
+        before = self.size()
+        #
+        # reversed edges: state -> word -> states
+        rev = {}
+        for (tostate, edges) in self._incoming.items():
+            rev[tostate] = {}
+            for (fromstate, word, t) in edges:
+                rev[tostate].setdefault(word, set()).add(fromstate)
+        #
+        # subset construction from the end of the automaton
+        init = frozenset([self.EOA])
+        index = {init: 0}
+        subsets = [init]
+        delta = []
+        i = 0
+        while i < len(subsets):
+            moves = {}
+            for state in subsets[i]:
+                for (word, states) in rev.get(state, {}).items():
+                    moves.setdefault(word, set()).update(states)
+            d = {}
+            for (word, states) in moves.items():
+                t = frozenset(states)
+                if t not in index:
+                    index[t] = len(subsets)
+                    subsets.append(t)
+                d[word] = index[t]
+            delta.append(d)
+            i += 1
+        final = [i for i in range(len(subsets)) if self.STARTSTATE in subsets[i]]
+        block = self.hopcroft(delta, final)
+        #
+        # number the blocks (the start, end and EOA keep their numbers)
+        rep = {}
+        for q in range(len(subsets)):
+            rep.setdefault(block[q], q)
+        order = [block[0]]
+        seen = set(order)
+        i = 0
+        while i < len(order):
+            for (word, q) in sorted(delta[rep[order[i]]].items()):
+                if block[q] not in seen:
+                    seen.add(block[q])
+                    order.append(block[q])
+            i += 1
+        ids = {block[0]: self.EOA, block[index[frozenset([self.ENDSTATE])]]: self.ENDSTATE}
+        for q in final:
+            ids[block[q]] = self.STARTSTATE
+        self._totalstate = 2
+        for b in order:
+            if b not in ids:
+                ids[b] = self.newstate()
+        self.clear()
+        for b in order:
+            for (word, q) in sorted(delta[rep[b]].items()):
+                self.append((ids[block[q]], word, ids[b]))
+        return (before, self.size())
+
+    #
+    #  partition of the states of a deterministic automaton into the blocks
+    #  of equivalent states (delta[state] = {word: state}, the transition
+    #  function may be partial)
+    def hopcroft(self, delta, final):
+        n = len(delta)
+        inv = [{} for q in range(n)]
+        for p in range(n):
+            for (word, q) in delta[p].items():
+                inv[q].setdefault(word, []).append(p)
+        final = set(final)
+        blocks = [b for b in (final, set(range(n)) - final) if b]
+        block = [0] * n
+        for (b, states) in enumerate(blocks):
+            for q in states:
+                block[q] = b
+        # all blocks are splitters at first since the transition function is partial
+        work = set(range(len(blocks)))
+        while work:
+            splitter = list(blocks[work.pop()])
+            preds = {}
+            for q in splitter:
+                for (word, states) in inv[q].items():
+                    preds.setdefault(word, set()).update(states)
+            for states in preds.values():
+                touched = {}
+                for p in states:
+                    touched.setdefault(block[p], set()).add(p)
+                for (b, inside) in touched.items():
+                    if len(inside) == len(blocks[b]):
+                        continue
+                    outside = blocks[b] - inside
+                    blocks[b] = inside
+                    nb = len(blocks)
+                    blocks.append(outside)
+                    for q in outside:
+                        block[q] = nb
+                    if b in work or len(outside) <= len(inside):
+                        work.add(nb)
+                    else:
+                        work.add(b)
+        return block
+
     #
     #
     def reverse(self): # convert dfa into reverse order
         newdfa = list()
+        accept = False
         for v in self._dfa:
             fromstate = v[0]
             tostate = v[2]
@@ -444,7 +753,10 @@ class DFA:
                 tostate = self.STARTSTATE
             elif fromstate == self.STARTSTATE:
                 newdfa.append((tostate, v[1], self._totalstate))
-                newdfa.append((self._totalstate, -1, -1))
+                if not accept:
+                    # a minimized automaton may have several edges from the start
+                    newdfa.append((self._totalstate, -1, -1))
+                    accept = True
                 continue
             newdfa.append((tostate, v[1], fromstate))
         return newdfa
@@ -37,7 +37,7 @@ class VoxforgeDict:
         else:
             f = open(fname, 'r')
         for l in f:
-            t = re.split(r"\s+", l.strip(), 2)
+            t = l.strip().split(None, 2)
             st = ' '.join(t[2].split(' ')[:-1])
             st = st.lower()
             try:
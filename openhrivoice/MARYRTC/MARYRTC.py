@@ -16,7 +16,8 @@ http://www.opensource.org/licenses/eclipse-1.0.txt
 import os
 import sys
 import time
-import urllib
+import io
+import threading
 import tempfile
 import traceback
 import wave
@@ -25,82 +26,103 @@ import OpenRTM_aist
 import RTC
 from __init__ import __version__
 import utils
+import httpclient
 
 from VoiceSynthComponentBase import *
 
+try:
+    _
+except NameError:
+    _ = lambda s: s
+
 
 __doc__ = _('German speech synthesis component using MARY.')
 
 class MARYTalkWrap(VoiceSynthBase):
+    # /voices of each server
+    _voices = {}
+
     def __init__(self, rtc):
         VoiceSynthBase.__init__(self)
         prop = rtc._properties
         if prop.getProperty("mary.sox_dir") :
-            self._conf.sox_top(prop.getProperty("mary.sox_dir"))
+            self._sox_bin = os.path.join(prop.getProperty("mary.sox_dir"), "sox")
 
-        self._lang = rtc._language
+        self._lang = rtc._language[0]
+        self._http = httpclient.fromproperties(prop)
         self.set_url(rtc._manytts_server [0])
 
     def set_url(self, url):
         self._baseurl = "http://"+url+"/"
         self._voice_type = {}
         print (self._baseurl)
-        voiceinfo = urllib.urlopen(self._baseurl + 'voices').readlines()
+        if url not in MARYTalkWrap._voices:
+            MARYTalkWrap._voices[url] = self.request('voices').decode('utf-8').splitlines()
+        voiceinfo = MARYTalkWrap._voices[url]
         print (voiceinfo)
         for v in voiceinfo:
+            if not v.strip():
+                continue
             (id, lang, gender, type) = v.strip().split(' ', 3)
             if lang == self._lang:
                 self._voice_type[gender] = id
 
         print (self._voice_type)
 
-    def getaudio(self, data, character):
+    def request(self, path):
+        return self._http.request('GET', self._baseurl + path).read()
+
+    def query(self, data, character, output_type):
         query = [
                  ('INPUT_TYPE', 'TEXT'),
-                 ('OUTPUT_TYPE', 'AUDIO'),
+                 ('OUTPUT_TYPE', output_type),
                  ('AUDIO', 'WAVE_FILE'),
                  ('LOCALE', self._lang),
                  ('VOICE', self._voice_type[character]),
                  ('INPUT_TEXT', data.encode('utf-8')),
                  ]
-        maryurl = self._baseurl + 'process?' + urllib.urlencode(query)
-        wavfile = self.gettempname()
-        urllib.urlretrieve(maryurl, wavfile)
+        return 'process?' + httpclient.urlencode(query)
 
-        #
-        # convert samplerate
-        # normally openjtalk outputs 48000Hz sound.
-        wavfile2 = self.gettempname()
-        cmdarg = [self._conf._sox_bin, "-t", "wav", wavfile, "-r", "16000", "-t", "wav", wavfile2]
-        p = subprocess.Popen(cmdarg)
-        p.wait()
-
-        os.remove(wavfile)
-        wavfile = wavfile2
-
-        return wavfile
+    def getaudio(self, data, character):
+        # (converted to samplerate by the base class)
+        return io.BytesIO(self.request(self.query(data, character, 'AUDIO')))
 
     def getdurations(self, data, character):
-        query = [
-                 ('INPUT_TYPE', 'TEXT'),
-                 ('OUTPUT_TYPE', 'REALISED_DURATIONS'),
-                 ('AUDIO', 'WAVE_FILE'),
-                 ('LOCALE', self._lang),
-                 ('VOICE', self._voice_type[character]),
-                 ('INPUT_TEXT', data.encode('utf-8')),
-                 ]
-        maryurl = self._baseurl + 'process?' + urllib.urlencode(query)
-        f = urllib.urlopen(maryurl)
-        d = f.read()
-        f.close()
+        d = self.request(self.query(data, character, 'REALISED_DURATIONS'))
         #lasttime = float(d.split('\n')[-2].split(' ')[0])
         #d = '#\n0.001 125 sil\n' + '\n'.join(d.split('\n')[1:]) + ('%f 125 sil\n' % (lasttime + 0.001,))
         return d
 
+    def cacheparams(self):
+        return (self._baseurl, sorted(self._voice_type.items()))
+
+    #
+    #  audio and durations are requested concurrently
+    #
     def synthreal(self, data, samplerate, character):
-        wavfile = self.getaudio(data, character)
-        durations = self.getdurations(data, character)
-        return (durations, wavfile)
+        result = []
+        def fetchdurations():
+            try:
+                result.append(self.getdurations(data, character))
+            except Exception as e:
+                result.append(e)
+        th = threading.Thread(target=fetchdurations)
+        th.start()
+        try:
+            wavfile = self.getaudio(data, character)
+        finally:
+            th.join()
+        if isinstance(result[0], Exception):
+            raise result[0]
+        return (result[0], wavfile)
+
+    def getstats(self):
+        stats = VoiceSynthBase.getstats(self)
+        stats['http'] = self._http.getstats()
+        return stats
+
+    def terminate(self):
+        self._http.close()
 
 MARYRTC_spec = ["implementation_id", "MARYRTC",
                 "type_name",         "MARYRTC",
@@ -128,6 +150,48 @@ MARYRTC_spec = ["implementation_id", "MARYRTC",
                 "conf.__widget__.manytts_server", "text",
                 "conf.default.language", "de",
                 "conf.__widget__.language", "text",
+                "conf.default.cache_dir", "",
+                "conf.__widget__.cache_dir", "text",
+                "conf.__description__.cache_dir", "Directory of the persistent synthesis cache (default: ~/.openhri/synthcache).",
+                "conf.default.cache_bytes", "67108864",
+                "conf.__widget__.cache_bytes", "text",
+                "conf.__type__.cache_bytes", "int",
+                "conf.__description__.cache_bytes", "Size limit of the persistent synthesis cache in bytes (0: disable cache).",
+                "conf.default.streaming", "NO",
+                "conf.__widget__.streaming", "radio",
+                "conf.__constraints__.streaming", "(YES, NO)",
+                "conf.__description__.streaming", "Synthesize long text sentence by sentence and start output after the first one (YES/NO).",
+                "conf.default.resample_quality", "medium",
+                "conf.__widget__.resample_quality", "radio",
+                "conf.__constraints__.resample_quality", "(fast, medium, high)",
+                "conf.__description__.resample_quality", "Quality of the sampling rate conversion (fast, medium, high).",
+                "conf.default.synth_workers", "2",
+                "conf.__widget__.synth_workers", "spin",
+                "conf.__type__.synth_workers", "int",
+                "conf.__constraints__.synth_workers", "0<=x<=16",
+                "conf.__description__.synth_workers", "Number of synthesis worker threads (0: synthesize in the data listener).",
+                "conf.default.queue_size", "8",
+                "conf.__widget__.queue_size", "spin",
+                "conf.__type__.queue_size", "int",
+                "conf.__constraints__.queue_size", "0<=x<=1000",
+                "conf.__description__.queue_size", "Maximum number of waiting texts to be synthesized, each counted as one request in streaming mode too (0: unlimited).",
+                "conf.default.queue_policy", "block",
+                "conf.__widget__.queue_policy", "radio",
+                "conf.__constraints__.queue_policy", "(block, drop_oldest, drop_newest)",
+                "conf.__description__.queue_policy", "Behavior when the request queue is full.",
+                "conf.default.warmup_file", "",
+                "conf.__widget__.warmup_file", "text",
+                "conf.__description__.warmup_file", "Phrase file pre-synthesized into the cache on activation (one phrase per line, optionally followed by character and rate separated by tabs).",
+                "conf.default.frame_ms", "20",
+                "conf.__widget__.frame_ms", "spin",
+                "conf.__type__.frame_ms", "int",
+                "conf.__constraints__.frame_ms", "5<=x<=1000",
+                "conf.__description__.frame_ms", "Duration of an output audio frame in milliseconds.",
+                "conf.default.lead_ms", "100",
+                "conf.__widget__.lead_ms", "spin",
+                "conf.__type__.lead_ms", "int",
+                "conf.__constraints__.lead_ms", "0<=x<=5000",
+                "conf.__description__.lead_ms", "Audio sent ahead of its playback time in milliseconds.",
                 ""]
 
 class MARYRTC(VoiceSynthComponentBase):
@@ -150,7 +214,11 @@ class MARYRTC(VoiceSynthComponentBase):
     #
     def onActivated(self, ec_id):
         try:
-            self._wrap = MARYTalkWrap(self)
+            if self._wrap is None:
+                self._wrap = MARYTalkWrap(self)
+            else:
+                self._wrap._lang = self._language[0]
+                self._wrap.set_url(self._manytts_server[0])
         except:
             self._logger.RTC_ERROR(traceback.format_exc())
             return RTC.RTC_ERROR
@@ -186,5 +254,113 @@ def main():
     manager = MARYRTCManager()
     manager.start()
 
+#
+#  check against a local stub MARY server (python MARYRTC.py --test)
+#  (concurrent AUDIO and REALISED_DURATIONS requests, keep-alive
+#   connections and the cache of /voices)
+#
+def _stubserver(delay):
+    try:
+        from http.server import HTTPServer, BaseHTTPRequestHandler
+        from socketserver import ThreadingMixIn
+        from urllib.parse import urlsplit, parse_qsl
+    except ImportError:
+        from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+        from SocketServer import ThreadingMixIn
+        from urlparse import urlsplit, parse_qsl
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+        lock = threading.Lock()
+        requests = []
+        active = 0
+        max_active = 0
+
+        def handle_error(self, request, client_address):
+            pass
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            server = self.server
+            with server.lock:
+                server.active += 1
+                server.max_active = max(server.max_active, server.active)
+            url = urlsplit(self.path)
+            query = dict(parse_qsl(url.query))
+            if url.path == '/voices':
+                data = b'cmu-slt-hsmm en_US female hmm\ncmu-bdl-hsmm en_US male hmm\n'
+            elif query.get('OUTPUT_TYPE') == 'AUDIO':
+                time.sleep(delay)
+                buf = io.BytesIO()
+                w = wave.open(buf, 'wb')
+                w.setnchannels(1)
+                w.setsampwidth(2)
+                w.setframerate(16000)
+                w.writeframes(b'\0\1' * 1600)
+                w.close()
+                data = buf.getvalue()
+            else:
+                time.sleep(delay)
+                data = ('#\n0.1 125 %s\n' % (query['INPUT_TEXT'],)).encode('utf-8')
+            with server.lock:
+                server.requests.append((url.path, query.get('OUTPUT_TYPE'), self.client_address))
+                server.active -= 1
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    server = Server(('127.0.0.1', 0), Handler)
+    th = threading.Thread(target=server.serve_forever)
+    th.daemon = True
+    th.start()
+    return server
+
+def _test():
+    class Properties:
+        def getProperty(self, key):
+            return ''
+    class Component:
+        _properties = Properties()
+        _language = ['en_US']
+    delay = 0.3
+    server = _stubserver(delay)
+    Component._manytts_server = ['127.0.0.1:%d' % server.server_address[1]]
+
+    # /voices is requested once for each server
+    wraps = [MARYTalkWrap(Component()) for i in range(2)]
+    assert [r[0] for r in server.requests] == ['/voices'], server.requests
+    assert wraps[1]._voice_type == {'female': 'cmu-slt-hsmm', 'male': 'cmu-bdl-hsmm'}, wraps[1]._voice_type
+    print ('voices cache: ok')
+
+    # audio and durations are requested at the same time
+    wrap = wraps[0]
+    for i in range(3):
+        start = time.time()
+        (durations, wavfile) = wrap.synthreal(u'hello', 16000, 'female')
+        assert time.time() - start < delay * 1.8, time.time() - start
+        assert durations.strip().endswith(b'hello'), durations
+        assert wave.open(wavfile).getnframes() == 1600
+    assert server.max_active == 2, server.max_active
+    print ('concurrent requests: ok')
+
+    # the connections are kept alive
+    stats = wrap._http.getstats()[Component._manytts_server[0]]
+    assert stats['connections'] <= 3 and stats['reused'] >= 4, stats
+    assert len(set([r[2] for r in server.requests])) == stats['connections'], server.requests
+    print ('keep-alive: ok')
+    print (wrap._http.summary())
+    for w in wraps:
+        w.terminate()
+    server.shutdown()
+
 if __name__=='__main__':
+    if '--test' in sys.argv:
+        _test()
+        sys.exit(0)
     main()
@@ -99,6 +99,7 @@ class OpenJTalkWrap(VoiceSynthBase):
         self._gv_spectrum = 1.0
         self._gv_log_f0 = 1.0
         self._volume = 0.0
+        self._delimiter_pattern = u'[。、！？]+\\s*'
 
         if prop.getProperty("openjtalk.3rdparty_dir") :
             self._conf.openjtalk(prop.getProperty("openjtalk.3rdparty_dir"))
@@ -108,6 +109,7 @@ class OpenJTalkWrap(VoiceSynthBase):
 
         if prop.getProperty("openjtalk.sox_dir") :
             self._conf.sox_top(prop.getProperty("openjtalk.sox_dir"))
+        self._sox_bin = self._conf._sox_bin
 
         openjtalk_bin=prop.getProperty("openjtalk.bin")
         if not openjtalk_bin : openjtalk_bin = self._conf._openjtalk_bin
@@ -209,18 +211,16 @@ class OpenJTalkWrap(VoiceSynthBase):
         print ' '.join(cmdarg)
         # run OpenJTalk
         #    String ---> Wav data
-        p = subprocess.Popen(cmdarg)
-        p.wait()
+        try:
+            self.runproc(cmdarg)
+        except:
+            for fn in (textfile, logfile, wavfile):
+                if os.path.exists(fn):
+                    os.remove(fn)
+            raise
 
-        # convert samplerate
         # normally openjtalk outputs 48000Hz sound.
-        wavfile2 = self.gettempname()
-        cmdarg = [self._conf._sox_bin, "-t", "wav", wavfile, "-r", str(samplerate), "-t", "wav", wavfile2]
-        p = subprocess.Popen(cmdarg)
-        p.wait()
-
-        os.remove(wavfile)
-        wavfile = wavfile2
+        # (converted to samplerate by the base class)
 
         # read duration data
         d = parseopenjtalk()
@@ -231,10 +231,29 @@ class OpenJTalkWrap(VoiceSynthBase):
         return (durationdata, wavfile)
 
     #
-    #  set cachesize
+    #  shift time alignment of a segment by offset (sec)
+    #  (toseg() lists the length of each phoneme, so the offset is given as a leading pause
+    #   in the same unit as toseg(): HTK time (100ns) / 1000000)
+    #
+    def shiftdurations(self, durationdata, offset):
+        return durationdata.replace('#\n', '#\n%f 125 pau\n' % (offset * 10,), 1)
+
+    #
+    #  set cachesize (number of cached utterances, 0: limited by cache_bytes only)
     #
     def set_cachesize(self, n):
         self._cachesize = n
+        if self._cache is not None:
+            self._cache.set_maxentries(n)
+
+    #
+    #  engine parameters which affect the synthesized audio
+    #
+    def cacheparams(self):
+        return (self._sampling_rate, self._frame_period, self._all_pass,
+                self._postfiltering_coefficent, self._speed_rate, self._addtional_half_tone,
+                self._threshold, self._gv_spectrum, self._gv_log_f0, self._volume,
+                self._conf._openjtalk_phonemodel_male_ja, self._conf._openjtalk_phonemodel_female_ja)
 
     #
     #  set params
@@ -279,9 +298,52 @@ OpenJTalkRTC_spec = ["implementation_id", "OpenJTalkRTC",
                      "conf.__widget__.character", "radio",
                      "conf.__constraints__.character", "(male, female)",
                      "conf.__description__.character", _("Character of the voice.").encode('UTF-8'),
-                     "conf.default.cachesize", "1",
+                     "conf.default.cachesize", "0",
                      "conf.__widget__.cachesize", "text",
                      "conf.__type__.cachesize", "int",
+                     "conf.__description__.cachesize", _("Maximum number of cached utterances (0: limited by cache_bytes only).").encode('UTF-8'),
+                     "conf.default.cache_dir", "",
+                     "conf.__widget__.cache_dir", "text",
+                     "conf.__description__.cache_dir", _("Directory of the persistent synthesis cache (default: ~/.openhri/synthcache).").encode('UTF-8'),
+                     "conf.default.cache_bytes", "67108864",
+                     "conf.__widget__.cache_bytes", "text",
+                     "conf.__type__.cache_bytes", "int",
+                     "conf.__description__.cache_bytes", _("Size limit of the persistent synthesis cache in bytes (0: disable cache).").encode('UTF-8'),
+                     "conf.default.streaming", "NO",
+                     "conf.__widget__.streaming", "radio",
+                     "conf.__constraints__.streaming", "(YES, NO)",
+                     "conf.__description__.streaming", _("Synthesize long text sentence by sentence and start output after the first one (YES/NO).").encode('UTF-8'),
+                     "conf.default.resample_quality", "medium",
+                     "conf.__widget__.resample_quality", "radio",
+                     "conf.__constraints__.resample_quality", "(fast, medium, high)",
+                     "conf.__description__.resample_quality", _("Quality of the sampling rate conversion (fast, medium, high).").encode('UTF-8'),
+                     "conf.default.synth_workers", "2",
+                     "conf.__widget__.synth_workers", "spin",
+                     "conf.__type__.synth_workers", "int",
+                     "conf.__constraints__.synth_workers", "0<=x<=16",
+                     "conf.__description__.synth_workers", _("Number of synthesis worker threads (0: synthesize in the data listener).").encode('UTF-8'),
+                     "conf.default.queue_size", "8",
+                     "conf.__widget__.queue_size", "spin",
+                     "conf.__type__.queue_size", "int",
+                     "conf.__constraints__.queue_size", "0<=x<=1000",
+                     "conf.__description__.queue_size", _("Maximum number of waiting texts to be synthesized, each counted as one request in streaming mode too (0: unlimited).").encode('UTF-8'),
+                     "conf.default.queue_policy", "block",
+                     "conf.__widget__.queue_policy", "radio",
+                     "conf.__constraints__.queue_policy", "(block, drop_oldest, drop_newest)",
+                     "conf.__description__.queue_policy", _("Behavior when the request queue is full.").encode('UTF-8'),
+                     "conf.default.warmup_file", "",
+                     "conf.__widget__.warmup_file", "text",
+                     "conf.__description__.warmup_file", _("Phrase file pre-synthesized into the cache on activation (one phrase per line, optionally followed by character and rate separated by tabs).").encode('UTF-8'),
+                     "conf.default.frame_ms", "20",
+                     "conf.__widget__.frame_ms", "spin",
+                     "conf.__type__.frame_ms", "int",
+                     "conf.__constraints__.frame_ms", "5<=x<=1000",
+                     "conf.__description__.frame_ms", _("Duration of an output audio frame in milliseconds.").encode('UTF-8'),
+                     "conf.default.lead_ms", "100",
+                     "conf.__widget__.lead_ms", "spin",
+                     "conf.__type__.lead_ms", "int",
+                     "conf.__constraints__.lead_ms", "0<=x<=5000",
+                     "conf.__description__.lead_ms", _("Audio sent ahead of its playback time in milliseconds.").encode('UTF-8'),
                      "conf.default.sampling_rate", "0",
                      "conf.__widget__.samplig_rate", "text",
                      "conf.__type__.samplig_rate", "int",
@@ -326,8 +388,8 @@ class OpenJTalkRTC(VoiceSynthComponentBase):
     def onInitialize(self):
         VoiceSynthComponentBase.onInitialize(self)
 
-        self._cachesize=[1]
-        self.bindParameter("cachesize", self._cachesize, "1")
+        self._cachesize=[0]
+        self.bindParameter("cachesize", self._cachesize, "0")
 
         self._sampling_rate=[0]
         self.bindParameter("sampling_rate", self._sampling_rate, "0")
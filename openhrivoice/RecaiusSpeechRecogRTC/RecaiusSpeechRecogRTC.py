@@ -18,9 +18,10 @@ import time, struct, traceback, locale, codecs, getopt, wave, tempfile
 import optparse
 
 import json
-
-from pydub import AudioSegment
-from pydub.silence import *
+try:
+    import audioop
+except ImportError:
+    audioop = None
 
 from xml.dom.minidom import Document
 
@@ -28,9 +29,11 @@ import OpenRTM_aist
 import RTC
 from __init__ import __version__
 import utils
+import httpclient
 
-from CloudSpeechRecogBase import CloudSpeechRecogBase
-from recaius import RecaiusAsr
+from CloudSpeechRecogBase import CloudSpeechRecogBase, HedgedSpeechRecog
+from julius_cli import JuliusCli
+from recaius import RecaiusAsr, RecaiusStream, RecaiusSessionPool, releaseTokenManager
 
 
 __doc__ = _('Google Speech Recognition component.')
@@ -44,14 +47,15 @@ class RecaiusSpeechRecogWrap(CloudSpeechRecogBase):
     #
     #  Constructor
     #
-    def __init__(self, rtc, language='jp', ex_sec=600):
+    def __init__(self, rtc, language='jp', ex_sec=600, sessions=2, encoding="pcm"):
         CloudSpeechRecogBase.__init__(self, language)
         self._service_id={}
         self._password=""
 
-        self._recaius = RecaiusAsr()
-
         prop = rtc._properties
+        self._http = httpclient.fromproperties(prop, cookies=True)
+        self._recaius = RecaiusAsr(http=self._http)
+
         if prop.getProperty("recaius.speech.jp.id") :
             self._service_id['jp']=prop.getProperty("recaius.speech.jp.id")
 
@@ -78,14 +82,82 @@ class RecaiusSpeechRecogWrap(CloudSpeechRecogBase):
                 self._logger = True
 
         self._recaius.setAccount(self._service_id[self._lang], self._passwd)
+        if encoding == "adpcm" and audioop is not None:
+            self._recaius.setAudioType("audio/x-adpcm")
+            self.set_encoding(encoding)
 
-        self._token = self._recaius.requestAuthToken(ex_sec)
+        self._tokens = self._recaius.getTokenManager(ex_sec)
+        self._token = self._tokens.token()
+        self._sessions = RecaiusSessionPool(self._recaius, self._tokens, sessions)
+
+    #
+    #  Request Recaius Voice Recognition (on a pooled session)
+    #  (encoded data is sent without silence padding)
+    #
+    def request_speech_recog(self, data, content_type=None):
+       asr = self._sessions.acquire()
+       if asr is None:
+           return ""
+       if content_type:
+           result = asr.getVoiceRecogResult(data, False)
+       else:
+           result = asr.getVoiceRecogResult(data.tobytes())
+       # a RESULT before the flush (a dict) leaves the session unflushed
+       self._sessions.release(asr, bool(result) and not isinstance(result, dict))
+       return result
+
+    #
+    #  Hypotheses in a result: [(text, score), ...] (None if recognition failed)
+    #  (the result of flush is the JSON text of the events, a stream gives
+    #   the list of RESULT events)
+    #
+    def hypotheses(self, res):
+       if not res:
+           return None
+       if isinstance(res, dict):
+           res = [res]
+       elif not isinstance(res, list):
+           res = [d for d in json.loads(res) if d['type'] == 'RESULT']
+           if not res:
+               return None
+       if len(res) == 1:
+           return [(r['str'], r.get('confidence', 0.0)) for r in res[0]['result']]
+       #
+       # the server split the stream into several utterances:
+       # the best hypotheses are joined
+       best = [d['result'][0] for d in res if d['result']]
+       if not best:
+           return None
+       sep = '' if self._lang in ('jp', 'cn') else ' '
+       return [(sep.join([r['str'] for r in best]), min([r.get('confidence', 0.0) for r in best]))]
 
     #
-    #  Request Recaius Voice Recognition
+    #  Open streaming upload (on a pooled session)
     #
-    def request_speech_recog(self, data):
-       return self._recaius.request_speech_recog(str(bytearray(data)))
+    def open_stream(self, audio):
+       if not self._streaming:
+           return CloudSpeechRecogBase.open_stream(self, audio)
+       return RecaiusStream(self._sessions)
+
+    #
+    #  Metrics of the auth token and the session pool
+    #
+    def getsessionstats(self):
+       stats = self._sessions.getstats()
+       if self._tokens is not None:
+           stats.update(self._tokens.getstats())
+       return stats
+
+    #
+    #  Terminate (end the pooled sessions)
+    #
+    def terminate(self):
+       self._sessions.close()
+       if self._tokens is not None:
+           releaseTokenManager(self._tokens)
+           self._tokens = None
+       self._http.close()
+       return CloudSpeechRecogBase.terminate(self)
        
 
 #
@@ -118,6 +190,62 @@ RecaiusSpeechRecogRTC_spec = ["implementation_id", "RecaiusSpeechRecogRTC",
                   "conf.__widget__.silence_thr", "text",
                   "conf.__type__.silence_thr", "int",
 
+                  "conf.default.vad_frame", "20",
+                  "conf.__widget__.vad_frame", "text",
+                  "conf.__type__.vad_frame", "int",
+
+                  "conf.default.max_utterance", "0",
+                  "conf.__widget__.max_utterance", "text",
+                  "conf.__type__.max_utterance", "int",
+
+                  "conf.default.utterance_policy", "split",
+                  "conf.__widget__.utterance_policy", "radio",
+                  "conf.__constraints__.utterance_policy", "(split, truncate)",
+                  "conf.__type__.utterance_policy", "string",
+
+                  "conf.default.max_backlog", "8",
+                  "conf.__widget__.max_backlog", "text",
+                  "conf.__type__.max_backlog", "int",
+
+                  "conf.default.backlog_policy", "drop_oldest",
+                  "conf.__widget__.backlog_policy", "radio",
+                  "conf.__constraints__.backlog_policy", "(block, drop_oldest, drop_newest)",
+                  "conf.__type__.backlog_policy", "string",
+
+                  "conf.default.concurrency", "2",
+                  "conf.__widget__.concurrency", "text",
+                  "conf.__type__.concurrency", "int",
+
+                  "conf.default.request_timeout", "30",
+                  "conf.__widget__.request_timeout", "text",
+                  "conf.__type__.request_timeout", "float",
+
+                  "conf.default.result_deadline", "0",
+                  "conf.__widget__.result_deadline", "text",
+                  "conf.__type__.result_deadline", "float",
+
+                  "conf.default.streaming", "0",
+                  "conf.__widget__.streaming", "radio",
+                  "conf.__constraints__.streaming", "(0, 1)",
+                  "conf.__type__.streaming", "int",
+
+                  "conf.default.session_pool", "2",
+                  "conf.__widget__.session_pool", "text",
+                  "conf.__type__.session_pool", "int",
+
+                  "conf.default.encoding", "pcm",
+                  "conf.__widget__.encoding", "radio",
+                  "conf.__constraints__.encoding", "(pcm, adpcm)",
+                  "conf.__type__.encoding", "string",
+
+                    "conf.default.hedge_server", "",
+                    "conf.__widget__.hedge_server", "text",
+                    "conf.__type__.hedge_server", "string",
+
+                    "conf.default.hedge_delay", "0",
+                    "conf.__widget__.hedge_delay", "text",
+                    "conf.__type__.hedge_delay", "float",
+
                   ""]
 #
 #  DataListener class
@@ -148,11 +276,25 @@ class RecaiusSpeechRecogRTC(OpenRTM_aist.DataFlowComponentBase):
     def __init__(self, manager):
         OpenRTM_aist.DataFlowComponentBase.__init__(self, manager)
         self._recog = None
+        self._backend = None
         self._copyrights=[]
         self._lang = [ "ja-JP" ]
         self._min_silence = [ 200 ]
         self._silence_thr = [ -20 ]
         self._min_buflen =  [ 8000 ]
+        self._vad_frame = [ 20 ]
+        self._max_utterance = [ 0 ]
+        self._utterance_policy = [ "split" ]
+        self._max_backlog = [ 8 ]
+        self._backlog_policy = [ "drop_oldest" ]
+        self._concurrency = [ 2 ]
+        self._request_timeout = [ 30.0 ]
+        self._result_deadline = [ 0.0 ]
+        self._streaming = [ 0 ]
+        self._session_pool = [ 2 ]
+        self._encoding = [ "pcm" ]
+        self._hedge_server = [ "" ]
+        self._hedge_delay = [ 0.0 ]
 
 
     #
@@ -169,14 +311,35 @@ class RecaiusSpeechRecogRTC(OpenRTM_aist.DataFlowComponentBase):
         self.bindParameter("min_silence", self._min_silence, "200")
         self.bindParameter("silence_thr", self._silence_thr, "-20")
         self.bindParameter("min_buflen", self._min_buflen, "8000")
+        self.bindParameter("vad_frame", self._vad_frame, "20")
+        self.bindParameter("max_utterance", self._max_utterance, "0")
+        self.bindParameter("utterance_policy", self._utterance_policy, "split")
+        self.bindParameter("max_backlog", self._max_backlog, "8")
+        self.bindParameter("backlog_policy", self._backlog_policy, "drop_oldest")
+        self.bindParameter("concurrency", self._concurrency, "2")
+        self.bindParameter("request_timeout", self._request_timeout, "30")
+        self.bindParameter("result_deadline", self._result_deadline, "0")
+        self.bindParameter("streaming", self._streaming, "0")
+        self.bindParameter("session_pool", self._session_pool, "2")
+        self.bindParameter("encoding", self._encoding, "pcm")
+        self.bindParameter("hedge_server", self._hedge_server, "")
+        self.bindParameter("hedge_delay", self._hedge_delay, "0")
         #
-        # create inport for audio stream
-        self._indata = RTC.TimedOctetSeq(RTC.Time(0,0), None)
-        self._inport = OpenRTM_aist.InPort("data", self._indata)
-        self._inport.appendProperty('description', _('Audio data (in packets) to be recognized.').encode('UTF-8'))
-        self._inport.addConnectorDataListener(OpenRTM_aist.ConnectorDataListenerType.ON_BUFFER_WRITE,
-                                              DataListener("data", self, RTC.TimedOctetSeq))
-        self.registerInPort(self._inport._name, self._inport)
+        # create inports for audio streams
+        # (recaius.speech.streams: comma separated stream ids, one inport is created for
+        #  each id and the results are tagged with it; "data" by default)
+        self._streams = []
+        if self._properties.getProperty("recaius.speech.streams") :
+            self._streams = [s.strip() for s in self._properties.getProperty("recaius.speech.streams").split(',') if s.strip()]
+        self._inports = {}
+        for name in (self._streams or ["data"]):
+            indata = RTC.TimedOctetSeq(RTC.Time(0,0), None)
+            inport = OpenRTM_aist.InPort(name, indata)
+            inport.appendProperty('description', _('Audio data (in packets) to be recognized.').encode('UTF-8'))
+            inport.addConnectorDataListener(OpenRTM_aist.ConnectorDataListenerType.ON_BUFFER_WRITE,
+                                            DataListener(name, self, RTC.TimedOctetSeq))
+            self.registerInPort(inport._name, inport)
+            self._inports[name] = (inport, indata)
 
         #
         # create outport for result
@@ -207,27 +370,51 @@ class RecaiusSpeechRecogRTC(OpenRTM_aist.DataFlowComponentBase):
     #  OnActivate
     #
     def onActivated(self, ec_id):
-        self._recog = RecaiusSpeechRecogWrap(self, self._lang[0])
-        self._recog.setcallback(self.onResult)
-
-        OpenRTM_aist.DataFlowComponentBase.onActivated(self, ec_id)
-        #self._recog.set_lang(self._lang[0])
-        self._recog.set_voice_detect_param(int(self._min_silence[0]),  int(self._silence_thr[0]), int(self._min_buflen[0]))
+        encoding = self._encoding[0]
+        if self._hedge_server[0]:
+            # hedged requests are sent as raw PCM
+            encoding = "pcm"
+        self._backend = RecaiusSpeechRecogWrap(self, self._lang[0], sessions=int(self._session_pool[0]), encoding=encoding)
+        #
+        # the token manager and the session pool are running from here:
+        # they are stopped if the activation fails
+        try:
+            if self._hedge_server[0]:
+                # local Julius server as the secondary backend
+                (host, port) = self._hedge_server[0].split(':')
+                julius = JuliusCli(host, int(port), self._backend._http)
+                self._recog = HedgedSpeechRecog([("recaius", self._backend), ("julius", julius)], float(self._hedge_delay[0]), self._lang[0])
+            else:
+                self._recog = self._backend
+            self._recog.setcallback(self.onResult)
+
+            OpenRTM_aist.DataFlowComponentBase.onActivated(self, ec_id)
+            #self._recog.set_lang(self._lang[0])
+            self._recog.set_voice_detect_param(int(self._min_silence[0]),  int(self._silence_thr[0]), int(self._min_buflen[0]), int(self._vad_frame[0]))
+            self._recog.set_max_utterance(int(self._max_utterance[0]), self._utterance_policy[0])
+            self._recog.set_backlog(int(self._max_backlog[0]), self._backlog_policy[0])
+            self._recog.set_request_param(int(self._concurrency[0]), float(self._request_timeout[0]), float(self._result_deadline[0]))
+            self._recog.set_streaming(int(self._streaming[0]) != 0)
+        except:
+            print (traceback.format_exc())
+            self._backend.terminate()
+            return RTC.RTC_ERROR
 
-        if self._recog._token:
+        if self._backend._token:
             #self._recog._recaius.startVoiceRecogSession()
             self._recog.start()
             return RTC.RTC_OK
         else:
+            self._backend.terminate()
             return RTC.RTC_ERROR
 
     #
     #  OnDeactivate
     #
-    def onDeactivate(self, ec_id):
+    def onDeactivated(self, ec_id):
         self._recog.terminate()
         #self._recog._recaius.endVoiceRecogSession()
-        OpenRTM_aist.DataFlowComponentBase.onDeactivate(self, ec_id)
+        OpenRTM_aist.DataFlowComponentBase.onDeactivated(self, ec_id)
         return RTC.RTC_OK
 
     #
@@ -235,8 +422,8 @@ class RecaiusSpeechRecogRTC(OpenRTM_aist.DataFlowComponentBase):
     #
     def onData(self, name, data):
         if self._recog:
-            if name == "data":
-                self._recog.write(data.data)
+            if name in self._inports:
+                self._recog.write(data.data, name)
 
 
     #
@@ -249,24 +436,27 @@ class RecaiusSpeechRecogRTC(OpenRTM_aist.DataFlowComponentBase):
     #
     #  OnResult
     #
-    def onResult(self, data):
+    def onResult(self, data, capture_time=None, stream_id=None):
         doc = Document()
         listentext = doc.createElement("listenText")
         doc.appendChild(listentext)
+        if self._streams:
+            listentext.setAttribute("stream", stream_id)
 
-        if len(data) <= 1:
-            listentext.setAttribute("state","RecognitionFailed")
+        try:
+            hypos = self._recog.hypotheses(data)
+        except:
+            print (traceback.format_exc())
+            listentext.setAttribute("state","ParseError")
         else:
-            try:
+            if not hypos:
+                listentext.setAttribute("state","RecognitionFailed")
+            else:
                 i=0
-                for r in data['result']:
+                for (text, score) in hypos:
                     i += 1
                     rank = str(i)
-                    if 'confidence' in r :
-                        score=str(r['confidence'])
-                    else:
-                        score=0.0
-                    text=r['str']
+                    score = str(score)
                     hypo = doc.createElement("data")
                     hypo.setAttribute("rank", rank)
                     hypo.setAttribute("score", score)
@@ -277,12 +467,20 @@ class RecaiusSpeechRecogRTC(OpenRTM_aist.DataFlowComponentBase):
 
                 listentext.setAttribute("state","Success")
 
-            except:
-                print (traceback.format_exc())
-                listentext.setAttribute("state","ParseError")
+        self._logger.RTC_INFO("queue: streams %(streams)d, depth %(depth)d (max %(max_depth)d), dropped %(dropped)d, wait %(wait_avg).3fs (max %(wait_max).3fs), timeouts %(timeouts)d, stale %(stale)d" % self._recog.getstats())
+        self._logger.RTC_INFO("http: " + self._backend._http.summary())
+        if self._recog is not self._backend:
+            self._logger.RTC_INFO("hedge: " + self._recog.summary())
+        stats = self._recog.getstats()
+        if stats['encoded'] > 0:
+            self._logger.RTC_INFO("encoding: %(encoded)d segments, ratio %(encode_ratio).2f, %(encode_time).4fs at end of speech" % stats)
+        self._logger.RTC_INFO("session: created %(created)d, warm %(warm)d, reused %(reused)d, misses %(misses)d, discarded %(discarded)d; token: requested %(requested)d, refreshed %(refreshed)d, failed %(failed)d" % self._backend.getsessionstats())
 
         res_data = doc.toxml(encoding="utf-8")
         self._outdata.data = res_data
+        if capture_time:
+            # time stamp of the recognized speech
+            self._outdata.tm = RTC.Time(int(capture_time), int((capture_time - int(capture_time)) * 1000000000))
         self._outport.write()
 
 #
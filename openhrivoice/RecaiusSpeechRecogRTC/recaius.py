@@ -5,15 +5,21 @@ import sys, os
 import time,wave
 import math
 import json
-import urllib
-import urllib.request, urllib.error
-import cookielib
+import threading
+import httpclient
 
 import base64
+try:
+    import audioop
+except ImportError:
+    audioop = None
 
 
+# connections shared by the clients in this process
+_http = httpclient.HTTPClient(cookies=True)
+
 class RecaiusAsr():
-  def __init__(self, service_id="", passwd=""):
+  def __init__(self, service_id="", passwd="", http=None):
      self._baseAuthUrl="https://api.recaius.jp/auth/v2/"
      self._baseAsrUrl="https://api.recaius.jp/asr/v2/"
      self._service_id=service_id
@@ -21,18 +27,48 @@ class RecaiusAsr():
      self._token = ''
      self._uuid = ''
      self._vid=1
+     self._used=False
      self._silence = getWavData("silence.wav")
      self._expiry=0
-     self._boundary = "----Boundary"
-
-     opener = urllib.request.build_opener(urllib.request.HTTPSHandler(debuglevel=0),
-                             urllib.request.HTTPCookieProcessor(cookielib.CookieJar()))
-     urllib.request.install_opener(opener)
+     self._boundary = b"----Boundary"
+     self._audio_type = "audio/x-linear"
+     self._http = http or _http
 
   def setAccount(self, service_id, passwd):
      self._service_id=service_id
      self._passwd=passwd
 
+  def setUrl(self, auth_url, asr_url):
+     self._baseAuthUrl=auth_url
+     self._baseAsrUrl=asr_url
+
+  # audio/x-linear or audio/x-adpcm
+  def setAudioType(self, audio_type):
+     self._audio_type=audio_type
+
+  #
+  #  token manager shared by the clients of this account
+  #
+  def getTokenManager(self, ex_sec=600):
+     auth = self.copy()
+     def refresh(token):
+       auth._token = token
+       return auth.refreshAuthToken(ex_sec) > 0
+     key = (self._baseAuthUrl, self._service_id, 'speech_recog_jaJP')
+     return getTokenManager(key, lambda: auth.requestAuthToken(ex_sec), refresh, ex_sec)
+
+  #
+  #  new object for another session (account, urls and token are shared)
+  #
+  def copy(self):
+     asr = RecaiusAsr(self._service_id, self._passwd, self._http)
+     asr.setUrl(self._baseAuthUrl, self._baseAsrUrl)
+     asr._token = self._token
+     asr._expiry = self._expiry
+     asr._silence = self._silence
+     asr._audio_type = self._audio_type
+     return asr
+
 
   #-------- Recaius Authorization
   def requestAuthToken(self, ex_sec=600):
@@ -40,13 +76,12 @@ class RecaiusAsr():
      headers = {'Content-Type' : 'application/json' }
      data = { "speech_recog_jaJP": { "service_id" : self._service_id, "password" : self._passwd}, "expiry_sec" : ex_sec }
 
-     request = urllib.request.Request(url, data=json.dumps(data), headers=headers)
      try:
-       result = urllib.urlopen(request)
-     except urllib.error.HTTPError as e:
+       result = self._http.request('POST', url, json.dumps(data).encode('utf-8'), headers)
+     except httpclient.HTTPError as e:
        print ('Error code:', e.code)
        return None
-     except urllib.error.URLError as e:
+     except httpclient.URLError as e:
        print ('URLErroe reason:', e.reason)
        return None
      else:
@@ -64,14 +99,12 @@ class RecaiusAsr():
 
      data = { "speech_recog_jaJP": { "service_id" : self._service_id, "password" : self._passwd}, "expiry_sec" : ex_sec }
 
-     request = urllib.request.Request(url, data=json.dumps(data), headers=headers)
-     request.get_method = lambda : 'PUT'
      try:
-       result = urllib.urlopen(request)
-     except urllib.error.HTTPError as e:
+       result = self._http.request('PUT', url, json.dumps(data).encode('utf-8'), headers)
+     except httpclient.HTTPError as e:
        print( 'Error code:', e.code)
        return -1
-     except urllib.error.URLError as e:
+     except httpclient.URLError as e:
        print ('URLErroe reason:', e.reason)
        return -1
      else:
@@ -84,16 +117,15 @@ class RecaiusAsr():
     
   def checkAuthToken(self):
      query_string = {'service_name' : 'speech_recog_jaJP'}
-     url = '{0}?{1}'.format(self._baseAuthUrl+'tokens', urllib.urlencode(query_string))
+     url = '{0}?{1}'.format(self._baseAuthUrl+'tokens', httpclient.urlencode(query_string))
      headers = {'Content-Type' : 'application/json', 'X-Token' : self._token }
 
-     request = urllib.request.Request(url, headers=headers)
      try:
-       result = urllib.urlopen(request)
-     except urllib.error.HTTPError as e:
+       result = self._http.request('GET', url, None, headers)
+     except httpclient.HTTPError as e:
        print ('Error code:', e.code)
        return -1
-     except urllib.error.URLError as e:
+     except httpclient.URLError as e:
        print ('URLErroe reason:', e.reason)
        return -1
      else:
@@ -107,20 +139,19 @@ class RecaiusAsr():
      url = self._baseAsrUrl+'voices'
      headers = {'Content-Type' : 'application/json', 'X-Token' : self._token }
 
-     data = { "audio_type": "audio/x-linear",
+     data = { "audio_type": self._audio_type,
               "result_type": "nbest",
               #"push_to_talk": True,
               "model_id": model,
               "comment": "Start" }
 
-     request = urllib.request.Request(url, data=json.dumps(data), headers=headers)
      try:
-       result = urllib.urlopen(request)
-     except urllib.error.HTTPError as e:
+       result = self._http.request('POST', url, json.dumps(data).encode('utf-8'), headers)
+     except httpclient.HTTPError as e:
        print ('Error code:', e.code)
        print ('Reason:', e.reason)
        return False
-     except urllib.error.URLError as e:
+     except httpclient.URLError as e:
        print ('URLErroe reason:', e.reason)
        return False
      else:
@@ -128,22 +159,21 @@ class RecaiusAsr():
        res = response.decode('utf-8')
        data=json.loads(res)
        self._uuid = data['uuid']
-       self._boundary = "----Boundary"+base64.b64encode(self._uuid)
+       self._vid = 0
+       self._boundary = b"----Boundary"+base64.b64encode(self._uuid.encode('utf-8'))
        return True
 
   def endVoiceRecogSession(self):
      url = self._baseAsrUrl+'voices/'+self._uuid
      headers = {'X-Token' : self._token }
 
-     request = urllib.request.Request(url, headers=headers)
-     request.get_method = lambda : 'DELETE'
      try:
-       result = urllib.urlopen(request)
-     except urllib.error.HTTPError as e:
+       result = self._http.request('DELETE', url, None, headers)
+     except httpclient.HTTPError as e:
        print ('Error code:', e.code)
        print ('Reason:', e.reason)
        return False
-     except urllib.error.URLError as e:
+     except httpclient.URLError as e:
        print( 'URLErroe reason:', e.reason)
        return False
      else:
@@ -152,12 +182,12 @@ class RecaiusAsr():
        if res : print (res)
        return True
 
-  def getVoiceRecogResult(self, data):
+  def getVoiceRecogResult(self, data, pad=True):
       #data = self._silence+data
-      data += self._silence+self._silence
+      if pad :
+        data += self._silence+self._silence
       voice_data = divString(data, 16364)
       #voice_data = divString(data, 32728)
-      self._vid=0
 
       for d in voice_data:
         self._vid += 1
@@ -174,31 +204,24 @@ class RecaiusAsr():
      url = self._baseAsrUrl+'voices/'+self._uuid
      headers = {'Content-Type' : 'multipart/form-data','X-Token' : self._token }
 
-     form_data = ""
-     form_data += self._boundary+"\r\n"
-     form_data += "Content-Disposition: form-data;name=\"voice_id\"\r\n\r\n"
-     form_data += str(vid)+"\r\n"
-     form_data += self._boundary+"\r\n"
-     form_data += "Content-Disposition: form-data;name=\"voice\"\r\n"
-     form_data += "Content-Type: application/octet-stream\r\n\r\n"
+     form_data = bytearray()
+     form_data += self._boundary+b"\r\n"
+     form_data += b"Content-Disposition: form-data;name=\"voice_id\"\r\n\r\n"
+     form_data += str(vid).encode('ascii')+b"\r\n"
+     form_data += self._boundary+b"\r\n"
+     form_data += b"Content-Disposition: form-data;name=\"voice\"\r\n"
+     form_data += b"Content-Type: application/octet-stream\r\n\r\n"
      form_data += data
-     form_data += "\r\n"
-     form_data += self._boundary+"\r\n"
-
-     request = urllib.request.Request(url)
-     request.add_header( 'X-Token', self._token )
-     request.add_header( 'Content-Type', 'multipart/form-data')
-     request.add_data(bytearray(form_data))
-
-     request.get_method = lambda : 'PUT'
+     form_data += b"\r\n"
+     form_data += self._boundary+b"\r\n"
 
      try:
-       result = urllib.urlopen(request)
-     except urllib.error.HTTPError as e:
+       result = self._http.request('PUT', url, bytes(form_data), headers)
+     except httpclient.HTTPError as e:
        print ('Error code:', e.code)
        print ('Reason:', e.reason)
        return False
-     except urllib.error.URLError as e:
+     except httpclient.URLError as e:
        print ('URLErroe reason:', e.reason)
        return False
      else:
@@ -214,16 +237,13 @@ class RecaiusAsr():
 
      data = { "voice_id": self._vid }
 
-     request = urllib.request.Request(url, data=json.dumps(data), headers=headers)
-     request.get_method = lambda : 'PUT'
-
      try:
-       result = urllib.urlopen(request)
-     except urllib.error.HTTPError as e:
+       result = self._http.request('PUT', url, json.dumps(data).encode('utf-8'), headers)
+     except httpclient.HTTPError as e:
        print( 'Error code:', e.code)
        print( 'Reason:', e.reason)
        return False
-     except urllib.error.URLError as e:
+     except httpclient.URLError as e:
        print( 'URLErroe reason:', e.reason)
        return False
      else:
@@ -241,6 +261,367 @@ class RecaiusAsr():
     return result
 
 
+#
+#  Shared auth token
+#
+class RecaiusTokenManager(threading.Thread):
+  """ Utility class to share an auth token between clients.
+  The token is requested once and refreshed in the background before it
+  expires. request() returns a new token (or None) and refresh(token)
+  extends its expiry (returns False on failure)."""
+  def __init__(self, request, refresh, ex_sec=600, margin=60):
+     threading.Thread.__init__(self)
+     self.daemon = True
+     self._request = request
+     self._refresh = refresh
+     self._ex_sec = ex_sec
+     self._margin = min(margin, ex_sec / 4.0)
+     self._cond = threading.Condition()
+     self._renewlock = threading.Lock()
+     self._token = None
+     self._expiry = 0
+     self._running = True
+     self._users = 0
+     self._stats = {'requested': 0, 'refreshed': 0, 'failed': 0, 'hits': 0}
+     self.start()
+
+  def valid(self):
+     return self._token and time.time() < self._expiry
+
+  #
+  #  current token (requested if there is no valid token)
+  #
+  def token(self):
+     with self._cond:
+       if self.valid():
+         self._stats['hits'] += 1
+         return self._token
+     self.renew(False)
+     return self._token
+
+  #
+  #  drop the token (e.g. rejected by the server)
+  #
+  def invalidate(self, token):
+     with self._cond:
+       if self._token == token:
+         self._token = None
+
+  #
+  #  refresh or request the token (one request at a time)
+  #
+  def renew(self, refresh=True):
+     with self._renewlock:
+       with self._cond:
+         token = self._token
+         if not refresh and self.valid():
+           return True
+       if refresh and token and self._refresh(token):
+         stat = 'refreshed'
+       else:
+         token = self._request()
+         stat = 'requested'
+       with self._cond:
+         if not token:
+           self._stats['failed'] += 1
+           return False
+         self._stats[stat] += 1
+         self._token = token
+         self._expiry = time.time() + self._ex_sec
+         self._cond.notify_all()
+         return True
+
+  #
+  #  refresh the token before it expires
+  #
+  def run(self):
+     while True:
+       with self._cond:
+         if not self._running:
+           break
+         if not self._token:
+           self._cond.wait()
+           continue
+         wait = self._expiry - self._margin - time.time()
+         if wait > 0:
+           self._cond.wait(wait)
+           continue
+       if not self.renew():
+         with self._cond:
+           self._cond.wait(min(self._margin, 5.0))
+
+  def stop(self):
+     with self._cond:
+       self._running = False
+       self._cond.notify_all()
+
+  #
+  #  metrics (requested, refreshed, failed and hits)
+  #
+  def getstats(self):
+     with self._cond:
+       return dict(self._stats)
+
+_token_managers = {}
+_token_managers_lock = threading.Lock()
+
+#
+#  token manager shared by the clients of the same account
+#  (each client calls releaseTokenManager when it is terminated)
+#
+def getTokenManager(key, request, refresh, ex_sec=600):
+  with _token_managers_lock:
+    if key not in _token_managers:
+      _token_managers[key] = RecaiusTokenManager(request, refresh, ex_sec)
+    manager = _token_managers[key]
+    manager._users += 1
+    return manager
+
+#
+#  the token manager is stopped when no client uses it
+#
+def releaseTokenManager(manager):
+  with _token_managers_lock:
+    manager._users -= 1
+    if manager._users > 0:
+      return
+    for (key, m) in list(_token_managers.items()):
+      if m is manager:
+        del _token_managers[key]
+  manager.stop()
+
+#
+#  Warm recognition sessions
+#
+class RecaiusSessionPool(threading.Thread):
+  """ Utility class to keep recognition sessions open ahead of use.
+  A session is returned to the pool after a successful request and used
+  again for the next utterance; sessions idle longer than max_idle (sec)
+  are ended. The pool is filled up to size only while there is demand
+  (a session has been acquired in the last max_idle seconds), so an idle
+  component ends its sessions and does not open new ones."""
+  def __init__(self, asr, tokens, size=2, max_idle=60):
+     threading.Thread.__init__(self)
+     self.daemon = True
+     self._asr = asr
+     self._tokens = tokens
+     self._size = size
+     self._max_idle = max_idle
+     self._cond = threading.Condition()
+     self._idle = []
+     self._busy = 0
+     self._last_use = time.time()
+     self._running = True
+     self._stats = {'created': 0, 'reused': 0, 'warm': 0, 'misses': 0, 'discarded': 0}
+     self.start()
+
+  #
+  #  new session (None on failure)
+  #
+  def open(self):
+     asr = self._asr.copy()
+     asr._token = self._tokens.token()
+     if not asr._token or not asr.startVoiceRecogSession():
+       return None
+     with self._cond:
+       self._stats['created'] += 1
+     return asr
+
+  #
+  #  number of sessions kept (idle and in use)
+  #
+  def count(self):
+     return len(self._idle) + self._busy
+
+  #
+  #  session for an utterance (opened now if the pool is empty)
+  #
+  def acquire(self):
+     with self._cond:
+       self._busy += 1
+       self._last_use = time.time()
+       if self._idle:
+         (asr, tm) = self._idle.pop()
+         self._stats['reused' if asr._used else 'warm'] += 1
+         asr._token = self._tokens.token()
+         return asr
+       self._stats['misses'] += 1
+     asr = self.open()
+     if asr is None:
+       with self._cond:
+         self._busy -= 1
+         self._cond.notify()
+     return asr
+
+  #
+  #  return the session (ended if the request failed)
+  #
+  def release(self, asr, ok=True):
+     asr._used = True
+     with self._cond:
+       self._busy -= 1
+       self._cond.notify()
+       if ok and self._running and self.count() < self._size:
+         self._idle.append((asr, time.time()))
+         return
+       self._stats['discarded'] += 1
+     # (the session is ended even if the request has been cancelled)
+     token = httpclient.setcancel(None)
+     try:
+       asr.endVoiceRecogSession()
+     finally:
+       httpclient.setcancel(token)
+
+  #
+  #  open sessions up to the pool size while there is demand
+  #  and end idle sessions
+  #
+  def run(self):
+     while True:
+       expired = []
+       with self._cond:
+         if not self._running:
+           break
+         now = time.time()
+         expired = [s for s in self._idle if now - s[1] > self._max_idle]
+         self._idle = [s for s in self._idle if now - s[1] <= self._max_idle]
+         demand = now - self._last_use <= self._max_idle
+         if not expired and (not demand or self.count() >= self._size):
+           self._cond.wait(self._max_idle / 2.0)
+           continue
+       for (asr, tm) in expired:
+         asr.endVoiceRecogSession()
+       if not expired:
+         asr = self.open()
+         with self._cond:
+           if asr is None:
+             self._cond.wait(5.0)
+             continue
+           if self._running and self.count() < self._size:
+             self._idle.append((asr, time.time()))
+             continue
+         asr.endVoiceRecogSession()
+
+  #
+  #  end all sessions
+  #
+  def close(self):
+     with self._cond:
+       self._running = False
+       idle = self._idle
+       self._idle = []
+       self._cond.notify_all()
+     for (asr, tm) in idle:
+       asr.endVoiceRecogSession()
+
+  #
+  #  metrics (created, reused, warm, misses and discarded sessions)
+  #
+  def getstats(self):
+     with self._cond:
+       return dict(self._stats)
+
+
+#
+#  Streaming upload
+#
+class RecaiusStream(threading.Thread):
+  """ Utility class to upload speech data while the user is speaking.
+  A session is taken from the pool as soon as the stream is created,
+  audio written by write() is sent in chunks as it arrives and close()
+  only flushes. All audio is sent even if the server returns a RESULT in
+  the middle of the stream; the result is the list of RESULT events.
+  The session is ended if the stream has not been flushed."""
+  def __init__(self, pool, chunk_size=16364):
+     threading.Thread.__init__(self)
+     self.daemon = True
+     self._pool = pool
+     self._chunk_size = chunk_size
+     self._cond = threading.Condition()
+     self._pending = bytearray()
+     self._closed = False
+     self._cancelled = False
+     self._result = None
+     # audio is encoded as it arrives for an adpcm session
+     self._adpcm = (pool._asr._audio_type == "audio/x-adpcm")
+     self._adpcm_state = None
+     self.start()
+
+  #
+  #  append speech data (called while speaking)
+  #
+  def write(self, data):
+     if self._adpcm:
+       (data, self._adpcm_state) = audioop.lin2adpcm(data, 2, self._adpcm_state)
+     with self._cond:
+       self._pending += data
+       self._cond.notify()
+
+  #
+  #  end of speech
+  #
+  def close(self):
+     with self._cond:
+       self._closed = True
+       self._cond.notify()
+
+  #
+  #  abandon the stream (the session is ended without flush)
+  #
+  def cancel(self):
+     with self._cond:
+       self._closed = True
+       self._cancelled = True
+       self._cond.notify()
+
+  #
+  #  wait for the result
+  #
+  def finish(self):
+     self.close()
+     self.join()
+     return self._result
+
+  #
+  #  next chunk to send (None at the end of speech)
+  #
+  def nextchunk(self):
+     with self._cond:
+       while not self._pending and not self._closed:
+         self._cond.wait()
+       if self._cancelled or not self._pending:
+         return None
+       chunk = bytes(self._pending[:self._chunk_size])
+       del self._pending[:self._chunk_size]
+       return chunk
+
+  def run(self):
+     asr = self._pool.acquire()
+     if asr is None:
+       return
+     results = []
+     flushed = False
+     try:
+       while True:
+         chunk = self.nextchunk()
+         if chunk is None:
+           break
+         asr._vid += 1
+         res = asr.sendSpeechData(asr._vid, chunk)
+         if res :
+           results.extend([d for d in json.loads(res) if d['type'] == 'RESULT'])
+       if not self._cancelled:
+         res = asr.flushVoiceRecogResult()
+         if res is not False:
+           flushed = True
+           if res :
+             results.extend([d for d in json.loads(res) if d['type'] == 'RESULT'])
+       if results:
+         self._result = results
+     finally:
+       self._pool.release(asr, flushed)
+
+
 def getWavData(fname):
     try:
         f = wave.open(fname)
@@ -248,7 +629,7 @@ def getWavData(fname):
         f.close()
         return data
     except:
-        return ""
+        return b""
 
 def divString(s, n):
   ll=len(s)
@@ -259,10 +640,150 @@ def divString(s, n):
   return res
 
 
+#
+#  check against a local stub Recaius server
+#  (python recaius.py --test)
+#
+def _stubserver(result_at=0):
+  try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+  except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+
+  class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    sessions = {}
+    ended = []
+    log = []
+
+    def handle_error(self, request, client_address):
+      pass
+
+  class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+      pass
+
+    def reply(self, data):
+      data = json.dumps(data).encode('utf-8') if data is not None else b''
+      self.send_response(200)
+      self.send_header('Content-Length', str(len(data)))
+      self.end_headers()
+      self.wfile.write(data)
+
+    def body(self):
+      return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def do_POST(self):
+      self.body()
+      if self.path.endswith('/tokens'):
+        self.reply({'token': 'token'})
+      else:
+        uuid = 'uuid%d' % len(self.server.sessions)
+        self.server.sessions[uuid] = 0
+        self.reply({'uuid': uuid})
+
+    def do_PUT(self):
+      data = self.body()
+      parts = self.path.split('/')
+      if parts[-1] == 'tokens':
+        self.reply(None)
+      elif parts[-1] == 'flush':
+        uuid = parts[-2]
+        self.server.log.append((uuid, 'flush'))
+        self.reply([{'type': 'RESULT', 'result': [{'str': 'flush%d' % self.server.sessions[uuid], 'confidence': 0.5}]}])
+      else:
+        # the voice is the last part of the multipart data
+        voice = data.split(b'application/octet-stream\r\n\r\n', 1)[1].rsplit(b'\r\n', 2)[0]
+        uuid = parts[-1]
+        self.server.sessions[uuid] += len(voice)
+        self.server.log.append((uuid, len(voice)))
+        if len(self.server.log) == result_at:
+          self.reply([{'type': 'RESULT', 'result': [{'str': 'early', 'confidence': 0.9}]}])
+        else:
+          self.reply(None)
+
+    def do_DELETE(self):
+      self.server.ended.append(self.path.split('/')[-1])
+      self.reply(None)
+
+  server = Server(('127.0.0.1', 0), Handler)
+  th = threading.Thread(target=server.serve_forever)
+  th.daemon = True
+  th.start()
+  return server
+
+def _stream(pool, chunks):
+  st = RecaiusStream(pool, 1000)
+  for c in chunks:
+    st.write(c)
+    time.sleep(0.05)
+  return st
+
+def _test():
+  for result_at in (0, 2):
+    server = _stubserver(result_at)
+    url = 'http://127.0.0.1:%d/' % server.server_address[1]
+    asr = RecaiusAsr('id', 'passwd', httpclient.HTTPClient(cookies=True))
+    asr.setUrl(url + 'auth/v2/', url + 'asr/v2/')
+    tokens = getTokenManager((url, 'id'), lambda: asr.copy().requestAuthToken(), lambda t: True)
+    pool = RecaiusSessionPool(asr, tokens, 1)
+    while not pool._idle:
+      time.sleep(0.01)
+
+    # audio is sent while speaking, close() only flushes
+    st = _stream(pool, [b'x' * 1500] * 3)
+    sent = len(server.log)
+    result = st.finish()
+    assert sent >= 3, server.log
+    assert server.sessions['uuid0'] == 4500, server.sessions
+    if result_at:
+      # RESULT in the middle: the rest is still sent and flushed
+      assert [d['result'][0]['str'] for d in result] == ['early', 'flush4500'], result
+    else:
+      assert [d['result'][0]['str'] for d in result] == ['flush4500'], result
+    print ('stream (result at %d): ok' % result_at)
+
+    # the flushed session is used again
+    result = _stream(pool, [b'y' * 500]).finish()
+    assert result[0]['result'][0]['str'] == 'flush5000', result
+    assert pool.getstats()['reused'] == 1, pool.getstats()
+    print ('session reuse: ok')
+
+    # a cancelled stream ends its session
+    st = _stream(pool, [b'z' * 500])
+    st.cancel()
+    st.join()
+    assert st._result is None and 'uuid0' in server.ended, server.ended
+    print ('cancel: ok')
+    pool.close()
+
+    # an idle pool ends its sessions and does not open new ones
+    pool = RecaiusSessionPool(asr, tokens, 1, 0.3)
+    while not pool._idle:
+      time.sleep(0.01)
+    time.sleep(1.0)
+    assert pool.count() == 0 and pool.getstats()['created'] == 1, pool.getstats()
+    result = _stream(pool, [b'w' * 500]).finish()
+    assert result and pool.getstats()['misses'] == 1, pool.getstats()
+    print ('idle pool: ok')
+    pool.close()
+    releaseTokenManager(tokens)
+    assert tokens._running is False
+    asr._http.close()
+    server.shutdown()
+
 #
 #  Main
 #
 if __name__ == '__main__':
+  if '--test' in sys.argv:
+    _test()
+    sys.exit(0)
+
   import glob
   recaius = RecaiusAsr('haraisao_MAj34mD8GZ', 'isao11038867')
   files = glob.glob('log/*.wav')
@@ -27,9 +27,10 @@ import OpenRTM_aist
 import RTC
 from __init__ import __version__
 import utils
+import httpclient
 
 from VoiceSynthComponentBase import *
-from recaius import RecaiusTts
+from recaius import RecaiusTts, releaseTokenManager
 
 
 __doc__ = _('German speech synthesis component using MARY.')
@@ -46,7 +47,8 @@ class RecaiusTalkWrap(VoiceSynthBase):
             self._recaius_passwd=prop.getProperty("recaius_talk.passwd")
 
         self._lang = rtc._language
-        self._recaius = RecaiusTts(self._recaius_id, self._recaius_passwd, self._lang[0])
+        self._http = httpclient.fromproperties(prop, cookies=True)
+        self._recaius = RecaiusTts(self._recaius_id, self._recaius_passwd, self._lang[0], http=self._http)
 
     def getaudio(self, data, character):
         wavfile = self.gettempname()
@@ -55,6 +57,20 @@ class RecaiusTalkWrap(VoiceSynthBase):
         return wavfile
 
 
+    def cacheparams(self):
+        return (self._lang[0],)
+
+    def getstats(self):
+        stats = VoiceSynthBase.getstats(self)
+        for (k, v) in self._recaius._tokens.getstats().items():
+            stats['token_' + k] = v
+        stats['http'] = self._http.getstats()
+        return stats
+
+    def terminate(self):
+        releaseTokenManager(self._recaius._tokens)
+        self._http.close()
+
     def synthreal(self, data, samplerate, character):
         wavfile = self.getaudio(data, character)
         return ("", wavfile)
@@ -83,6 +99,48 @@ RecaiusTalkRTC_spec = ["implementation_id", "RecaiusTalkRTC",
                 "conf.__description__.character", "Character of the voice.",
                 "conf.default.language", "ja_JP",
                 "conf.__widget__.language", "text",
+                "conf.default.cache_dir", "",
+                "conf.__widget__.cache_dir", "text",
+                "conf.__description__.cache_dir", "Directory of the persistent synthesis cache (default: ~/.openhri/synthcache).",
+                "conf.default.cache_bytes", "67108864",
+                "conf.__widget__.cache_bytes", "text",
+                "conf.__type__.cache_bytes", "int",
+                "conf.__description__.cache_bytes", "Size limit of the persistent synthesis cache in bytes (0: disable cache).",
+                "conf.default.streaming", "NO",
+                "conf.__widget__.streaming", "radio",
+                "conf.__constraints__.streaming", "(YES, NO)",
+                "conf.__description__.streaming", "Synthesize long text sentence by sentence and start output after the first one (YES/NO).",
+                "conf.default.resample_quality", "medium",
+                "conf.__widget__.resample_quality", "radio",
+                "conf.__constraints__.resample_quality", "(fast, medium, high)",
+                "conf.__description__.resample_quality", "Quality of the sampling rate conversion (fast, medium, high).",
+                "conf.default.synth_workers", "2",
+                "conf.__widget__.synth_workers", "spin",
+                "conf.__type__.synth_workers", "int",
+                "conf.__constraints__.synth_workers", "0<=x<=16",
+                "conf.__description__.synth_workers", "Number of synthesis worker threads (0: synthesize in the data listener).",
+                "conf.default.queue_size", "8",
+                "conf.__widget__.queue_size", "spin",
+                "conf.__type__.queue_size", "int",
+                "conf.__constraints__.queue_size", "0<=x<=1000",
+                "conf.__description__.queue_size", "Maximum number of waiting texts to be synthesized, each counted as one request in streaming mode too (0: unlimited).",
+                "conf.default.queue_policy", "block",
+                "conf.__widget__.queue_policy", "radio",
+                "conf.__constraints__.queue_policy", "(block, drop_oldest, drop_newest)",
+                "conf.__description__.queue_policy", "Behavior when the request queue is full.",
+                "conf.default.warmup_file", "",
+                "conf.__widget__.warmup_file", "text",
+                "conf.__description__.warmup_file", "Phrase file pre-synthesized into the cache on activation (one phrase per line, optionally followed by character and rate separated by tabs).",
+                "conf.default.frame_ms", "20",
+                "conf.__widget__.frame_ms", "spin",
+                "conf.__type__.frame_ms", "int",
+                "conf.__constraints__.frame_ms", "5<=x<=1000",
+                "conf.__description__.frame_ms", "Duration of an output audio frame in milliseconds.",
+                "conf.default.lead_ms", "100",
+                "conf.__widget__.lead_ms", "spin",
+                "conf.__type__.lead_ms", "int",
+                "conf.__constraints__.lead_ms", "0<=x<=5000",
+                "conf.__description__.lead_ms", "Audio sent ahead of its playback time in milliseconds.",
                 ""]
 
 class RecaiusTalkRTC(VoiceSynthComponentBase):
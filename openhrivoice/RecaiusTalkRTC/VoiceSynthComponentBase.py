@@ -23,13 +23,22 @@ import os
 import sys
 import time
 import signal
+import subprocess
 import tempfile
 import traceback
+import codecs
 import platform
 import wave
+import re
+import hashlib
+import shutil
+import threading
+import collections
+import multiprocessing
 
 import OpenRTM_aist
 import RTC
+import resample
 
 
 #
@@ -42,6 +51,256 @@ def getCurrentTime():
     now = time.time()
   return now
 
+#
+#  monotonic clock for audio playout
+#
+if hasattr(time, 'monotonic'):
+    monotonic = time.monotonic
+else:
+    monotonic = getCurrentTime
+
+#
+#   Persistent synthesis cache
+#
+class SynthCache:
+    """ Disk-backed cache of synthesized audio with LRU eviction.
+
+    Each entry is stored as '<key>.wav' and '<key>.dur' under the cache
+    directory, where key is a hash of the text and the synthesis parameters.
+    The modification time of the wav file keeps the LRU order across restarts.
+    Recently used entries are also kept in memory as PCM data (up to memmaxbytes).
+    """
+    #
+    #  Constructor
+    #
+    def __init__(self, dirname, maxbytes, maxentries=0, memmaxbytes=16777216):
+        self._dir = dirname
+        self._maxbytes = maxbytes
+        self._maxentries = maxentries
+        self._entries = collections.OrderedDict()
+        self._totalbytes = 0
+        self._memmaxbytes = memmaxbytes
+        self._memory = collections.OrderedDict()
+        self._membytes = 0
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        if not os.path.exists(self._dir):
+            os.makedirs(self._dir)
+        self.scan()
+
+    #
+    #  load index of existing entries (oldest first)
+    #
+    def scan(self):
+        files = []
+        for f in os.listdir(self._dir):
+            if not f.endswith('.wav'):
+                continue
+            key = f[:-4]
+            wavfile = os.path.join(self._dir, f)
+            if not os.path.exists(os.path.join(self._dir, key + '.dur')):
+                continue
+            st = os.stat(wavfile)
+            files.append((st.st_mtime, key, st.st_size))
+        files.sort()
+        for (mtime, key, size) in files:
+            self._entries[key] = size
+            self._totalbytes += size
+        self.evict()
+
+    #
+    #  compute cache key
+    #
+    def key(self, *args):
+        return hashlib.sha1(repr(args).encode('utf-8')).hexdigest()
+
+    #
+    #  file names of the entry
+    #
+    def filenames(self, key):
+        return (os.path.join(self._dir, key + '.dur'), os.path.join(self._dir, key + '.wav'))
+
+    #
+    #  get entry: returns (durationdata, pcmdata) or None
+    #
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            (durfile, wavfile) = self.filenames(key)
+            try:
+                os.utime(wavfile, None)
+                entry = self._memory.pop(key, None)
+                if entry is None:
+                    f = open(durfile, 'rb')
+                    durationdata = f.read()
+                    f.close()
+                    if bytes is not str:
+                        durationdata = durationdata.decode('utf-8')
+                    entry = (durationdata, readwav(wavfile))
+                    self._membytes += len(entry[1])
+                self._memory[key] = entry
+            except (IOError, OSError, EOFError, wave.Error):
+                # removed by another process sharing the directory
+                self.remove(key)
+                self.misses += 1
+                return None
+            self._entries[key] = self._entries.pop(key)
+            self.hits += 1
+            self.evict()
+        return entry
+
+    #
+    #  has entry or not
+    #
+    def contains(self, key):
+        with self._lock:
+            return key in self._entries
+
+    #
+    #  store synthesized PCM data into the cache
+    #
+    def put(self, key, durationdata, pcmdata, samplerate):
+        (durfile, cachefile) = self.filenames(key)
+        tmpname = '.tmp%d.%d' % (os.getpid(), threading.current_thread().ident)
+        f = open(durfile + tmpname, 'wb')
+        if isinstance(durationdata, bytes):
+            f.write(durationdata)
+        else:
+            f.write(durationdata.encode('utf-8'))
+        f.close()
+        writewav(cachefile + tmpname, pcmdata, samplerate)
+        with self._lock:
+            self.remove(key)
+            self.rename(durfile + tmpname, durfile)
+            self.rename(cachefile + tmpname, cachefile)
+            size = os.path.getsize(cachefile)
+            self._entries[key] = size
+            self._totalbytes += size
+            self._memory[key] = (durationdata, pcmdata)
+            self._membytes += len(pcmdata)
+            self.evict()
+
+    #
+    #  rename (replace the destination if exists)
+    #
+    def rename(self, src, dst):
+        if os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+    #
+    #  remove entry
+    #
+    def remove(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._totalbytes -= self._entries.pop(key)
+            if key in self._memory:
+                self._membytes -= len(self._memory.pop(key)[1])
+            for f in self.filenames(key):
+                try:
+                    os.remove(f)
+                except OSError:
+                    pass
+
+    #
+    #  drop least recently used entries over the budget
+    #
+    def evict(self):
+        with self._lock:
+            while len(self._entries) > 1 and (self._totalbytes > self._maxbytes or
+                    (self._maxentries > 0 and len(self._entries) > self._maxentries)):
+                self.remove(next(iter(self._entries)))
+            while len(self._memory) > 1 and self._membytes > self._memmaxbytes:
+                self._membytes -= len(self._memory.popitem(False)[1][1])
+
+    #
+    #  set maximum number of entries (0: unlimited)
+    #
+    def set_maxentries(self, n):
+        self._maxentries = n
+        self.evict()
+
+#
+#   read PCM data from wav file
+#
+def readwav(wavfile, samplerate=None, quality='medium', sox_bin='sox', runproc=None):
+    fp = wave.open(wavfile, 'rb')
+    try:
+        (channels, width, rate) = (fp.getnchannels(), fp.getsampwidth(), fp.getframerate())
+        data = fp.readframes(fp.getnframes())
+    finally:
+        fp.close()
+    if samplerate is None or (rate == samplerate and channels == 1 and width == 2):
+        return data
+    if resample.available() and channels == 1 and width == 2:
+        return resample.resample(data, rate, samplerate, quality)
+    # fallback: convert with sox
+    fn = tempfile.mkstemp(suffix='.wav')
+    os.close(fn[0])
+    tmpfiles = [fn[1]]
+    try:
+        if hasattr(wavfile, 'read'):
+            # in-memory wav data
+            fn = tempfile.mkstemp(suffix='.wav')
+            os.close(fn[0])
+            tmpfiles.append(fn[1])
+            wavfile.seek(0)
+            f = open(fn[1], 'wb')
+            f.write(wavfile.read())
+            f.close()
+            wavfile = fn[1]
+        cmdarg = [sox_bin, "-t", "wav", wavfile, "-r", str(samplerate), "-c", "1", "-b", "16", "-t", "wav", tmpfiles[0]]
+        if runproc is not None:
+            runproc(cmdarg)
+        else:
+            subprocess.Popen(cmdarg).wait()
+        return readwav(tmpfiles[0])
+    finally:
+        for f in tmpfiles:
+            os.remove(f)
+
+#
+#  write 16bit mono PCM data to a wav file
+#
+def writewav(wavfile, pcmdata, samplerate):
+    fp = wave.open(wavfile, 'wb')
+    try:
+        fp.setnchannels(1)
+        fp.setsampwidth(2)
+        fp.setframerate(samplerate)
+        fp.writeframes(pcmdata)
+    finally:
+        fp.close()
+
+#
+#  read phrase file: one phrase per line, optionally followed by
+#  character and sampling rate separated by tabs ("#" starts a comment line)
+#
+def readphrases(filename, character, samplerate):
+    phrases = []
+    f = codecs.open(filename, 'r', 'utf-8')
+    try:
+        for l in f:
+            l = l.rstrip('\r\n')
+            if not l.strip() or l.startswith('#'):
+                continue
+            v = l.split('\t')
+            text = v[0].strip()
+            c = character
+            r = samplerate
+            if len(v) > 1 and v[1].strip():
+                c = v[1].strip()
+            if len(v) > 2 and v[2].strip():
+                r = int(v[2])
+            phrases.append((text, r, c))
+    finally:
+        f.close()
+    return phrases
+
 #
 #   Voice Synthesizer Base Class
 #
@@ -51,10 +310,34 @@ class VoiceSynthBase:
     #
     def __init__(self):
         self._durationdata = ""
-        self._fp = None
-        self._history = []
-        self._cache = {}
+        self._view = None
+        self._pos = 0
+        self._framesize = 2
+        self._samplerate = 16000
+        self._played = 0
+        self._durations = collections.deque()
+        self._lock = threading.RLock()
+        self._cond = threading.Condition(self._lock)
+        self._jobs = collections.deque()
+        self._results = {}
+        self._seq = 0
+        self._nextseq = 0
+        self._nworkers = 0
+        self._nthreads = 0
+        self._queuesize = 8
+        self._policy = "block"
+        self._dropped = 0
+        self._warmup_total = 0
+        self._warmup_done = 0
+        self._procs = {}
+        self._local = threading.local()
+        self._starts = collections.deque()
+        self._delimiter_pattern = u'[.?!;]+(?:\\s+|$)'
+        self._cache = None
+        self._cachedir = os.path.join(os.path.expanduser('~'), '.openhri', 'synthcache')
         self._cachesize = 10
+        self._sox_bin = "sox"
+        self._resample_quality = "medium"
         self._copyrights = []
     #
     #  get temporary file name
@@ -65,52 +348,441 @@ class VoiceSynthBase:
         os.close(fn[0])
         return fn[1]
 
+    #
+    #  set persistent cache (maxbytes <= 0 disables the cache)
+    #
+    def set_cache(self, dirname, maxbytes):
+        if not dirname:
+            dirname = self._cachedir
+        if maxbytes > 0:
+            self._cache = SynthCache(dirname, maxbytes, self._cachesize)
+        else:
+            self._cache = None
+
+    #
+    #  engine parameters which affect the synthesized audio
+    #
+    def cacheparams(self):
+        return ()
+
     #
     #  save Wavformatted data
     #
     def synth(self, data, samplerate, character):
         if not data:
             return
-        if self._fp is not None:
-            self._fp.close()
-            self._fp = None
+        entry = self.synthsegment(data, samplerate, character)
+        self.setpcm(entry[0], entry[1], samplerate)
+
+    #
+    #  synthesize text segment by segment (playout starts after the first one)
+    #
+    def synthstream(self, data, samplerate, character):
+        self.flush()
+        self.request(data, samplerate, character, True)
+
+    #
+    #  set number of worker threads, size (in texts) and full policy of the request queue
+    #  (policy: block, drop_oldest or drop_newest)
+    #
+    def set_queue(self, workers, queuesize, policy):
+        with self._cond:
+            self._nworkers = workers
+            self._queuesize = queuesize
+            self._policy = policy
+            while self._nthreads < self._nworkers:
+                self._nthreads += 1
+                th = threading.Thread(target=self.worker)
+                th.daemon = True
+                th.start()
+            self._cond.notify_all()
+
+    #
+    #  queue text to be synthesized after the current requests
+    #  (split into segments which are synthesized in parallel if streaming)
+    #
+    def request(self, data, samplerate, character, streaming=False):
+        if not data:
+            return
+        if streaming:
+            segments = self.splittext(data)
+        else:
+            segments = [data]
+        self.enqueue([(seg, samplerate, character, i == 0) for (i, seg) in enumerate(segments)])
+
+    #
+    #  add the jobs (segments) of a text to the request queue
+    #  (synthesize here if there is no worker).
+    #  The queue size limits the number of texts, so a text is never split.
+    #
+    def enqueue(self, jobs):
+        with self._cond:
+            while self._nworkers > 0 and self.backlog() >= self._queuesize > 0:
+                if self._policy == "drop_newest":
+                    self._dropped += 1
+                    print ("synthesis request dropped (queue full, %d dropped)" % (self._dropped,))
+                    return
+                elif self._policy == "drop_oldest":
+                    self.drop(min([j[2] for j in self._jobs if j[2] >= self.nextutterance()]))
+                else:
+                    self._cond.wait()
+            start = self._seq
+            self._seq += len(jobs)
+            self._starts.append(start)
+            if self._nworkers > 0:
+                self._jobs.extend([(start + i, job, start) for (i, job) in enumerate(jobs)])
+                self._cond.notify_all()
+                return
+        for (i, job) in enumerate(jobs):
+            self.runjob(start + i, job)
+
+    #
+    #  number of queued texts (the text being played is not counted)
+    #
+    def backlog(self):
+        cut = self.nextutterance()
+        return len(set([j[2] for j in self._jobs if j[2] >= cut]))
+
+    #
+    #  drop a queued text which starts at seq start
+    #
+    def drop(self, start):
+        end = self._seq
+        for s in self._starts:
+            if s > start:
+                end = s
+                break
+        self._jobs = collections.deque([j for j in self._jobs if j[2] != start])
+        for seq in range(start, end):
+            self._results[seq] = None
+        self._dropped += 1
+        print ("synthesis request dropped (queue full, %d dropped)" % (self._dropped,))
+
+    #
+    #  worker thread: synthesize queued jobs
+    #
+    def worker(self):
+        self._cond.acquire()
+        try:
+            while True:
+                while not self._jobs and self._nthreads <= self._nworkers:
+                    self._cond.wait()
+                if self._nthreads > self._nworkers:
+                    self._nthreads -= 1
+                    return
+                (seq, job, start) = self._jobs.popleft()
+                self._cond.notify_all()
+                self._cond.release()
+                try:
+                    self.runjob(seq, job)
+                finally:
+                    self._cond.acquire()
+        finally:
+            self._cond.release()
+
+    #
+    #  synthesize a job and store the result for playout
+    #
+    def runjob(self, seq, job):
+        (data, samplerate, character, first) = job
+        self._local.seq = seq
         try:
-            (self._durationdata, wavfile) = self._cache[(data, samplerate, character)]
-            self._fp = wave.open(wavfile, 'rb')
-        except KeyError:
-            (self._durationdata, wavfile) = self.synthreal(data, samplerate, character)
-            self._history.append((data, samplerate, character))
-            self._cache[(data, samplerate, character)] = (self._durationdata, wavfile)
-            self._fp = wave.open(wavfile, 'rb')
-            if len(self._history) > self._cachesize:
-                d = self._history.pop(0)
-                (logdata, wavfile) = self._cache[d]
-                del self._cache[d]
-                del logdata
+            entry = self.synthsegment(data, samplerate, character)
+            result = (entry[0], entry[1], samplerate, first)
+        except:
+            result = None
+            if not self.discarded(seq):
+                print (traceback.format_exc())
+        finally:
+            self._local.seq = None
+        with self._cond:
+            if not self.discarded(seq):
+                self._results[seq] = result
+
+    #
+    #  the request has been played or discarded (its result is None)
+    #
+    def discarded(self, seq):
+        return seq < self._nextseq or (seq in self._results and self._results[seq] is None)
+
+    #
+    #  first seq of the utterances after the one being played
+    #
+    def nextutterance(self):
+        while self._starts and self._starts[0] < self._nextseq:
+            self._starts.popleft()
+        if self._starts:
+            return self._starts[0]
+        return self._seq
+
+    #
+    #  discard queued requests and current playout
+    #
+    def flush(self):
+        with self._cond:
+            self._jobs.clear()
+            self._results.clear()
+            self._nextseq = self._seq
+            self._durations.clear()
+            self._view = None
+            self._pos = 0
+            self._cond.notify_all()
+
+    #
+    #  barge-in: discard queued requests and current playout, and kill running engine processes
+    #
+    def cancel(self):
+        self.flush()
+        self.killprocs()
+
+    #
+    #  discard queued requests of the utterances which are not started yet
+    #  (the current utterance is played to the end, including its segments
+    #   which are still synthesized in streaming mode)
+    #
+    def discard(self):
+        with self._cond:
+            cut = self.nextutterance()
+            self._jobs = collections.deque([j for j in self._jobs if j[0] < cut])
+            for seq in range(cut, self._seq):
+                self._results[seq] = None
+            self._cond.notify_all()
+        self.killprocs(cut)
+
+    #
+    #  seq of the request synthesized in this thread
+    #  (None: synth() without the queue, -1: cache warm-up)
+    #
+    def procseq(self):
+        return getattr(self._local, 'seq', None)
+
+    #
+    #  a process of the request seq is killed by killprocs(fromseq) or not
+    #  (processes of the cache warm-up are never killed)
+    #
+    def killable(self, seq, fromseq):
+        return seq is None or seq >= fromseq
+
+    #
+    #  kill running engine processes of the requests from fromseq
+    #
+    def killprocs(self, fromseq=0):
+        with self._lock:
+            procs = [p for (p, seq) in self._procs.items() if self.killable(seq, fromseq)]
+        for p in procs:
+            try:
+                p.kill()
+            except OSError:
+                pass
+
+    #
+    #  run an engine process and wait for it (killed by cancel())
+    #  raises CalledProcessError if it failed or was killed
+    #
+    def runproc(self, cmdarg, **kwargs):
+        p = subprocess.Popen(cmdarg, **kwargs)
+        with self._lock:
+            self._procs[p] = self.procseq()
+        try:
+            ret = p.wait()
+        finally:
+            with self._lock:
+                del self._procs[p]
+        if ret != 0:
+            raise subprocess.CalledProcessError(ret, cmdarg)
+        return ret
+
+    #
+    #  stop worker threads
+    #
+    def stopworkers(self):
+        self.set_queue(0, self._queuesize, self._policy)
+
+    #
+    #  split text at sentence and clause boundaries
+    #
+    def splittext(self, data):
+        segments = []
+        start = 0
+        for m in re.finditer(self._delimiter_pattern, data):
+            segments.append(data[start:m.end()].strip())
+            start = m.end()
+        segments.append(data[start:].strip())
+        return [seg for seg in segments if seg]
+
+    #
+    #  synthesize (or get from cache) a segment: returns (durationdata, pcmdata)
+    #
+    def synthsegment(self, data, samplerate, character):
+        key = None
+        if self._cache is not None:
+            key = self.cachekey(data, samplerate, character)
+            entry = self._cache.get(key)
+            if entry is not None:
+                return entry
+        return self.synthnew(key, data, samplerate, character)
+
+    #
+    #  key of a segment in the cache
+    #
+    def cachekey(self, data, samplerate, character):
+        return self._cache.key(self.__class__.__name__, data, samplerate, character, self.cacheparams())
+
+    #
+    #  synthesize a segment and store it in the cache (if key is given)
+    #
+    def synthnew(self, key, data, samplerate, character):
+        (durationdata, wavfile) = self.synthreal(data, samplerate, character)
+        if bytes is not str and isinstance(durationdata, bytes):
+            durationdata = durationdata.decode('utf-8')
+        try:
+            entry = (durationdata, readwav(wavfile, samplerate, self._resample_quality, self._sox_bin, self.runproc))
+        finally:
+            if not hasattr(wavfile, 'read'):
                 os.remove(wavfile)
+        # (the output of a request discarded by barge-in may be cut off)
+        seq = self.procseq()
+        with self._lock:
+            discarded = seq is not None and seq >= 0 and self.discarded(seq)
+        if key is not None and not discarded:
+            self._cache.put(key, durationdata, entry[1], samplerate)
+        return entry
+
+    #
+    #  pre-synthesize phrases into the cache in background using all cores
+    #  (phrases: list of (text, samplerate, character))
+    #
+    def warmup(self, phrases, streaming=False, nthreads=0):
+        if self._cache is None:
+            return
+        jobs = collections.deque()
+        for (text, samplerate, character) in phrases:
+            if streaming:
+                segments = self.splittext(text)
+            else:
+                segments = [text]
+            for seg in segments:
+                jobs.append((seg, samplerate, character))
+        with self._lock:
+            self._warmup_total += len(jobs)
+        if nthreads <= 0:
+            nthreads = multiprocessing.cpu_count()
+        for i in range(min(nthreads, len(jobs))):
+            th = threading.Thread(target=self.warmupworker, args=(jobs,))
+            th.daemon = True
+            th.start()
+
+    #
+    #  warm-up thread
+    #
+    def warmupworker(self, jobs):
+        self._local.seq = -1
+        while True:
+            try:
+                (data, samplerate, character) = jobs.popleft()
+            except IndexError:
+                return
+            try:
+                key = self.cachekey(data, samplerate, character)
+                if not self._cache.contains(key):
+                    self.synthnew(key, data, samplerate, character)
+            except:
+                print (traceback.format_exc())
+            with self._lock:
+                self._warmup_done += 1
+                if self._warmup_done == self._warmup_total or self._warmup_done % 10 == 0:
+                    print ("cache warm-up: %d/%d" % (self._warmup_done, self._warmup_total))
+
+    #
+    #  counters of warm-up progress, cache hit rate and the synthesis queue
+    #
+    def getstats(self):
+        with self._cond:
+            queued = self.backlog()
+        stats = {'warmup_done': self._warmup_done, 'warmup_total': self._warmup_total,
+                 'cache_hits': 0, 'cache_misses': 0, 'cache_hitrate': 0.0,
+                 'queued': queued, 'dropped': self._dropped}
+        if self._cache is not None:
+            stats['cache_hits'] = self._cache.hits
+            stats['cache_misses'] = self._cache.misses
+            if self._cache.hits + self._cache.misses > 0:
+                stats['cache_hitrate'] = float(self._cache.hits) / (self._cache.hits + self._cache.misses)
+        return stats
+
+    #
+    #  set PCM data to be played
+    #
+    def setpcm(self, durationdata, pcmdata, samplerate):
+        with self._lock:
+            self.flush()
+            self._starts.append(self._seq)
+            self._results[self._seq] = (durationdata, pcmdata, samplerate, True)
+            self._seq += 1
 
     #
-    #  TTS conversion
+    #  shift time alignment of a segment by offset (sec)
+    #  (each line starts with the end time of the phoneme)
+    #
+    def shiftdurations(self, durationdata, offset):
+        lines = []
+        for l in durationdata.split('\n'):
+            v = l.split(' ', 1)
+            try:
+                v[0] = '%f' % (float(v[0]) + offset,)
+            except ValueError:
+                pass
+            lines.append(' '.join(v))
+        return '\n'.join(lines)
+
+    #
+    #  get time alignment of segments started since last call
+    #
+    def popduration(self):
+        try:
+            return self._durations.popleft()
+        except IndexError:
+            return None
+
+    #
+    #  TTS conversion: returns (durationdata, wavfile)
+    #  (wavfile is a file name or a file object of in-memory wav data)
     #
     def synthreal(self, data, samplerate, character):
         pass
     #
-    #   read data from file.
+    #   read data (memoryview of chunk frames) from PCM buffer.
+    #   returns empty data while waiting for queued requests.
     #
     def readdata(self, chunk):
-        if self._fp is None:
-            return None
-        try:
-            data = self._fp.readframes(chunk)
-        except ValueError:
-            self._fp.close()
-            self._fp = None
-            return None
-        if data == '':
-            self._fp.close()
-            self._fp = None
+        with self._lock:
+            view = self._view
+            if view is not None:
+                data = view[self._pos:self._pos + chunk * self._framesize]
+                if len(data) > 0:
+                    self._pos += len(data)
+                    return data
+                self._played += len(view)
+                self._view = None
+            while self._nextseq in self._results:
+                result = self._results.pop(self._nextseq)
+                self._nextseq += 1
+                if result is None:
+                    continue
+                (durationdata, pcmdata, samplerate, first) = result
+                self._samplerate = samplerate
+                self._durationdata = durationdata
+                if first:
+                    self._played = 0
+                    self._durations.append(durationdata)
+                else:
+                    offset = float(self._played) / (self._framesize * self._samplerate)
+                    self._durations.append(self.shiftdurations(durationdata, offset))
+                self._pos = 0
+                self._view = memoryview(pcmdata)
+                return self.readdata(chunk)
+            if self._nextseq < self._seq:
+                return memoryview(b'')
             return None
-        return data
     #
     #  terminated
     #
@@ -153,7 +825,6 @@ class VoiceSynthComponentBase(OpenRTM_aist.DataFlowComponentBase):
         self._logger.RTC_INFO(self._properties.getProperty("type_name") + " version " + self._properties.getProperty("version"))
         self._logger.RTC_INFO("Copyright (C) 2010-2011 Yosuke Matsusaka")
         self._logger.RTC_INFO("Copyright (C) 2017 Isao Hara")
-        self._prevtime = time.clock()
 
         # configuration parameters
         self._samplerate = [16000,]
@@ -164,6 +835,27 @@ class VoiceSynthComponentBase(OpenRTM_aist.DataFlowComponentBase):
         self._sampling_rate = [0,]
         self.bindParameter("sampling_rate", self._sampling_rate, 0)
 
+        self._cache_dir = ["",]
+        self.bindParameter("cache_dir", self._cache_dir, "")
+        self._cache_bytes = [67108864,]
+        self.bindParameter("cache_bytes", self._cache_bytes, "67108864")
+        self._streaming = ["NO",]
+        self.bindParameter("streaming", self._streaming, "NO")
+        self._resample_quality = ["medium",]
+        self.bindParameter("resample_quality", self._resample_quality, "medium")
+        self._synth_workers = [2,]
+        self.bindParameter("synth_workers", self._synth_workers, "2")
+        self._queue_size = [8,]
+        self.bindParameter("queue_size", self._queue_size, "8")
+        self._queue_policy = ["block",]
+        self.bindParameter("queue_policy", self._queue_policy, "block")
+        self._warmup_file = ["",]
+        self.bindParameter("warmup_file", self._warmup_file, "")
+        self._frame_ms = [20,]
+        self.bindParameter("frame_ms", self._frame_ms, "20")
+        self._lead_ms = [100,]
+        self.bindParameter("lead_ms", self._lead_ms, "100")
+
         # create inport
         self._indata = RTC.TimedString(RTC.Time(0,0), "")
         self._inport = OpenRTM_aist.InPort("text", self._indata)
@@ -172,6 +864,14 @@ class VoiceSynthComponentBase(OpenRTM_aist.DataFlowComponentBase):
                                               DataListener("ON_BUFFER_WRITE", self))
         self.registerInPort(self._inport._name, self._inport)
 
+        # create inport for barge-in control
+        self._controldata = RTC.TimedString(RTC.Time(0,0), "")
+        self._controlport = OpenRTM_aist.InPort("control", self._controldata)
+        self._controlport.appendProperty('description', 'Control of the output: "stop", "flush" (discard queued texts, the current text is played to the end) or "say <text>" (stop and say the text).')
+        self._controlport.addConnectorDataListener(OpenRTM_aist.ConnectorDataListenerType.ON_BUFFER_WRITE,
+                                                   DataListener("CONTROL", self))
+        self.registerInPort(self._controlport._name, self._controlport)
+
         # create outport for wave data
         self._outdata = RTC.TimedOctetSeq(RTC.Time(0,0), None)
         self._outport = OpenRTM_aist.OutPort("result", self._outdata)
@@ -189,7 +889,25 @@ class VoiceSynthComponentBase(OpenRTM_aist.DataFlowComponentBase):
         self._durport = OpenRTM_aist.OutPort("duration", self._durdata)
         self._durport.appendProperty('description', 'Time aliment information of each phonemes (to be used to lip-sync).')
         self.registerOutPort(self._durport._name, self._durport)
+
+        # create outport for statistics
+        self._statsdata = RTC.TimedString(RTC.Time(0,0), "")
+        self._statsport = OpenRTM_aist.OutPort("statistics", self._statsdata)
+        self._statsport.appendProperty('description', 'Counters of warm-up progress, cache hit rate, synthesis queue (queued, dropped) and playout (underruns, overruns) as "name=value" separated by spaces, sent when they change (at most once a second).')
+        self.registerOutPort(self._statsport._name, self._statsport)
+        self._statstime = None
+        self._statstext = ""
         self._is_active = False
+        self._playing = False
+        self._player = None
+        self._framebuf = bytearray()
+        self._playlock = threading.Lock()
+        self._start = None
+        self._sent = 0
+        self._offset = 0.0
+        self._underrun = False
+        self._underruns = 0
+        self._overruns = 0
         return RTC.RTC_OK
 
     #
@@ -197,7 +915,9 @@ class VoiceSynthComponentBase(OpenRTM_aist.DataFlowComponentBase):
     #
     def onFinalize(self):
         OpenRTM_aist.DataFlowComponentBase.onFinalize(self)
+        self.stopplayout()
         if self._wrap :
+            self._wrap.stopworkers()
             self._wrap.terminate()
         return RTC.RTC_OK
 
@@ -206,15 +926,29 @@ class VoiceSynthComponentBase(OpenRTM_aist.DataFlowComponentBase):
     #
     def onActivated(self, ec_id):
         OpenRTM_aist.DataFlowComponentBase.onActivated(self, ec_id)
+        if self._wrap is not None:
+            self._wrap.set_cache(self._cache_dir[0], int(self._cache_bytes[0]))
+            self._wrap._resample_quality = self._resample_quality[0]
+            self._wrap.set_queue(int(self._synth_workers[0]), int(self._queue_size[0]), self._queue_policy[0])
+            if self._warmup_file[0]:
+                try:
+                    phrases = readphrases(self._warmup_file[0], self._character[0], self._samplerate[0])
+                    self._logger.RTC_INFO("cache warm-up: %d phrases" % (len(phrases),))
+                    self._wrap.warmup(phrases, self._streaming[0] == "YES")
+                except:
+                    self._logger.RTC_ERROR(traceback.format_exc())
         self._is_active = True
+        if self._wrap is not None:
+            self.startplayout()
         return RTC.RTC_OK
 
     #
     #  OnDeactivate
     #
-    def onDeactivate(self, ec_id):
-        OpenRTM_aist.DataFlowComponentBase.onDeactivate(self, ec_id)
+    def onDeactivated(self, ec_id):
+        OpenRTM_aist.DataFlowComponentBase.onDeactivated(self, ec_id)
         self._is_active = False
+        self.stopplayout()
         return RTC.RTC_OK
 
     #
@@ -223,46 +957,188 @@ class VoiceSynthComponentBase(OpenRTM_aist.DataFlowComponentBase):
     def onData(self, name, data):
         try:
             if self._is_active == True:
+                if name == "CONTROL":
+                    return self.onControl(data)
                 udata = data.data.encode('raw-unicode-escape').decode()
 
                 self._logger.RTC_INFO(udata + " " + str(self._samplerate[0]) + " " + self._character[0])
                 if self._wrap is not None:
-                    self._wrap.synth(udata, self._samplerate[0], self._character[0])
+                    self._wrap.request(udata, self._samplerate[0], self._character[0], self._streaming[0] == "YES")
         except:
             self._logger.RTC_ERROR(traceback.format_exc())
 
     #
-    #  OnExecute (Periodic execution) 
+    #  control command (barge-in)
     #
-    def onExecute(self, ec_id):
-        OpenRTM_aist.DataFlowComponentBase.onExecute(self, ec_id)
-        try:
-            # send stream
-            now = getCurrentTime()
-            chunk = int(self._samplerate[0] * (now - self._prevtime))
-            data = None
-            if chunk > 0:
-                self._prevtime = now
-                data = self._wrap.readdata(chunk)
-                if data is not None:
-                    #print("===Send data")
-                    if self._statusdata.data != "started":
-                        self._logger.RTC_INFO("stream started")
-                        self._statusdata.data = "started"
-                        self._statusport.write(self._statusdata)
-                        self._durdata.data = self._wrap._durationdata
-                        self._durport.write(self._durdata)
-                        data2 = self._wrap.readdata(int(self._samplerate[0] * 1.0))
-                        if data2 is not None:
-                            data += data2
-                    self._outdata.data = data
-                    self._outport.write(self._outdata)
-                else:
-                    if self._statusdata.data != "finished":
-                        self._logger.RTC_INFO("stream finished")
-                        self._statusdata.data = "finished"
-                        self._statusport.write(self._statusdata)
-        except:
-            self._logger.RTC_ERROR(traceback.format_exc())
-        return RTC.RTC_OK
+    def onControl(self, data):
+        cmd = data.data.encode('raw-unicode-escape').decode().strip()
+        self._logger.RTC_INFO("control: " + cmd)
+        if cmd == "stop":
+            self.interrupt()
+        elif cmd == "flush":
+            self._wrap.discard()
+        elif cmd.startswith("say "):
+            self.interrupt()
+            self._wrap.request(cmd[4:].strip(), self._samplerate[0], self._character[0], self._streaming[0] == "YES")
+        else:
+            self._logger.RTC_ERROR("unknown control command: " + cmd)
+
+    #
+    #  stop current output: cancel synthesis, drop buffered audio and send "interrupted"
+    #
+    def interrupt(self):
+        with self._playlock:
+            self._wrap.cancel()
+            del self._framebuf[:]
+            if self._start is not None:
+                self._start = None
+                self.setstatus("interrupted")
 
+    #
+    #  start playout thread
+    #
+    def startplayout(self):
+        if self._player is not None:
+            return
+        self._playing = True
+        self._player = threading.Thread(target=self.playout)
+        self._player.daemon = True
+        self._player.start()
+
+    #
+    #  stop playout thread
+    #
+    def stopplayout(self):
+        self._playing = False
+        if self._player is not None:
+            self._player.join()
+            self._player = None
+
+    #
+    #  playout thread: send fixed-duration frames paced by a monotonic clock.
+    #  Each frame is sent up to lead_ms before its playback time, which is set as its timestamp.
+    #  underrun: synthesized audio was not ready in time,
+    #  overrun: the thread itself was late and the lead buffer ran out.
+    #  On both, the timeline is shifted to continue from the current time.
+    #
+    def playout(self):
+        while self._playing:
+            try:
+                rate = self._samplerate[0]
+                framesamples = max(1, int(rate * self._frame_ms[0] / 1000.0))
+                period = float(framesamples) / rate
+                with self._playlock:
+                    wait = self.playframe(rate, framesamples, self._lead_ms[0] / 1000.0)
+                self.writestats()
+                if wait:
+                    time.sleep(min(wait, period))
+            except:
+                self._logger.RTC_ERROR(traceback.format_exc())
+                time.sleep(0.1)
+
+    #
+    #  send a frame if it is due: returns time to wait before the next call
+    #
+    def playframe(self, rate, framesamples, lead):
+        now = monotonic()
+        period = float(framesamples) / rate
+        if self._start is not None:
+            t = self._start + float(self._sent) / rate
+            if now < t - lead:
+                return t - lead - now
+        (frame, finished) = self.readframe(framesamples)
+        if frame is None:
+            # waiting for synthesis
+            if self._start is not None and not self._underrun and now >= t:
+                self._underruns += 1
+                self._underrun = True
+            return period
+        if self._start is None:
+            if not frame:
+                return period
+            self._start = now
+            self._sent = 0
+            self._offset = time.time() - now
+            t = now
+            self.setstatus("started")
+        elif now > t:
+            if not self._underrun:
+                self._overruns += 1
+            self._start += now - t
+            t = now
+        self._underrun = False
+        self.writedurations()
+        if frame:
+            ts = t + self._offset
+            self._outdata.tm = RTC.Time(int(ts), int((ts - int(ts)) * 1000000000))
+            self._outdata.data = frame
+            self._outport.write(self._outdata)
+            self._sent += len(frame) // self._wrap._framesize
+        if finished:
+            self._start = None
+            self.setstatus("finished")
+        return 0
+
+    #
+    #  read a frame of nsamples: returns (frame, finished).
+    #  frame is None while waiting for synthesis, shorter at the end of the stream.
+    #
+    def readframe(self, nsamples):
+        nbytes = nsamples * self._wrap._framesize
+        while len(self._framebuf) < nbytes:
+            data = self._wrap.readdata((nbytes - len(self._framebuf)) // self._wrap._framesize)
+            if data is None:
+                frame = bytes(self._framebuf)
+                del self._framebuf[:]
+                return (frame, True)
+            if len(data) == 0:
+                return (None, False)
+            self._framebuf.extend(data)
+        frame = bytes(self._framebuf[:nbytes])
+        del self._framebuf[:nbytes]
+        return (frame, False)
+
+    #
+    #  send time alignment of the segments started
+    #
+    def writedurations(self):
+        durationdata = self._wrap.popduration()
+        while durationdata is not None:
+            self._durdata.data = durationdata
+            self._durport.write(self._durdata)
+            durationdata = self._wrap.popduration()
+
+    #
+    #  send statistics if they changed (at most once a second)
+    #
+    def writestats(self):
+        now = monotonic()
+        if self._statstime is not None and now < self._statstime + 1.0:
+            return
+        self._statstime = now
+        stats = self._wrap.getstats()
+        stats['underruns'] = self._underruns
+        stats['overruns'] = self._overruns
+        items = []
+        for (name, value) in sorted(stats.items()):
+            if isinstance(value, float):
+                items.append("%s=%.2f" % (name, value))
+            elif isinstance(value, int):
+                items.append("%s=%d" % (name, value))
+        text = " ".join(items)
+        if text != self._statstext:
+            self._statstext = text
+            self._statsdata.data = text
+            self._statsport.write(self._statsdata)
+
+    #
+    #  send status
+    #
+    def setstatus(self, status):
+        self._logger.RTC_INFO("stream " + status)
+        if status == "finished":
+            stats = self._wrap.getstats()
+            self._logger.RTC_INFO("cache hit rate: %.2f (%d/%d), warm-up: %d/%d" % (stats['cache_hitrate'], stats['cache_hits'], stats['cache_hits'] + stats['cache_misses'], stats['warmup_done'], stats['warmup_total']))
+            self._logger.RTC_INFO("playout underruns: %d, overruns: %d" % (self._underruns, self._overruns))
+        self._statusdata.data = status
+        self._statusport.write(self._statusdata)
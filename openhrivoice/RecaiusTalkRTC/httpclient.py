@@ -0,0 +1,556 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''HTTP client with persistent connections for the cloud/HTTP backends
+
+Copyright (C) 2017
+    Isao Hara
+    National Institute of Advanced Industrial Science and Technology (AIST),
+    Japan
+    All rights reserved.
+
+Licensed under the Eclipse Public License -v 1.0 (EPL)
+http://www.opensource.org/licenses/eclipse-1.0.txt
+
+Connections are kept alive in a pool per host (scheme, host and port) and
+reused by later requests. The connect and read timeouts are set
+separately. Idempotent requests (GET, HEAD, PUT, DELETE, OPTIONS) are
+retried on connection errors and on 502/503/504 responses, after an
+exponential backoff with random jitter. When a reused connection turns
+out to be closed by the server, the request is sent again at once on a new
+connection if it could not be written, if the server closed the
+connection without answering, or if the method is idempotent. Other
+errors of non-idempotent requests (e.g. a POST which timed out or was cut
+in the middle of the response) are raised, so that such a request is never
+processed twice. The latency of each request is counted in a histogram per
+host.
+
+A thread can set a CancelToken for its requests (setcancel()). Cancelling
+the token from another thread aborts the request in flight by shutting
+down its connection, and later requests of the thread fail at once with
+Cancelled. Connecting is not aborted (it is bounded by the connect
+timeout).
+
+Run this module to check the client against a local stub HTTP server.
+'''
+
+import time
+import random
+import socket
+import threading
+try:
+    import http.client as httplib
+    from urllib.parse import urlsplit, urlencode
+except ImportError:
+    import httplib
+    from urlparse import urlsplit
+    from urllib import urlencode
+RemoteDisconnected = getattr(httplib, 'RemoteDisconnected', None)
+
+IDEMPOTENT = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+RETRY_STATUS = (502, 503, 504)
+
+# upper bounds of the latency histogram in ms (the last bucket is unbounded)
+BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+#
+#  Errors (same attributes as urllib.error)
+#
+class URLError(IOError):
+    def __init__(self, reason):
+        IOError.__init__(self, reason)
+        self.reason = reason
+
+class HTTPError(URLError):
+    def __init__(self, url, code, reason, data):
+        URLError.__init__(self, reason)
+        self.url = url
+        self.code = code
+        self.data = data
+
+    def __str__(self):
+        return 'HTTP Error %d: %s' % (self.code, self.reason)
+
+class Cancelled(URLError):
+    def __init__(self):
+        URLError.__init__(self, 'request cancelled')
+
+#
+#  Cancellation of the requests of a thread
+#
+class CancelToken:
+    """ Utility class to abort the requests of the threads which set it."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._conns = []
+        self.cancelled = False
+
+    #
+    #  register a connection in use (False if already cancelled)
+    #
+    def add(self, conn):
+        with self._lock:
+            if self.cancelled:
+                return False
+            self._conns.append(conn)
+            return True
+
+    def remove(self, conn):
+        with self._lock:
+            if conn in self._conns:
+                self._conns.remove(conn)
+
+    #
+    #  cancel: shut down the connections in use
+    #  (a blocked read returns at once)
+    #
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            conns = self._conns
+            self._conns = []
+        for conn in conns:
+            try:
+                conn.sock.shutdown(socket.SHUT_RDWR)
+            except (AttributeError, socket.error):
+                pass
+
+_local = threading.local()
+
+#
+#  set the cancel token of the requests of the current thread
+#  (None: not cancellable); returns the previous one
+#
+def setcancel(token):
+    prev = getattr(_local, 'token', None)
+    _local.token = token
+    return prev
+
+#
+#  the requests of the current thread have been cancelled or not
+#
+def cancelled():
+    token = getattr(_local, 'token', None)
+    return token is not None and token.cancelled
+
+#
+#  Response
+#
+class Response:
+    """ Utility class to hold a response which has been read completely."""
+    def __init__(self, res, data):
+        self.status = res.status
+        self.reason = res.reason
+        self.headers = res.getheaders()
+        self.data = data
+
+    def getheader(self, name, default=None):
+        name = name.lower()
+        for (k, v) in self.headers:
+            if k.lower() == name:
+                return v
+        return default
+
+    def read(self):
+        return self.data
+
+#
+#  Connections and metrics of a host
+#
+class HostPool:
+    """ Utility class to keep idle keep-alive connections to a host."""
+    def __init__(self, scheme, host, maxidle=4):
+        self._scheme = scheme
+        self._host = host
+        self._maxidle = maxidle
+        self._idle = []
+        self._lock = threading.Lock()
+        self.cookies = {}
+        self.stats = {'requests': 0, 'connections': 0, 'reused': 0, 'retries': 0, 'errors': 0}
+        self.histogram = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+
+    #
+    #  get an idle connection or connect a new one
+    #  (returns (connection, reused))
+    #
+    def get(self, connect_timeout, read_timeout):
+        with self._lock:
+            if self._idle:
+                self.stats['reused'] += 1
+                return (self._idle.pop(), True)
+            self.stats['connections'] += 1
+        if self._scheme == 'https':
+            conn = httplib.HTTPSConnection(self._host, timeout=connect_timeout)
+        else:
+            conn = httplib.HTTPConnection(self._host, timeout=connect_timeout)
+        conn.connect()
+        conn.sock.settimeout(read_timeout)
+        return (conn, False)
+
+    #
+    #  return a connection after the response has been read
+    #
+    def put(self, conn):
+        with self._lock:
+            if len(self._idle) < self._maxidle:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    #
+    #  count a request
+    #
+    def count(self, elapsed, error=False):
+        ms = elapsed * 1000.0
+        i = 0
+        while i < len(BUCKETS) and ms > BUCKETS[i]:
+            i += 1
+        with self._lock:
+            self.stats['requests'] += 1
+            if error:
+                self.stats['errors'] += 1
+            self.histogram[i] += 1
+            self.total += elapsed
+
+    def close(self):
+        with self._lock:
+            idle = self._idle
+            self._idle = []
+        for conn in idle:
+            conn.close()
+
+#
+#  HTTP client
+#
+class HTTPClient:
+    """ Utility class to send HTTP requests over pooled connections."""
+    #
+    #  Constructor
+    #  (timeouts in seconds, retries of idempotent requests, initial backoff in seconds)
+    #
+    def __init__(self, connect_timeout=10.0, read_timeout=30.0, retries=2, backoff=0.2, maxidle=4, cookies=False):
+        self._connect_timeout = connect_timeout
+        self._read_timeout = read_timeout
+        self._retries = retries
+        self._backoff = backoff
+        self._maxidle = maxidle
+        self._cookies = cookies
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    #
+    #  pool of a host
+    #
+    def pool(self, scheme, host):
+        with self._lock:
+            key = (scheme, host)
+            if key not in self._pools:
+                self._pools[key] = HostPool(scheme, host, self._maxidle)
+            return self._pools[key]
+
+    #
+    #  send a request and read the response
+    #  (raises HTTPError on an error status, URLError on a connection error)
+    #
+    def request(self, method, url, body=None, headers=None):
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        pool = self.pool(parts.scheme, parts.netloc)
+        headers = dict(headers or {})
+        attempt = 0
+        while True:
+            if self._cookies and pool.cookies:
+                headers['Cookie'] = '; '.join('%s=%s' % c for c in pool.cookies.items())
+            start = time.time()
+            try:
+                res = self.send(pool, method, path, body, headers)
+            except Cancelled:
+                raise
+            except (httplib.HTTPException, socket.error) as e:
+                pool.count(time.time() - start, True)
+                if cancelled():
+                    raise Cancelled()
+                if method not in IDEMPOTENT or attempt >= self._retries:
+                    raise URLError(e)
+                res = None
+            else:
+                pool.count(time.time() - start, res.status >= 400)
+                if res.status not in RETRY_STATUS or method not in IDEMPOTENT or attempt >= self._retries:
+                    break
+            attempt += 1
+            with pool._lock:
+                pool.stats['retries'] += 1
+            time.sleep(self._backoff * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5))
+
+        if self._cookies:
+            for (k, v) in res.headers:
+                if k.lower() == 'set-cookie':
+                    (name, sep, value) = v.split(';', 1)[0].partition('=')
+                    pool.cookies[name.strip()] = value.strip()
+        if res.status >= 400:
+            raise HTTPError(url, res.status, res.reason, res.data)
+        return res
+
+    #
+    #  one exchange on a pooled connection
+    #  (sent again on a new connection if a reused one has been closed
+    #   before the request has been processed)
+    #
+    def send(self, pool, method, path, body, headers):
+        token = getattr(_local, 'token', None)
+        if token is not None and token.cancelled:
+            raise Cancelled()
+        (conn, reused) = pool.get(self._connect_timeout, self._read_timeout)
+        if token is not None and not token.add(conn):
+            conn.close()
+            raise Cancelled()
+        try:
+            return self.exchange(pool, conn, reused, method, path, body, headers)
+        finally:
+            if token is not None:
+                token.remove(conn)
+
+    def exchange(self, pool, conn, reused, method, path, body, headers):
+        try:
+            conn.request(method, path, body, headers)
+        except (httplib.HTTPException, socket.error) as e:
+            conn.close()
+            if not reused or isinstance(e, socket.timeout) or cancelled():
+                raise
+            return self.send(pool, method, path, body, headers)
+        try:
+            res = conn.getresponse()
+            data = res.read()
+        except (httplib.HTTPException, socket.error) as e:
+            conn.close()
+            if not reused or isinstance(e, socket.timeout) or cancelled():
+                raise
+            if method not in IDEMPOTENT and not unanswered(e):
+                raise
+            return self.send(pool, method, path, body, headers)
+        if cancelled():
+            # (the connection may have been shut down after the response)
+            conn.close()
+        elif res.will_close:
+            conn.close()
+        else:
+            pool.put(conn)
+        return Response(res, data)
+
+    #
+    #  metrics per host: requests, connections, reused, retries, errors,
+    #  latency_avg (sec) and histogram [(upper bound in ms or None, count)]
+    #
+    def getstats(self):
+        with self._lock:
+            pools = list(self._pools.items())
+        stats = {}
+        for ((scheme, host), pool) in pools:
+            with pool._lock:
+                s = dict(pool.stats)
+                s['latency_avg'] = 0.0
+                if s['requests'] > 0:
+                    s['latency_avg'] = pool.total / s['requests']
+                s['histogram'] = list(zip(BUCKETS + (None,), pool.histogram))
+            stats[host] = s
+        return stats
+
+    #
+    #  one line summary of the metrics
+    #
+    def summary(self):
+        lines = []
+        for (host, s) in sorted(self.getstats().items()):
+            lines.append('%s: requests %d, connections %d, reused %d, retries %d, errors %d, latency %.3fs (p50 %s, p95 %s)' %
+                         (host, s['requests'], s['connections'], s['reused'], s['retries'], s['errors'],
+                          s['latency_avg'], percentile(s['histogram'], 0.5), percentile(s['histogram'], 0.95)))
+        return '; '.join(lines)
+
+    #
+    #  close idle connections
+    #
+    def close(self):
+        with self._lock:
+            pools = list(self._pools.values())
+        for pool in pools:
+            pool.close()
+
+#
+#  the server closed the connection without reading a status line
+#
+def unanswered(e):
+    if RemoteDisconnected is not None and isinstance(e, RemoteDisconnected):
+        return True
+    # (py2 reports the empty status line with a message or as "''")
+    return isinstance(e, httplib.BadStatusLine) and (e.line in ('', "''") or e.line.startswith('No status line received'))
+
+#
+#  upper bound of the bucket which contains the percentile (e.g. "<=250ms")
+#
+def percentile(histogram, p):
+    total = sum(n for (b, n) in histogram)
+    if total == 0:
+        return '-'
+    acc = 0
+    for (bound, n) in histogram:
+        acc += n
+        if acc >= p * total:
+            break
+    if bound is None:
+        return '>%dms' % BUCKETS[-1]
+    return '<=%dms' % bound
+
+#
+#  client with options from component properties
+#  (http.connect_timeout, http.read_timeout, http.retries)
+#
+def fromproperties(prop, **kwargs):
+    for (key, conv) in (('connect_timeout', float), ('read_timeout', float), ('retries', int)):
+        value = prop.getProperty('http.' + key)
+        if value:
+            kwargs[key] = conv(value)
+    return HTTPClient(**kwargs)
+
+#
+#  check against a local stub HTTP server
+#  (connection reuse, recovery from closed connections, timeouts, retries)
+#
+def _stubserver():
+    try:
+        from http.server import HTTPServer, BaseHTTPRequestHandler
+        from socketserver import ThreadingMixIn
+    except ImportError:
+        from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+        from SocketServer import ThreadingMixIn
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+        hits = {}
+        release = threading.Event()
+
+        def handle_error(self, request, client_address):
+            # clients which gave up (timeouts) are expected
+            pass
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def reply(self, status, data, length=None):
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(data) if length is None else length))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def handle_request(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            if length:
+                self.rfile.read(length)
+            path = self.path
+            n = self.server.hits.get(path, 0) + 1
+            self.server.hits[path] = n
+            if path == '/drop':
+                # answered, then the keep-alive connection is closed
+                self.reply(200, b'ok')
+                self.close_connection = True
+            elif path == '/cut':
+                # the connection is closed in the middle of the response
+                self.reply(200, b'0123456789', 100)
+                self.close_connection = True
+            elif path == '/slow':
+                self.server.release.wait(1.0)
+                self.reply(200, b'ok')
+            elif path == '/busy' and n == 1:
+                self.reply(503, b'busy')
+            else:
+                self.reply(200, b'ok')
+
+        do_GET = handle_request
+        do_POST = handle_request
+
+    server = Server(('127.0.0.1', 0), Handler)
+    th = threading.Thread(target=server.serve_forever)
+    th.daemon = True
+    th.start()
+    return server
+
+def _test():
+    server = _stubserver()
+    url = 'http://127.0.0.1:%d' % server.server_address[1]
+    host = '127.0.0.1:%d' % server.server_address[1]
+    client = HTTPClient(read_timeout=0.3, retries=1, backoff=0.01)
+
+    # connection reuse
+    for i in range(5):
+        assert client.request('GET', url + '/ok').data == b'ok'
+    s = client.getstats()[host]
+    assert (s['connections'], s['reused']) == (1, 4), s
+    print ('reuse: ok')
+
+    # a reused connection closed by the server: sent again at once
+    for method in ('GET', 'POST'):
+        client.request(method, url + '/drop', b'x')
+        time.sleep(0.1)
+        assert client.request(method, url + '/ok', b'x').data == b'ok'
+    print ('closed connection: ok')
+
+    # cut in the middle of the response: a POST is not sent twice
+    client.request('GET', url + '/ok')
+    try:
+        client.request('POST', url + '/cut', b'x')
+        assert False, 'no error'
+    except URLError:
+        pass
+    assert server.hits['/cut'] == 1, server.hits
+    print ('no duplicate POST: ok')
+
+    # timeout
+    client = HTTPClient(read_timeout=0.3, retries=0)
+    start = time.time()
+    try:
+        client.request('GET', url + '/slow')
+        assert False, 'no timeout'
+    except URLError:
+        pass
+    assert time.time() - start < 0.9
+    print ('timeout: ok')
+
+    # retry of an idempotent request on 503
+    client = HTTPClient(retries=1, backoff=0.01)
+    assert client.request('GET', url + '/busy').data == b'ok'
+    assert client.getstats()[host]['retries'] == 1
+    print ('retry: ok')
+
+    # cancel a request in flight from another thread: aborted, not retried
+    client = HTTPClient(read_timeout=5.0, retries=2, backoff=0.01)
+    token = CancelToken()
+    errors = []
+    def slow():
+        setcancel(token)
+        for i in range(2):
+            try:
+                client.request('GET', url + '/slow')
+            except Cancelled as e:
+                errors.append(time.time())
+    hits = server.hits.get('/slow', 0)
+    th = threading.Thread(target=slow)
+    start = time.time()
+    th.start()
+    time.sleep(0.2)
+    token.cancel()
+    th.join(2.0)
+    assert len(errors) == 2 and errors[0] - start < 0.5, (errors, start)
+    assert server.hits['/slow'] == hits + 1, server.hits
+    assert not client.pool('http', host)._idle
+    print ('cancel: ok')
+    print (client.summary())
+    server.release.set()
+    server.shutdown()
+
+if __name__ == '__main__':
+    _test()
@@ -5,38 +5,36 @@ import sys, os
 import time,wave
 import math
 import json
-import urllib
-import urllib.request, urllib.error
-import cookielib
+import threading
+import httpclient
 
 import base64
 
 
 
+# connections shared by the clients in this process
+_http = httpclient.HTTPClient(cookies=True)
+
 class RecaiusAuth():
-  def __init__(self, service_id, passwd):
+  def __init__(self, service_id, passwd, http=None):
      self._baseAuthUrl="https://api.recaius.jp/auth/v2/"
      self._service_id=service_id
      self._passwd=passwd
      self._token = ''
-
-     opener = urllib.request.build_opener(urllib.request.HTTPSHandler(debuglevel=0),
-                             urllib.request.HTTPCookieProcessor(cookielib.CookieJar()))
-     urllib.request.install_opener(opener)
+     self._http = http or _http
 
   #-------- Recaius Authorization
-  def requestAuthToken(self, srv):
+  def requestAuthToken(self, srv, ex_sec=600):
      url = self._baseAuthUrl+'tokens'
      headers = {'Content-Type' : 'application/json' }
-     data = { srv : { "service_id" : self._service_id, "password" : self._passwd} }
+     data = { srv : { "service_id" : self._service_id, "password" : self._passwd}, "expiry_sec" : ex_sec }
 
-     request = urllib.request.Request(url, data=json.dumps(data), headers=headers)
      try:
-       result = urllib.urlopen(request)
-     except urllib.error.HTTPError as e:
+       result = self._http.request('POST', url, json.dumps(data).encode('utf-8'), headers)
+     except httpclient.HTTPError as e:
        print ('Error code:', e.code)
        return False
-     except urllib.error.URLError as e:
+     except httpclient.URLError as e:
        print ('URLErroe reason:', e.reason)
        return False
      else:
@@ -47,19 +45,17 @@ class RecaiusAuth():
        return True
   #
   #
-  def refreshAuthToken(self, srv):
+  def refreshAuthToken(self, srv, ex_sec=600):
      url = self._baseAuthUrl+'tokens'
      headers = {'Content-Type' : 'application/json', 'X-Token' : self._token }
-     data = { srv : { "service_id" : self._service_id, "password" : self._passwd} }
+     data = { srv : { "service_id" : self._service_id, "password" : self._passwd}, "expiry_sec" : ex_sec }
 
-     request = urllib.request.Request(url, data=json.dumps(data), headers=headers)
-     request.get_method = lambda : 'PUT'
      try:
-       result = urllib.urlopen(request)
-     except urllib.error.HTTPError as e:
+       result = self._http.request('PUT', url, json.dumps(data).encode('utf-8'), headers)
+     except httpclient.HTTPError as e:
        print ('Error code:', e.code)
        return -1
-     except urllib.error.URLError as e:
+     except httpclient.URLError as e:
        print( 'URLErroe reason:', e.reason)
        return -1
      else:
@@ -71,16 +67,15 @@ class RecaiusAuth():
   #
   def checkAuthToken(self):
      query_string = {'service_name' : 'speech_recog_jaJP'}
-     url = '{0}?{1}'.format(self._baseAuthUrl+'tokens', urllib.urlencode(query_string))
+     url = '{0}?{1}'.format(self._baseAuthUrl+'tokens', httpclient.urlencode(query_string))
      headers = {'Content-Type' : 'application/json', 'X-Token' : self._token }
 
-     request = urllib.request.Request(url, headers=headers)
      try:
-       result = urllib.urlopen(request)
-     except urllib.error.HTTPError as e:
+       result = self._http.request('GET', url, None, headers)
+     except httpclient.HTTPError as e:
        print ('Error code:', e.code)
        return -1
-     except urllib.error.URLError as e:
+     except httpclient.URLError as e:
        print ('URLErroe reason:', e.reason)
        return -1
      else:
@@ -89,24 +84,164 @@ class RecaiusAuth():
        data=json.loads(res)
        return data['remaining_sec']
 
+  #
+  #  token manager shared by the clients of this account
+  #
+  def getTokenManager(self, srv, ex_sec=600):
+     def request():
+       if self.requestAuthToken(srv, ex_sec):
+         return self._token
+       return None
+     def refresh(token):
+       self._token = token
+       return self.refreshAuthToken(srv, ex_sec) != -1
+     key = (self._baseAuthUrl, self._service_id, srv)
+     return getTokenManager(key, request, refresh, ex_sec)
+
+#
+#  Shared auth token
+#
+class RecaiusTokenManager(threading.Thread):
+  """ Utility class to share an auth token between clients.
+  The token is requested once and refreshed in the background before it
+  expires. request() returns a new token (or None) and refresh(token)
+  extends its expiry (returns False on failure)."""
+  def __init__(self, request, refresh, ex_sec=600, margin=60):
+     threading.Thread.__init__(self)
+     self.daemon = True
+     self._request = request
+     self._refresh = refresh
+     self._ex_sec = ex_sec
+     self._margin = min(margin, ex_sec / 4.0)
+     self._cond = threading.Condition()
+     self._renewlock = threading.Lock()
+     self._token = None
+     self._expiry = 0
+     self._running = True
+     self._users = 0
+     self._stats = {'requested': 0, 'refreshed': 0, 'failed': 0, 'hits': 0}
+     self.start()
+
+  def valid(self):
+     return self._token and time.time() < self._expiry
+
+  #
+  #  current token (requested if there is no valid token)
+  #
+  def token(self):
+     with self._cond:
+       if self.valid():
+         self._stats['hits'] += 1
+         return self._token
+     self.renew(False)
+     return self._token
+
+  #
+  #  drop the token (e.g. rejected by the server)
+  #
+  def invalidate(self, token):
+     with self._cond:
+       if self._token == token:
+         self._token = None
+
+  #
+  #  refresh or request the token (one request at a time)
+  #
+  def renew(self, refresh=True):
+     with self._renewlock:
+       with self._cond:
+         token = self._token
+         if not refresh and self.valid():
+           return True
+       if refresh and token and self._refresh(token):
+         stat = 'refreshed'
+       else:
+         token = self._request()
+         stat = 'requested'
+       with self._cond:
+         if not token:
+           self._stats['failed'] += 1
+           return False
+         self._stats[stat] += 1
+         self._token = token
+         self._expiry = time.time() + self._ex_sec
+         self._cond.notify_all()
+         return True
+
+  #
+  #  refresh the token before it expires
+  #
+  def run(self):
+     while True:
+       with self._cond:
+         if not self._running:
+           break
+         if not self._token:
+           self._cond.wait()
+           continue
+         wait = self._expiry - self._margin - time.time()
+         if wait > 0:
+           self._cond.wait(wait)
+           continue
+       if not self.renew():
+         with self._cond:
+           self._cond.wait(min(self._margin, 5.0))
+
+  def stop(self):
+     with self._cond:
+       self._running = False
+       self._cond.notify_all()
+
+  #
+  #  metrics (requested, refreshed, failed and hits)
+  #
+  def getstats(self):
+     with self._cond:
+       return dict(self._stats)
+
+_token_managers = {}
+_token_managers_lock = threading.Lock()
+
+#
+#  token manager shared by the clients of the same account
+#  (each client calls releaseTokenManager when it is terminated)
+#
+def getTokenManager(key, request, refresh, ex_sec=600):
+  with _token_managers_lock:
+    if key not in _token_managers:
+      _token_managers[key] = RecaiusTokenManager(request, refresh, ex_sec)
+    manager = _token_managers[key]
+    manager._users += 1
+    return manager
+
+#
+#  the token manager is stopped when no client uses it
+#
+def releaseTokenManager(manager):
+  with _token_managers_lock:
+    manager._users -= 1
+    if manager._users > 0:
+      return
+    for (key, m) in list(_token_managers.items()):
+      if m is manager:
+        del _token_managers[key]
+  manager.stop()
+
 #
 #
 #
 class RecaiusAsr():
-  def __init__(self, service_id, passwd):
+  def __init__(self, service_id, passwd, http=None):
      self._baseAsrUrl="https://api.recaius.jp/asr/v2/"
      self._service_id=service_id
      self._passwd=passwd
-     self._auth=RecaiusAuth(service_id, passwd)
+     self._auth=RecaiusAuth(service_id, passwd, http)
+     self._http = http or _http
      self._token = ''
      self._uuid = ''
      self._vid=1
      self._silence = getWavData("silence.wav")
-     self._boundary = "----Boundary"
-
-     opener = urllib.request.build_opener(urllib.request.HTTPSHandler(debuglevel=0),
-                             urllib.request.HTTPCookieProcessor(cookielib.CookieJar()))
-     urllib.request.install_opener(opener)
+     self._boundary = b"----Boundary"
 
   #-------- Recaius Authorization
   def requestAuthToken(self):
@@ -133,14 +268,13 @@ class RecaiusAsr():
               "model_id": 1,
               "comment": "Start" }
 
-     request = urllib.request.Request(url, data=json.dumps(data), headers=headers)
      try:
-       result = urllib.urlopen(request)
-     except urllib.error.HTTPError as e:
+       result = self._http.request('POST', url, json.dumps(data).encode('utf-8'), headers)
+     except httpclient.HTTPError as e:
        print ('Error code:', e.code)
        print ('Reason:', e.reason)
        return False
-     except urllib.error.URLError as e:
+     except httpclient.URLError as e:
        print ('URLErroe reason:', e.reason)
        return False
      else:
@@ -148,22 +282,20 @@ class RecaiusAsr():
        res = response.decode('utf-8')
        data=json.loads(res)
        self._uuid = data['uuid']
-       self._boundary = "----Boundary"+base64.b64encode(self._uuid)
+       self._boundary = b"----Boundary"+base64.b64encode(self._uuid.encode('utf-8'))
        return True
 
   def endVoiceRecogSession(self):
      url = self._baseAsrUrl+'voices/'+self._uuid
      headers = {'X-Token' : self._token }
 
-     request = urllib.request.Request(url, headers=headers)
-     request.get_method = lambda : 'DELETE'
      try:
-       result = urllib.urlopen(request)
-     except urllib.error.HTTPError as e:
-       print ('Error code:', e.cod(e))
+       result = self._http.request('DELETE', url, None, headers)
+     except httpclient.HTTPError as e:
+       print ('Error code:', e.code)
        print ('Reason:', e.reason)
        return False
-     except urllib.error.URLError as e:
+     except httpclient.URLError as e:
        print ('URLErroe reason:', e.reason)
        return False
      else:
@@ -193,30 +325,23 @@ class RecaiusAsr():
      url = self._baseAsrUrl+'voices/'+self._uuid
      headers = {'Content-Type' : 'multipart/form-data','X-Token' : self._token }
 
-     form_data = self._boundary+"\r\n"
-     form_data += "Content-Disposition: form-data;name=\"voice_id\"\r\n\r\n"
-     form_data += str(vid)+"\r\n"
-     form_data += self._boundary+"\r\n"
-     form_data += "Content-Disposition: form-data;name=\"voice\"\r\n"
-     form_data += "Content-Type: application/octet-stream\r\n\r\n"
+     form_data = bytearray(self._boundary+b"\r\n")
+     form_data += b"Content-Disposition: form-data;name=\"voice_id\"\r\n\r\n"
+     form_data += str(vid).encode('ascii')+b"\r\n"
+     form_data += self._boundary+b"\r\n"
+     form_data += b"Content-Disposition: form-data;name=\"voice\"\r\n"
+     form_data += b"Content-Type: application/octet-stream\r\n\r\n"
      form_data += data
-     form_data += "\r\n"
-     form_data += self._boundary+"\r\n"
-
-     request = urllib.request.Request(url)
-     request.add_header( 'X-Token', self._token )
-     request.add_header( 'Content-Type', 'multipart/form-data')
-     request.add_data(bytearray(form_data))
-
-     request.get_method = lambda : 'PUT'
+     form_data += b"\r\n"
+     form_data += self._boundary+b"\r\n"
 
      try:
-       result = urllib.urlopen(request)
-     except urllib.error.HTTPError as e:
+       result = self._http.request('PUT', url, bytes(form_data), headers)
+     except httpclient.HTTPError as e:
        print( 'Error code:', e.code)
        print ('Reason:', e.reason)
        return False
-     except urllib.error.URLError as e:
+     except httpclient.URLError as e:
        print ('URLErroe reason:', e.reason)
        return False
      else:
@@ -232,16 +357,13 @@ class RecaiusAsr():
 
      data = { "voice_id": self._vid }
 
-     request = urllib.request.Request(url, data=json.dumps(data), headers=headers)
-     request.get_method = lambda : 'PUT'
-
      try:
-       result = urllib.urlopen(request)
-     except urllib.error.HTTPError as e:
+       result = self._http.request('PUT', url, json.dumps(data).encode('utf-8'), headers)
+     except httpclient.HTTPError as e:
        print ('Error code:', e.code)
        print ('Reason:', e.reason)
        return False
-     except urllib.error.URLError as e:
+     except httpclient.URLError as e:
        print ('URLErroe reason:', e.reason)
        return False
      else:
@@ -262,11 +384,13 @@ class RecaiusAsr():
 #
 #
 class RecaiusTts():
-  def __init__(self, service_id, passwd, language='ja_JP'):
+  def __init__(self, service_id, passwd, language='ja_JP', ex_sec=600, http=None):
      self._baseTtsUrl="https://api.recaius.jp/tts/v2/"
      self._service_id=service_id
      self._passwd=passwd
-     self._auth=RecaiusAuth(service_id, passwd)
+     self._auth=RecaiusAuth(service_id, passwd, http)
+     self._http = http or _http
+     self._tokens=self._auth.getTokenManager("speech_synthesis", ex_sec)
      self._lang = language
      self._token = ''
      self._uuid = ''
@@ -275,18 +399,13 @@ class RecaiusTts():
                                     'zh_CN':'zh_CN-en_US-F0002-H00T', 'fr_FR' : 'fr_FR-F0001-H00T'}
                            }
 
-     opener = urllib.request.build_opener(urllib.request.HTTPSHandler(debuglevel=0),
-                             urllib.request.HTTPCookieProcessor(cookielib.CookieJar()))
-     urllib.request.install_opener(opener)
 
      self.requestAuthToken()
 
   #-------- Recaius Authorization
   def requestAuthToken(self):
-     res = self._auth.requestAuthToken("speech_synthesis")
-     if res :
-        self._token = self._auth._token
-     return res
+     self._token = self._tokens.token()
+     return bool(self._token)
 
   def refreshAuthToken(self):
      return self._auth.refreshAuthToken("speech_synthesis")
@@ -296,7 +415,8 @@ class RecaiusTts():
      return self._auth.checkAuthToken()
 
   #-------- PlainText to Speech
-  def text2speech(self, text, id='ja_JP-M0001-H00T'):
+  def text2speech(self, text, id='ja_JP-M0001-H00T', retry=True):
+     self.requestAuthToken()
      url = self._baseTtsUrl+'plaintext2speechwave'
      headers = {'Content-Type' : 'application/json', 'X-Token' : self._token }
 
@@ -323,16 +443,17 @@ class RecaiusTts():
               "kbitrate" : 256        # 352, 256, 128, 64, 32, 15
           }
 
-     request = urllib.request.Request(url, data=json.dumps(data), headers=headers)
-     request.get_method = lambda : 'POST'
-
      try:
-       result = urllib.urlopen(request)
-     except urllib.error.HTTPError as e:
+       result = self._http.request('POST', url, json.dumps(data).encode('utf-8'), headers)
+     except httpclient.HTTPError as e:
        print ('Error code:', e.code)
        print ('Reason:', e.reason)
+       if e.code == 401 and retry:
+         # the token was rejected: request a new one
+         self._tokens.invalidate(self._token)
+         return self.text2speech(text, id, False)
        return ""
-     except urllib.error.URLError as e:
+     except httpclient.URLError as e:
        print ('URLError reason:', e.reason)
        return ""
      else:
@@ -358,7 +479,7 @@ def getWavData(fname):
         f.close()
         return data
     except:
-        return ""
+        return b""
 
 #
 #
@@ -48,6 +48,7 @@ class config():
             os.makedirs(self._configdir)
 
         self._lexicondb = os.path.join(self._configdir, 'lexcon.db')
+        self._grammarcache = os.path.join(self._configdir, 'grammar')
 
         self.julius(os.path.join(self._basedir, "3rdparty") )
         self.openjtalk(os.path.join(self._basedir, "3rdparty") )
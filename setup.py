@@ -91,6 +91,7 @@ setup(name='openhrivoice',
       [console_scripts]
       openjtalkrtc = openhrivoice.OpenJTalkRTC.OpenJTalkRTC:main
       juliusrtc = openhrivoice.JuliusRTC.JuliusRTC:main
+      juliuscompilegrammar = openhrivoice.JuliusRTC.compilegrammar:main
       juliusclirtc = openhrivoice.JuliusCliRTC.JuliusCli:main
       festivalrtc = openhrivoice.FestivalRTC.FestivalRTC:main
       googlespeechrecogrtc = openhrivoice.GoogleSpeechRecogRTC.GoogleSpeechRecogRTC:main